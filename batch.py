@@ -0,0 +1,198 @@
+"""
+Пакетная обработка отчётов МойСклад: справочник Остатки_Комус.xlsx и популярность из CRM
+загружаются один раз, отчёты обрабатываются параллельно в пуле процессов.
+
+Запуск из корня проекта:
+    python batch.py reports/ -o output/
+    python batch.py report1.xlsx report2.xlsx --combined Остатки.xlsx --workers 4
+    python batch.py reports/ --profile другой_поставщик
+"""
+import os
+import sys
+import logging
+import argparse
+from io import BytesIO
+from concurrent.futures import ProcessPoolExecutor
+from openpyxl import Workbook, load_workbook
+from dotenv import load_dotenv
+
+from crm_connector import get_crm_popularity
+from file_processing import process_excel_files, ReportResult
+from profiles import profile_registry
+
+# --- ЗАГРУЗКА ПЕРЕМЕННЫХ ИЗ .ENV ---
+load_dotenv()
+# Сколько процессов обрабатывают пакет одновременно
+BATCH_WORKERS = int(os.getenv("BATCH_WORKERS", str(os.cpu_count() or 1)))
+
+REPORT_EXTENSIONS = ('.xls', '.xlsx')
+SHEET_TITLE_MAX_LENGTH = 31  # Ограничение Excel на длину имени листа
+SHEET_TITLE_FORBIDDEN = '[]:*?/\\'
+
+# Снимок популярности и профиль, переданные процессу пула при запуске
+_worker_popularity_map = None
+_worker_profile = None
+
+
+def collect_inputs(paths):
+    """
+    Раскрывает список файлов и папок в пары (имя файла, путь) для process_batch.
+    Из папок берутся отчёты .xls/.xlsx, временные файлы Excel (~$...) пропускаются.
+    """
+    inputs = []
+    for path in paths:
+        if os.path.isdir(path):
+            for name in sorted(os.listdir(path)):
+                if name.endswith(REPORT_EXTENSIONS) and not name.startswith('~$'):
+                    inputs.append((name, os.path.join(path, name)))
+        else:
+            inputs.append((os.path.basename(path), path))
+    return inputs
+
+
+def process_batch(inputs, popularity_map=None, progress=None, workers=BATCH_WORKERS, profile=None):
+    """
+    Обрабатывает несколько отчётов за один вызов.
+    inputs - список пар (имя файла, путь или содержимое в байтах).
+    popularity_map - снимок популярности; если не передан, запрашивается из CRM один раз на весь пакет.
+    progress - необязательный колбэк progress(text) для сообщений о ходе обработки.
+    workers - размер пула процессов; при workers=1 отчёты обрабатываются по очереди в текущем потоке.
+    profile - имя профиля поставщика (по умолчанию - профиль по умолчанию).
+
+    Возвращает список пар (имя файла, ReportResult или строка с описанием ошибки) в порядке inputs.
+    """
+    profile_settings = profile_registry.get(profile)
+    if popularity_map is None:
+        popularity_map = get_crm_popularity(profile_settings.crm_store, profile_settings.crm_order_method)
+    # Справочник и шаблон загружаются до запуска пула: процессы, созданные через fork, получают их готовыми
+    profile_settings.reference_cache.get()
+    profile_settings.template_cache.get()
+
+    workers = max(1, min(workers, len(inputs)))
+    logging.info(f"Пакетная обработка: {len(inputs)} файлов, процессов: {workers}")
+    if workers == 1:
+        results = []
+        for index, (name, source) in enumerate(inputs, 1):
+            _report_batch_progress(progress, index, len(inputs), name)
+            results.append((name, process_excel_files(source, popularity_map, None, profile)))
+        return results
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                             initargs=(popularity_map, profile)) as executor:
+        futures = [executor.submit(_process_in_worker, source) for _, source in inputs]
+        results = []
+        for index, ((name, _), future) in enumerate(zip(inputs, futures), 1):
+            try:
+                result = future.result()
+            except Exception as e:
+                logging.error(f"Ошибка при обработке файла {name} в пуле: {e}", exc_info=True)
+                result = f"Произошла ошибка при обработке: {e}"
+            _report_batch_progress(progress, index, len(inputs), name)
+            results.append((name, result))
+        return results
+
+
+def _init_worker(popularity_map, profile):
+    global _worker_popularity_map, _worker_profile
+    _worker_popularity_map, _worker_profile = popularity_map, profile
+    profile_settings = profile_registry.get(profile)
+    profile_settings.reference_cache.get()
+    profile_settings.template_cache.get()
+
+
+def _process_in_worker(source):
+    return process_excel_files(source, _worker_popularity_map, None, _worker_profile)
+
+
+def _report_batch_progress(progress, index, total, name):
+    if progress is not None:
+        progress(f"Обработка файла {index} из {total}: {name}")
+
+
+def output_name(result, source_name):
+    """Имя выходного файла с именем исходного отчёта, чтобы результаты пакета не перезаписывали друг друга."""
+    stem = os.path.splitext(result.file_name)[0]
+    return f"{stem} ({os.path.splitext(source_name)[0]}).xlsx"
+
+
+def write_outputs(results, output_dir):
+    """Сохраняет успешные результаты пакета в output_dir. Возвращает список путей."""
+    os.makedirs(output_dir, exist_ok=True)
+    paths = []
+    for source_name, result in results:
+        if not isinstance(result, ReportResult):
+            continue
+        path = os.path.join(output_dir, output_name(result, source_name))
+        with open(path, 'wb') as f:
+            f.write(result.content)
+        paths.append(path)
+    return paths
+
+
+def combine_reports(results, profile=None):
+    """
+    Собирает успешные результаты пакета в одну книгу: по листу на каждый исходный отчёт.
+    Переносятся значения и ширина колонок листа шаблона. Возвращает книгу в виде байтов.
+    """
+    combined = Workbook()
+    combined.remove(combined.active)
+    for source_name, result in results:
+        if not isinstance(result, ReportResult):
+            continue
+        source = load_workbook(BytesIO(result.content))[profile_registry.get(profile).template_sheet]
+        target = combined.create_sheet(_sheet_title(combined, source_name))
+        for row in source.iter_rows(values_only=True):
+            target.append(row)
+        for letter, dimension in source.column_dimensions.items():
+            target.column_dimensions[letter].width = dimension.width
+
+    output = BytesIO()
+    combined.save(output)
+    return output.getvalue()
+
+
+def _sheet_title(workbook, source_name):
+    title = os.path.splitext(source_name)[0]
+    title = ''.join('_' if char in SHEET_TITLE_FORBIDDEN else char for char in title)
+    title = title[:SHEET_TITLE_MAX_LENGTH] or 'Отчёт'
+    candidate, suffix = title, 2
+    while candidate in workbook.sheetnames:
+        tail = f" ({suffix})"
+        candidate = title[:SHEET_TITLE_MAX_LENGTH - len(tail)] + tail
+        suffix += 1
+    return candidate
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Пакетная обработка отчётов МойСклад")
+    parser.add_argument('paths', nargs='+', help="файлы отчётов или папки с ними")
+    parser.add_argument('-o', '--output-dir', default='output', help="куда сохранить результаты")
+    parser.add_argument('--combined', help="сохранить все результаты одной книгой по этому пути")
+    parser.add_argument('--workers', type=int, default=BATCH_WORKERS)
+    parser.add_argument('--no-crm', action='store_true', help="не запрашивать популярность из CRM")
+    parser.add_argument('--profile', help="профиль поставщика из profiles.json")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    inputs = collect_inputs(args.paths)
+    if not inputs:
+        print("Не найдено ни одного отчёта .xls/.xlsx.", file=sys.stderr)
+        return 1
+
+    results = process_batch(inputs, {} if args.no_crm else None, workers=args.workers, profile=args.profile)
+    if args.combined:
+        with open(args.combined, 'wb') as f:
+            f.write(combine_reports(results, args.profile))
+        print(f"Книга с результатами: {args.combined}")
+    else:
+        for path in write_outputs(results, args.output_dir):
+            print(path)
+
+    failed = [(name, result) for name, result in results if not isinstance(result, ReportResult)]
+    for name, error in failed:
+        print(f"{name}: {error}", file=sys.stderr)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
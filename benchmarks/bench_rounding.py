@@ -0,0 +1,50 @@
+"""
+Бенчмарк apply_rounding_logic на синтетических данных.
+
+Запуск из корня проекта:
+    python -m benchmarks.bench_rounding --sizes 10000 100000 1000000
+"""
+import time
+import logging
+import argparse
+import numpy as np
+import pandas as pd
+
+from file_processing import apply_rounding_logic
+
+
+def make_compositions(size, compositions_per_plant=8, seed=0):
+    """
+    Синтетический аналог листа "Состав композиций": ключ, название в CRM, растение,
+    а также рассчитанные остатки и словарь популярности.
+    """
+    rng = np.random.default_rng(seed)
+    plants = max(1, size // compositions_per_plant)
+    df_data = pd.DataFrame({
+        0: rng.integers(0, size, size).astype(str),
+        1: pd.Series(rng.integers(0, size, size)).map('Композиция {}'.format),
+        2: pd.Series(rng.integers(0, plants, size)).map('Растение {}'.format),
+    })
+    calculated_data = rng.integers(-2, 40, size) / rng.integers(1, 7, size)
+    popularity_map = {f'Композиция {i}': int(rng.integers(1, 20)) for i in range(0, size, 3)}
+    return df_data, calculated_data, popularity_map
+
+
+def run(sizes, repeat):
+    for size in sizes:
+        df_data, calculated_data, popularity_map = make_compositions(size)
+        timings = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            apply_rounding_logic(df_data, calculated_data, popularity_map)
+            timings.append(time.perf_counter() - started)
+        print(f"{size:>9} композиций: лучшее {min(timings) * 1000:9.1f} мс, среднее {np.mean(timings) * 1000:9.1f} мс")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Бенчмарк apply_rounding_logic")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10_000, 100_000, 1_000_000])
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+    logging.disable(logging.INFO)
+    run(args.sizes, args.repeat)
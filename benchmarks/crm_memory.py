@@ -0,0 +1,101 @@
+"""
+Бенчмарк памяти синхронизации заказов RetailCRM: пиковый RSS процесса, загружающего заказы
+из локального заменителя CRM, при разном количестве страниц. Страницы сразу сворачиваются
+в хранилище, поэтому прирост пика не должен зависеть от числа страниц.
+
+Каждый замер идёт в отдельном процессе (VmHWM из /proc - пик RSS за всю жизнь процесса, Linux),
+заменитель CRM с заказами работает в процессе бенчмарка и в замер не попадает.
+
+Запуск из корня проекта:
+    python -m benchmarks.crm_memory --pages 10 50 200 --page-size 100
+"""
+import sys
+import json
+import time
+import asyncio
+import logging
+import argparse
+import tempfile
+
+
+def peak_rss_mb():
+    # ru_maxrss не подходит: Linux сохраняет его через exec, и дочерний процесс унаследовал бы пик бенчмарка
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('VmHWM:'):
+                return int(line.split()[1]) / 1024
+    return 0.0
+
+
+async def measure_sync(base_url, page_size):
+    """Замер в дочернем процессе: синхронизация в пустое хранилище. Возвращает dict с результатами."""
+    import crm_connector
+    from retailcrm_client import RetailCrmClient
+
+    crm_connector.CRM_PAGE_LIMIT = page_size
+    baseline = peak_rss_mb()
+    with tempfile.NamedTemporaryFile(suffix='.sqlite') as store_file:
+        store = crm_connector.PopularityStore(store_file.name)
+        started = time.perf_counter()
+        async with RetailCrmClient(base_url, 'benchmark', rate=0) as client:
+            popularity_map = await crm_connector.fetch_crm_popularity(store, client=client)
+        seconds = time.perf_counter() - started
+    return {
+        'seconds': seconds,
+        'baseline_rss_mb': baseline,
+        'peak_rss_mb': peak_rss_mb(),
+        'compositions': len(popularity_map or {}),
+        'streaming': crm_connector.ijson is not None,
+    }
+
+
+async def run(args):
+    # Генераторы (openpyxl, pandas) импортируются только здесь, чтобы не раздувать память процесса замера
+    from benchmarks import synthetic
+
+    orders = synthetic.make_orders(max(args.pages) * args.page_size, args.compositions)
+    results = []
+    for pages in args.pages:
+        runner, base_url = await synthetic.start_crm_server(orders[:pages * args.page_size])
+        try:
+            process = await asyncio.create_subprocess_exec(
+                sys.executable, '-m', 'benchmarks.crm_memory', '--worker', base_url,
+                '--page-size', str(args.page_size), stdout=asyncio.subprocess.PIPE)
+            stdout, _ = await process.communicate()
+        finally:
+            await runner.cleanup()
+        if process.returncode != 0:
+            raise RuntimeError(f"замер для {pages} страниц завершился с кодом {process.returncode}")
+
+        result = {'pages': pages, **json.loads(stdout)}
+        results.append(result)
+        growth = result['peak_rss_mb'] - result['baseline_rss_mb']
+        print(f"{pages:>6} страниц  {result['seconds']:8.2f} с  пик RSS {result['peak_rss_mb']:8.1f} МБ  "
+              f"прирост {growth:6.1f} МБ")
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Пиковая память синхронизации заказов RetailCRM")
+    parser.add_argument('--pages', type=int, nargs='+', default=[10, 50, 200], help="количество страниц заказов")
+    parser.add_argument('--page-size', type=int, default=100, help="заказов на страницу CRM")
+    parser.add_argument('--compositions', type=int, default=500, help="разных композиций в заказах")
+    parser.add_argument('--output', help="куда записать результаты в JSON")
+    parser.add_argument('--worker', metavar='BASE_URL', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    logging.disable(logging.WARNING)
+
+    if args.worker:
+        print(json.dumps(asyncio.run(measure_sync(args.worker, args.page_size))))
+        return
+
+    results = asyncio.run(run(args))
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump({'params': {'page_size': args.page_size, 'compositions': args.compositions},
+                       'results': results}, f, ensure_ascii=False, indent=2)
+        print(f"Результаты сохранены: {args.output}")
+
+
+if __name__ == "__main__":
+    main()
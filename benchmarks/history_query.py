@@ -0,0 +1,78 @@
+"""
+Бенчмарк архива истории расчётов: время дописывания запуска и запросов /history
+(ряд по растению и рейтинг расхода) при разной глубине архива, по сравнению с чтением
+всего архива целиком и фильтрацией в pandas.
+
+Архив заполняется синтетическими запусками задним числом (по одному в день) во временной папке.
+
+Запуск из корня проекта:
+    python -m benchmarks.history_query --days 30 365 730 --rows 2000
+"""
+import time
+import logging
+import argparse
+import tempfile
+from datetime import datetime, timedelta
+import numpy as np
+import pyarrow.dataset as ds
+
+from history_archive import HistoryArchive, HISTORY_DAYS
+from benchmarks.bench_rounding import make_compositions
+
+PROFILE = 'benchmark'
+
+
+def best_of(repeat, func):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = func()
+        timings.append(time.perf_counter() - started)
+    return min(timings), result
+
+
+def full_scan(archive, plant, days):
+    """Без выборки колонок и фильтра на стороне Parquet: весь архив в pandas."""
+    df = ds.dataset(archive.directory, format='parquet', partitioning=archive._partitioning).to_table().to_pandas()
+    since = (datetime.now() - timedelta(days=days)).date().isoformat()
+    df = df[(df['profile'] == PROFILE) & (df['date'] >= since) & (df['plant'] == plant)]
+    return df.groupby(['date', 'run_at'])['final_value'].sum()
+
+
+def run(args):
+    df_data, calculated_data, popularity_map = make_compositions(args.rows)
+    final_values = np.floor(np.clip(calculated_data, 0, None))
+    plant = df_data.iloc[0, 2]
+    now = datetime.now()
+    filled = 0
+    with tempfile.TemporaryDirectory() as directory:
+        archive = HistoryArchive(directory)
+        for days in sorted(args.days):
+            append_timings = []
+            for day in range(days - 1, filled - 1, -1):
+                started = time.perf_counter()
+                archive.append(PROFILE, df_data, calculated_data, final_values - day % 7, popularity_map,
+                               run_at=now - timedelta(days=day))
+                append_timings.append(time.perf_counter() - started)
+            filled = days
+
+            series_seconds, points = best_of(args.repeat, lambda: archive.series(PROFILE, plant, HISTORY_DAYS))
+            depletion_seconds, _ = best_of(args.repeat, lambda: archive.depletion(PROFILE, HISTORY_DAYS))
+            scan_seconds, _ = best_of(args.repeat, lambda: full_scan(archive, plant, HISTORY_DAYS))
+            print(f"{days:>5} дней  запись {np.median(append_timings) * 1000:6.1f} мс  "
+                  f"ряд {series_seconds * 1000:7.1f} мс ({len(points)} точек)  "
+                  f"рейтинг {depletion_seconds * 1000:7.1f} мс  полное чтение {scan_seconds * 1000:8.1f} мс")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Запись и запросы архива истории расчётов")
+    parser.add_argument('--days', type=int, nargs='+', default=[30, 365, 730], help="глубина архива в днях")
+    parser.add_argument('--rows', type=int, default=2000, help="строк справочника в одном запуске")
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+    logging.disable(logging.WARNING)
+    run(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,154 @@
+"""
+Бенчмарк всей цепочки загрузка -> отчёт по стадиям на синтетических данных.
+
+Для каждой стадии измеряется время (лучшее из --repeat запусков) и пиковая память (tracemalloc,
+отдельным запуском, чтобы трассировка не искажала время). Результат пишется в JSON; если указан
+--baseline, стадии сравниваются с ним и при замедлении больше --tolerance скрипт завершается с кодом 1.
+
+Запуск из корня проекта:
+    python -m benchmarks.pipeline --plants 500 --per-plant 8 --orders 5000 --output bench.json
+    python -m benchmarks.pipeline --baseline bench.json
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import logging
+import platform
+import argparse
+import tempfile
+import tracemalloc
+
+import crm_connector
+from benchmarks import synthetic
+from retailcrm_client import RetailCrmClient
+from file_processing import read_report_range, calculate_formulas, apply_rounding_logic
+from reference_cache import ReferenceCache
+from report_writer import TemplateCache, render_report
+
+
+def measure(func, repeat):
+    """Возвращает (результат, лучшее время в секундах, пиковая память в байтах)."""
+    timings = []
+    result = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = func()
+        timings.append(time.perf_counter() - started)
+
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, min(timings), peak
+
+
+def run(args, workdir):
+    stages = {}
+
+    def stage(name, func):
+        result, seconds, peak = measure(func, args.repeat)
+        stages[name] = {'seconds': seconds, 'peak_bytes': peak}
+        print(f"{name:<22} {seconds * 1000:10.1f} мс  {peak / 2 ** 20:8.1f} МБ")
+        return result
+
+    reference_path = os.path.join(workdir, 'reference.xlsx')
+    template_path = os.path.join(workdir, 'template.xlsx')
+    compositions = synthetic.make_reference(reference_path, args.plants, args.per_plant)
+    synthetic.make_template(template_path, compositions)
+    report = synthetic.make_report(args.report_rows)
+    orders = synthetic.make_orders(args.orders, compositions)
+    report_range = f'D13:F{13 + args.report_rows}'
+
+    report_df = stage('read_report_range', lambda: read_report_range(report, report_range))
+    reference = stage('load_reference', lambda: ReferenceCache(reference_path).get())
+
+    komus_df_1 = reference.komus_df_1.copy()
+    stock = report_df.iloc[:, 2].to_numpy()[:len(komus_df_1)]
+    komus_df_1.iloc[:len(stock), 2] = stock
+    calculated_data = stage('calculate_formulas',
+                            lambda: calculate_formulas(komus_df_1, reference.komus_df_2_all, reference.countif_dict,
+                                                       index=reference.index))
+
+    async def fetch_popularity():
+        runner, base_url = await synthetic.start_crm_server(orders)
+        try:
+            # Каждый замер - полная синхронизация в пустое хранилище
+            store_path = os.path.join(workdir, 'popularity.sqlite')
+            if os.path.exists(store_path):
+                os.remove(store_path)
+            store = crm_connector.PopularityStore(store_path)
+            async with RetailCrmClient(base_url, 'benchmark', rate=args.crm_rate, burst=1) as client:
+                return await crm_connector.fetch_crm_popularity(store, client=client)
+        finally:
+            await runner.cleanup()
+
+    crm_connector.CRM_PAGE_LIMIT = args.page_size
+    popularity_map = stage('get_crm_popularity', lambda: asyncio.run(fetch_popularity()))
+
+    calculated_series = stage('apply_rounding_logic',
+                              lambda: apply_rounding_logic(reference.komus_df_2_all, calculated_data, popularity_map,
+                                                           index=reference.index))
+
+    template_cache = TemplateCache(template_path)
+    stage('render_report', lambda: render_report(calculated_series.to_numpy(), template_cache))
+
+    return {
+        'params': {key: value for key, value in vars(args).items() if key not in ('output', 'baseline')},
+        'environment': {'python': platform.python_version(), 'machine': platform.machine()},
+        'created_at': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'stages': stages,
+    }
+
+
+def compare(results, baseline, tolerance):
+    """Сравнивает время стадий с базовым прогоном. Возвращает список замедлившихся стадий."""
+    regressions = []
+    for name, stage in results['stages'].items():
+        base = baseline.get('stages', {}).get(name)
+        if not base:
+            continue
+        ratio = stage['seconds'] / base['seconds'] if base['seconds'] else 1.0
+        mark = ''
+        if ratio > 1 + tolerance:
+            regressions.append(name)
+            mark = '  <-- замедление'
+        print(f"{name:<22} {base['seconds'] * 1000:10.1f} -> {stage['seconds'] * 1000:10.1f} мс  x{ratio:.2f}{mark}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк цепочки обработки отчёта по стадиям")
+    parser.add_argument('--report-rows', type=int, default=70, help="строк в отчёте МойСклад")
+    parser.add_argument('--plants', type=int, default=90, help="растений (строк первого листа справочника)")
+    parser.add_argument('--per-plant', type=int, default=4, help="композиций на растение")
+    parser.add_argument('--orders', type=int, default=2000, help="заказов в CRM")
+    parser.add_argument('--page-size', type=int, default=100, help="заказов на страницу CRM")
+    parser.add_argument('--crm-rate', type=float, default=1000.0, help="лимит запросов к CRM в секунду")
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--output', help="куда записать результаты в JSON")
+    parser.add_argument('--baseline', help="JSON с результатами базового прогона для сравнения")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="допустимое замедление (0.2 = 20%%)")
+    args = parser.parse_args()
+    logging.disable(logging.WARNING)
+
+    with tempfile.TemporaryDirectory() as workdir:
+        results = run(args, workdir)
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+        print(f"Результаты сохранены: {args.output}")
+
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print(f"Замедлились стадии: {', '.join(regressions)}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
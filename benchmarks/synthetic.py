@@ -0,0 +1,124 @@
+"""
+Генераторы синтетических данных для бенчмарков: отчёт МойСклад, справочник Остатки_Комус.xlsx,
+шаблон отчёта и заказы RetailCRM, а также локальный заменитель API RetailCRM.
+"""
+import random
+from io import BytesIO
+from datetime import datetime, timedelta
+from aiohttp import web
+from openpyxl import Workbook
+
+from reference_cache import KOMUS_LIST_1, KOMUS_LIST_2
+from report_writer import LESKOVSKY_SHEET
+
+
+def plant_name(index):
+    return f'Растение {index} 12/30 см'
+
+
+def composition_name(index):
+    return f'Композиция {index}'
+
+
+def make_report(rows, first_row=13, seed=0):
+    """Отчёт МойСклад: в колонках D:F с first_row - артикул, название и остаток. Возвращает байты xlsx."""
+    rng = random.Random(seed)
+    workbook = Workbook(write_only=True)
+    worksheet = workbook.create_sheet()
+    for _ in range(first_row - 1):
+        worksheet.append([])
+    for index in range(rows):
+        worksheet.append([None, None, None, rng.randint(1, 10 ** 7), plant_name(index), rng.randint(-2, 30)])
+    output = BytesIO()
+    workbook.save(output)
+    return output.getvalue()
+
+
+def make_reference(path, plants, compositions_per_plant, seed=0):
+    """
+    Справочник с двумя листами в раскладке Остатки_Комус.xlsx:
+    KOMUS_LIST_1 - артикул, наименование, остаток; KOMUS_LIST_2 - колонки 2/4/5 (состав, название в CRM, растение).
+    """
+    rng = random.Random(seed)
+    workbook = Workbook(write_only=True)
+    compositions = workbook.create_sheet(KOMUS_LIST_2)
+    compositions.append(['Артикул', None, 'Состав композиции', None, 'Название в СРМ', 'Название растений'])
+    index = 0
+    for plant in range(plants):
+        for _ in range(compositions_per_plant):
+            compositions.append([rng.randint(1, 10 ** 7), None, plant_name(plant), None,
+                                 composition_name(index), plant_name(plant)])
+            index += 1
+
+    stock = workbook.create_sheet(KOMUS_LIST_1)
+    stock.append(['Артикул', 'Наименование', 'остаток'])
+    for plant in range(plants):
+        stock.append([rng.randint(1, 10 ** 6), plant_name(plant), rng.randint(-1, 40)])
+    workbook.save(path)
+    return index
+
+
+def make_template(path, rows):
+    """Шаблон отчёта Лесковского с заголовком и rows строками данных."""
+    workbook = Workbook(write_only=True)
+    worksheet = workbook.create_sheet(LESKOVSKY_SHEET)
+    worksheet.append(['Артикул Поставщика', 'Наименование', 'Остатки на складе поставщика', 'Цена с НДС'])
+    for index in range(rows):
+        worksheet.append([index + 1, composition_name(index), 0, 1000])
+    workbook.save(path)
+
+
+def make_orders(count, compositions, days=60, seed=0):
+    """Заказы RetailCRM с 1-3 позициями, в свойстве SET_NAME которых указана композиция в [...]."""
+    rng = random.Random(seed)
+    now = datetime.now()
+    orders = []
+    for order_id in range(1, count + 1):
+        items = []
+        for _ in range(rng.randint(1, 3)):
+            name = composition_name(rng.randrange(compositions))
+            items.append({
+                'offer': {'name': name},
+                'quantity': 1,
+                'properties': [{'code': 'SET_NAME', 'name': 'Набор', 'value': f'Набор [{name}]'}],
+            })
+        created_at = now - timedelta(days=rng.uniform(0, days))
+        orders.append({
+            'id': order_id,
+            'createdAt': created_at.strftime('%Y-%m-%d %H:%M:%S'),
+            'customer': {'firstName': 'Имя', 'lastName': 'Фамилия', 'email': 'client@example.com'},
+            'delivery': {'address': {'text': 'г. Москва, ул. Примерная, д. 1'}},
+            'items': items,
+        })
+    return orders
+
+
+def make_crm_app(orders):
+    """aiohttp-приложение, отвечающее на GET /api/v5/orders как RetailCRM (фильтр createdAtFrom, постранично)."""
+
+    async def list_orders(request):
+        date_from = request.query.get('filter[createdAtFrom]', '')
+        selected = [order for order in orders if order['createdAt'] >= date_from]
+        limit = int(request.query.get('limit', 20))
+        page = int(request.query.get('page', 1))
+        total_pages = max(1, -(-len(selected) // limit))
+        return web.json_response({
+            'success': True,
+            'pagination': {'limit': limit, 'totalCount': len(selected), 'currentPage': page,
+                           'totalPageCount': total_pages},
+            'orders': selected[(page - 1) * limit:page * limit],
+        })
+
+    app = web.Application()
+    app.router.add_get('/api/v5/orders', list_orders)
+    return app
+
+
+async def start_crm_server(orders, host='127.0.0.1', port=0):
+    """Запускает заменитель RetailCRM. Возвращает (runner, base_url)."""
+    runner = web.AppRunner(make_crm_app(orders))
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return runner, f'http://{host}:{port}'
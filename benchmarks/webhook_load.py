@@ -0,0 +1,179 @@
+"""
+Нагрузочный тест режима webhook: отправляет на адрес бота поток смоделированных обновлений Telegram
+и считает пропускную способность и задержку ответа (p50/p95/p99).
+
+С --fake-api-port тест сам поднимает заменитель Bot API: бот, запущенный с
+TELEGRAM_API_URL=http://127.0.0.1:<порт>, отвечает в него, а не в Telegram. Тогда в смесь
+можно добавить документы (--document, --documents) и дождаться, пока бот пришлёт все отчёты.
+
+Запуск из корня проекта (бот: BOT_MODE=webhook, BOT_TOKEN=123:test, TELEGRAM_API_URL=http://127.0.0.1:8081):
+    python -m benchmarks.webhook_load --url http://127.0.0.1:8080/webhook --updates 2000 --concurrency 50
+    python -m benchmarks.webhook_load --fake-api-port 8081 --document report.xlsx --documents 10
+"""
+import sys
+import json
+import time
+import asyncio
+import logging
+import argparse
+from collections import Counter
+import aiohttp
+from aiohttp import web
+
+USER_ID_BASE = 10 ** 6
+
+
+def percentile(values, share):
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(round(share * (len(ordered) - 1))))]
+
+
+def make_update(update_id, user_id, text=None, document=None):
+    """Обновление с личным сообщением пользователя: текст или документ (file_id, имя, размер)."""
+    message = {
+        'message_id': update_id,
+        'date': int(time.time()),
+        'chat': {'id': user_id, 'type': 'private'},
+        'from': {'id': user_id, 'is_bot': False, 'first_name': 'Нагрузка'},
+    }
+    if document:
+        file_id, file_name, file_size = document
+        message['document'] = {'file_id': file_id, 'file_unique_id': file_id, 'file_name': file_name,
+                               'file_size': file_size}
+    else:
+        message['text'] = text
+        message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text)}]
+    return {'update_id': update_id, 'message': message}
+
+
+class FakeBotApi:
+    """Заменитель Bot API: отвечает на любой метод, раздаёт файл документа и считает вызовы."""
+
+    def __init__(self, document=b''):
+        self.document = document
+        self.calls = Counter()
+        self._message_id = 0
+
+    def make_app(self):
+        app = web.Application(client_max_size=64 * 2 ** 20)
+        app.router.add_post('/bot{token}/{method}', self.handle_method)
+        app.router.add_get('/file/bot{token}/{path:.*}', self.handle_file)
+        return app
+
+    async def handle_method(self, request):
+        method = request.match_info['method']
+        self.calls[method] += 1
+        form = await request.post()
+        if method in ('setWebhook', 'deleteWebhook', 'answerCallbackQuery'):
+            return web.json_response({'ok': True, 'result': True})
+        if method == 'getFile':
+            return web.json_response({'ok': True, 'result': {
+                'file_id': form.get('file_id'), 'file_unique_id': form.get('file_id'),
+                'file_size': len(self.document), 'file_path': 'documents/report.xlsx'}})
+        self._message_id += 1
+        chat_id = int(form.get('chat_id') or 0)
+        return web.json_response({'ok': True, 'result': {
+            'message_id': self._message_id, 'date': int(time.time()), 'chat': {'id': chat_id, 'type': 'private'},
+            'text': form.get('text', '')}})
+
+    async def handle_file(self, request):
+        self.calls['download'] += 1
+        return web.Response(body=self.document)
+
+
+async def fire(args, document_size=0):
+    """
+    Отправляет обновления с ограничением параллельности; документы - только если их есть кому раздать
+    (document_size > 0). Возвращает (задержки в секундах, статусы ответов, общее время).
+    """
+    updates = [make_update(index, USER_ID_BASE + index, document=(f'doc-{index}', 'report.xlsx', document_size))
+               for index in range(1, args.documents + 1)] if document_size else []
+    updates += [make_update(len(updates) + index, USER_ID_BASE + index % args.users, text='/start')
+                for index in range(1, args.updates + 1)]
+
+    headers = {'X-Telegram-Bot-Api-Secret-Token': args.secret} if args.secret else {}
+    latencies = []
+    statuses = Counter()
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async with aiohttp.ClientSession(headers=headers) as session:
+        async def send(update):
+            async with semaphore:
+                started = time.perf_counter()
+                try:
+                    async with session.post(args.url, data=json.dumps(update),
+                                            headers={'Content-Type': 'application/json'}) as response:
+                        await response.read()
+                        statuses[response.status] += 1
+                except aiohttp.ClientError as e:
+                    statuses[type(e).__name__] += 1
+                latencies.append(time.perf_counter() - started)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(send(update) for update in updates))
+        return latencies, statuses, time.perf_counter() - started
+
+
+async def run(args):
+    document = b''
+    if args.document:
+        with open(args.document, 'rb') as f:
+            document = f.read()
+
+    fake_api = runner = None
+    if args.fake_api_port:
+        fake_api = FakeBotApi(document)
+        runner = web.AppRunner(fake_api.make_app())
+        await runner.setup()
+        await web.TCPSite(runner, '127.0.0.1', args.fake_api_port).start()
+        print(f"Заменитель Bot API: http://127.0.0.1:{args.fake_api_port}")
+
+    try:
+        latencies, statuses, seconds = await fire(args, len(document) if fake_api else 0)
+        total = len(latencies)
+        print(f"Обновлений: {total} за {seconds:.2f} с, {total / seconds:.0f} в секунду")
+        print(f"Ответы: {dict(statuses)}")
+        print(f"Задержка ответа: p50 {percentile(latencies, 0.50) * 1000:.1f} мс, "
+              f"p95 {percentile(latencies, 0.95) * 1000:.1f} мс, p99 {percentile(latencies, 0.99) * 1000:.1f} мс, "
+              f"макс {max(latencies, default=0) * 1000:.1f} мс")
+
+        if fake_api is not None:
+            expected = args.documents if document else 0
+            drain_started = time.perf_counter()
+            while fake_api.calls['sendDocument'] < expected and time.perf_counter() - drain_started < args.drain:
+                await asyncio.sleep(0.2)
+            print(f"Отчётов отправлено: {fake_api.calls['sendDocument']} из {expected}, "
+                  f"ожидание после последнего обновления {time.perf_counter() - drain_started:.1f} с")
+            # Бот отвечает на обновления в фоне, уже после ответа webhook: ждём, пока вызовы затихнут,
+            # иначе последние ответы упрутся в остановленный заменитель
+            total_calls = -1
+            while total_calls != sum(fake_api.calls.values()):
+                total_calls = sum(fake_api.calls.values())
+                await asyncio.sleep(1.0)
+            print(f"Вызовы Bot API: {dict(fake_api.calls)}")
+    finally:
+        if runner is not None:
+            await runner.cleanup()
+    return 0 if all(status == 200 for status in statuses) else 1
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест webhook бота")
+    parser.add_argument('--url', default='http://127.0.0.1:8080/webhook', help="адрес webhook бота")
+    parser.add_argument('--secret', help="WEBHOOK_SECRET бота")
+    parser.add_argument('--updates', type=int, default=1000, help="текстовых обновлений (/start)")
+    parser.add_argument('--users', type=int, default=100, help="разных пользователей среди текстовых обновлений")
+    parser.add_argument('--concurrency', type=int, default=50, help="одновременных запросов")
+    parser.add_argument('--fake-api-port', type=int, help="поднять заменитель Bot API на этом порту")
+    parser.add_argument('--document', help="отчёт МойСклад, который отдаёт заменитель Bot API")
+    parser.add_argument('--documents', type=int, default=0, help="обновлений с документом")
+    parser.add_argument('--drain', type=float, default=120.0, help="сколько секунд ждать отправки всех отчётов")
+    args = parser.parse_args()
+    logging.disable(logging.WARNING)
+    sys.exit(asyncio.run(run(args)))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,110 +1,287 @@
 import os
-import requests
 import re
+import asyncio
 import logging
+import sqlite3
+import aiohttp
 from datetime import datetime, timedelta
 from dotenv import load_dotenv
 
+from metrics import metrics
+from retailcrm_client import RetailCrmClient, CrmError, crm_client, CRM_CONCURRENCY
+
+try:
+    import ijson
+except ImportError:  # Без ijson страница разбирается целиком через json
+    ijson = None
+
 load_dotenv()
-CRM_API_URL = os.getenv("RETAILCRM_BASE_URL")
-CRM_API_KEY = os.getenv("RETAILCRM_API_KEY")
 
-CRM_API_VERSION = "v5"
+# --- НАСТРОЙКИ ЗАГРУЗКИ ---
+CRM_POPULARITY_DAYS = 60  # Окно расчёта популярности
+CRM_PAGE_LIMIT = 100  # Максимальный лимит для постранички
+# Локальное хранилище составов заказов для инкрементальной синхронизации
+CRM_STORE_PATH = os.getenv("CRM_STORE_PATH", "crm_popularity.sqlite")
+# Заказы, созданные за последние N дней до прошлой синхронизации, перезагружаются повторно,
+# чтобы подхватить правки в недавних заказах
+CRM_SYNC_OVERLAP_DAYS = int(os.getenv("CRM_SYNC_OVERLAP_DAYS", "1"))
+# Способ оформления заказов, по которым считается популярность (в профилях задаётся свой)
+CRM_ORDER_METHOD = os.getenv("CRM_ORDER_METHOD", "komus")
+
+SET_NAME_PATTERN = re.compile(r'\[(.*?)\]')  # Регулярное выражение для извлечения [Текст]
 
 
-def get_crm_popularity():
+class PopularityStore:
+    """
+    SQLite-хранилище: для каждого заказа - дата создания и набор композиций из него.
+    Популярность считается запросом к хранилищу, а из CRM догружаются только новые заказы.
     """
-    Получает список заказов из RetailCRM за последние 2 месяца со способом 'komus'
-    и рассчитывает популярность каждой композиции.
 
-    Возвращает: dict, где ключ - название композиции, значение - количество заказов.
+    def __init__(self, path=CRM_STORE_PATH):
+        self.path = path
+        with self._connect() as conn:
+            conn.executescript("""
+                CREATE TABLE IF NOT EXISTS orders (
+                    id TEXT PRIMARY KEY,
+                    created_at TEXT NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS order_compositions (
+                    order_id TEXT NOT NULL REFERENCES orders(id) ON DELETE CASCADE,
+                    name TEXT NOT NULL,
+                    PRIMARY KEY (order_id, name)
+                );
+                CREATE INDEX IF NOT EXISTS orders_created_at ON orders(created_at);
+                CREATE TABLE IF NOT EXISTS meta (
+                    key TEXT PRIMARY KEY,
+                    value TEXT
+                );
+            """)
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path)
+        conn.execute("PRAGMA foreign_keys = ON")
+        return conn
+
+    def get_watermark(self):
+        """Время (YYYY-MM-DD HH:MM:SS) начала последней успешной синхронизации или None."""
+        with self._connect() as conn:
+            row = conn.execute("SELECT value FROM meta WHERE key = 'watermark'").fetchone()
+        return row[0] if row else None
+
+    def set_watermark(self, value):
+        with self._connect() as conn:
+            conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('watermark', ?)", (value,))
+
+    def upsert_orders(self, orders):
+        """Сохраняет заказы: orders - список (id, created_at, набор композиций)."""
+        with self._connect() as conn:
+            conn.executemany("INSERT OR REPLACE INTO orders (id, created_at) VALUES (?, ?)",
+                             [(order_id, created_at) for order_id, created_at, _ in orders])
+            conn.executemany("DELETE FROM order_compositions WHERE order_id = ?",
+                             [(order_id,) for order_id, _, _ in orders])
+            conn.executemany("INSERT INTO order_compositions (order_id, name) VALUES (?, ?)",
+                             [(order_id, name) for order_id, _, names in orders for name in names])
+
+    def prune(self, date_from):
+        """Удаляет заказы, созданные раньше date_from."""
+        with self._connect() as conn:
+            deleted = conn.execute("DELETE FROM orders WHERE created_at < ?", (date_from,)).rowcount
+        if deleted:
+            logging.info(f"Из хранилища CRM удалено устаревших заказов: {deleted}")
+
+    def popularity(self, date_from):
+        """dict: название композиции -> количество заказов, созданных начиная с date_from."""
+        with self._connect() as conn:
+            rows = conn.execute("""
+                SELECT oc.name, COUNT(*)
+                FROM order_compositions oc JOIN orders o ON o.id = oc.order_id
+                WHERE o.created_at >= ?
+                GROUP BY oc.name
+            """, (date_from,)).fetchall()
+        return dict(rows)
+
+
+def extract_compositions(order):
+    """Возвращает набор названий композиций ([...] в свойстве SET_NAME) из позиций заказа."""
+    unique_sets_in_order = set()
+
+    for item in order.get('items', []):
+        properties = item.get('properties')
+        set_name_value = ''
+
+        # --- ИСПРАВЛЕННАЯ ЛОГИКА ДЛЯ ОБРАБОТКИ СПИСКА ИЛИ СЛОВАРЯ ---
+        if isinstance(properties, list):
+            # Если properties - это список объектов (как предполагается из ошибки)
+            for prop in properties:
+                if prop.get('code') == 'SET_NAME':
+                    set_name_value = prop.get('value', '')
+                    break
+        elif isinstance(properties, dict):
+            # Если properties - это словарь, где ключи - коды свойств (изначальная логика)
+            set_name_value = properties.get('SET_NAME', {}).get('value', '')
+        # --- КОНЕЦ ИСПРАВЛЕННОЙ ЛОГИКИ ---
+
+        if set_name_value:
+            # Извлекаем текст внутри квадратных скобок [...]
+            match = SET_NAME_PATTERN.search(set_name_value)
+            if match:
+                # Добавляем композицию в набор (уникальность на заказ)
+                unique_sets_in_order.add(match.group(1).strip())
+
+    return unique_sets_in_order
+
+
+async def parse_orders_page(response):
     """
-    if not CRM_API_URL or not CRM_API_KEY:
-        logging.error("Ошибка: Не найдены переменные окружения RETAILCRM_BASE_URL или RETAILCRM_API_KEY.")
-        return {}
+    Разбирает страницу списка заказов в {'success', 'errorMsg', 'pagination', 'orders'}, где orders -
+    список (id, createdAt, набор композиций). Из заказа берутся только id, createdAt и SET_NAME позиций,
+    остальное (клиент, доставка, прочие свойства) не попадает в память.
+    С ijson тело читается потоком по мере поступления, без него - целиком через json.
+    """
+    if ijson is None:
+        data = await response.json(content_type=None)
+        data['orders'] = [(order.get('id'), order.get('createdAt'), extract_compositions(order))
+                          for order in data.get('orders') or []]
+        return data
 
-    logging.info("Начало запроса популярности из RetailCRM.")
+    page = {'success': False, 'pagination': {}, 'orders': []}
+    order_id = created_at = set_name = prop_code = prop_value = None
+    names = set()
+    async for prefix, event, value in ijson.parse_async(response.content):
+        if prefix == 'orders.item.items.item.properties.item.code':
+            prop_code = value
+        elif prefix == 'orders.item.items.item.properties.item.value':
+            prop_value = value
+        elif prefix == 'orders.item.items.item.properties.item' and event == 'end_map':
+            # Как в extract_compositions: берётся первое свойство SET_NAME позиции
+            if prop_code == 'SET_NAME' and set_name is None:
+                set_name = prop_value or ''
+            prop_code = prop_value = None
+        elif prefix == 'orders.item.items.item.properties.SET_NAME.value':
+            set_name = value
+        elif prefix == 'orders.item.items.item' and event == 'end_map':
+            match = SET_NAME_PATTERN.search(set_name) if isinstance(set_name, str) else None
+            if match:
+                names.add(match.group(1).strip())
+            set_name = None
+        elif prefix == 'orders.item.id':
+            order_id = value
+        elif prefix == 'orders.item.createdAt':
+            created_at = value
+        elif prefix == 'orders.item' and event == 'end_map':
+            page['orders'].append((order_id, created_at, names))
+            order_id = created_at = None
+            names = set()
+        elif prefix in ('success', 'errorMsg'):
+            page[prefix] = value
+        elif prefix == 'pagination.totalPageCount':
+            page['pagination']['totalPageCount'] = int(value)
+    return page
 
-    # Расчет даты 2 месяца назад для фильтрации
-    date_from = (datetime.now() - timedelta(days=60)).strftime('%Y-%m-%d')
 
-    # Базовый URL для API
-    base_url = f"{CRM_API_URL}/api/{CRM_API_VERSION}/orders"
+async def _fetch_page(client, filters, page):
+    data = await client.list_orders(filters, page, CRM_PAGE_LIMIT, parse=parse_orders_page)
+    metrics.inc('crm_pages_fetched_total')
+    return data
 
-    # Параметры фильтра
-    params = {
-        'apiKey': CRM_API_KEY,
-        'filter[orderMethods][]': 'komus',  # Способ оформления Комус
-        'filter[createdAtFrom]': date_from,  # За последние 2 месяца
-        'limit': 100,  # Максимальный лимит для постранички
-        'page': 1
+
+async def sync_orders(store, date_from, order_method=CRM_ORDER_METHOD, client=None):
+    """
+    Загружает заказы со способом order_method, созданные начиная с date_from, в хранилище store.
+    Первая страница сообщает totalPageCount, остальные загружаются параллельно
+    (не более CRM_CONCURRENCY одновременно; частоту запросов и повторы ограничивает клиент).
+    Каждая страница сразу записывается в хранилище и отбрасывается, поэтому память не растёт
+    с количеством страниц. Возвращает количество загруженных заказов.
+    """
+    client = client or crm_client
+    filters = {
+        'orderMethods': [order_method],  # Способ оформления (по умолчанию Комус)
+        'createdAtFrom': date_from,
     }
+    semaphore = asyncio.Semaphore(CRM_CONCURRENCY)
+    default_created_at = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
 
-    all_orders = []
-    total_pages = 1
-    set_name_pattern = re.compile(r'\[(.*?)\]')  # Регулярное выражение для извлечения [Текст]
+    async def save(orders):
+        # SQLite - блокирующие вызовы, поэтому запись идёт в потоке, а не в event loop
+        await asyncio.to_thread(store.upsert_orders, [(str(order_id), created_at or default_created_at, names)
+                                                      for order_id, created_at, names in orders])
+        return len(orders)
 
-    try:
-        # Цикл для обхода постраничной разбивки
-        while params['page'] <= total_pages:
-            response = requests.get(base_url, params=params)
-            response.raise_for_status()  # Вызывает исключение для HTTP ошибок
-            data = response.json()
+    first_page = await _fetch_page(client, filters, 1)
+    total_pages = first_page.get('pagination', {}).get('totalPageCount', 1)
+    loaded = await save(first_page['orders'])
+    logging.info(f"Загружена страница 1 из {total_pages}. Заказов: {loaded}")
+    del first_page
 
-            if not data.get('success'):
-                logging.error(f"Ошибка в ответе CRM: {data.get('errorMsg', 'Неизвестная ошибка')}")
-                return {}
+    async def fetch_limited(page):
+        async with semaphore:
+            count = await save((await _fetch_page(client, filters, page))['orders'])
+        logging.info(f"Загружена страница {page} из {total_pages}. Заказов: {count}")
+        return count
 
-            if 'pagination' in data:
-                total_pages = data['pagination']['totalPageCount']
+    loaded += sum(await asyncio.gather(*(fetch_limited(page) for page in range(2, total_pages + 1))))
+    return loaded
 
-            all_orders.extend(data.get('orders', []))
 
-            logging.info(
-                f"Загружена страница {params['page']} из {total_pages}. Заказов: {len(data.get('orders', []))}")
-            params['page'] += 1
+async def fetch_crm_popularity(store=None, order_method=CRM_ORDER_METHOD, client=None):
+    """
+    Синхронизирует локальное хранилище с RetailCRM и возвращает популярность композиций
+    за последние CRM_POPULARITY_DAYS дней. Из CRM загружаются только заказы, созданные
+    после прошлой синхронизации (с запасом CRM_SYNC_OVERLAP_DAYS).
 
-    except requests.exceptions.RequestException as err:
+    Возвращает: dict популярности или None, если CRM недоступна.
+    """
+    client = client or crm_client
+    if not client.configured:
+        logging.error("Ошибка: Не найдены переменные окружения RETAILCRM_BASE_URL или RETAILCRM_API_KEY.")
+        return None
+
+    store = store or await asyncio.to_thread(PopularityStore)
+    sync_started = datetime.now()
+    window_from = (sync_started - timedelta(days=CRM_POPULARITY_DAYS)).strftime('%Y-%m-%d')
+    date_from = window_from
+    watermark = await asyncio.to_thread(store.get_watermark)
+    if watermark:
+        overlap_from = datetime.strptime(watermark, '%Y-%m-%d %H:%M:%S') - timedelta(days=CRM_SYNC_OVERLAP_DAYS)
+        date_from = max(window_from, overlap_from.strftime('%Y-%m-%d'))
+
+    logging.info(f"Начало синхронизации заказов RetailCRM с {date_from}.")
+    try:
+        with metrics.span('get_crm_popularity') as span:
+            loaded = await sync_orders(store, date_from, order_method, client)
+            span.add('crm_orders', loaded)
+    except (aiohttp.ClientError, asyncio.TimeoutError) as err:
         logging.error(f"Ошибка при запросе к CRM: {err}")
-        return {}
+        return None
+    except CrmError as e:
+        logging.error(str(e))
+        return None
     except Exception as e:
         logging.error(f"Непредвиденная ошибка при работе с CRM: {e}", exc_info=True)
-        return {}
-
-    logging.info(f"Всего загружено {len(all_orders)} заказов. Начинаю расчет популярности.")
-
-    popularity_map = {}
-
-    for order in all_orders:
-        unique_sets_in_order = set()
-
-        for item in order.get('items', []):
-            properties = item.get('properties')
-            set_name_value = ''
-
-            # --- ИСПРАВЛЕННАЯ ЛОГИКА ДЛЯ ОБРАБОТКИ СПИСКА ИЛИ СЛОВАРЯ ---
-            if isinstance(properties, list):
-                # Если properties - это список объектов (как предполагается из ошибки)
-                for prop in properties:
-                    if prop.get('code') == 'SET_NAME':
-                        set_name_value = prop.get('value', '')
-                        break
-            elif isinstance(properties, dict):
-                # Если properties - это словарь, где ключи - коды свойств (изначальная логика)
-                set_name_value = properties.get('SET_NAME', {}).get('value', '')
-            # --- КОНЕЦ ИСПРАВЛЕННОЙ ЛОГИКИ ---
-
-            if set_name_value:
-                # Извлекаем текст внутри квадратных скобок [...]
-                match = set_name_pattern.search(set_name_value)
-                if match:
-                    composition_name = match.group(1).strip()
-                    # Добавляем композицию в набор (уникальность на заказ)
-                    unique_sets_in_order.add(composition_name)
-
-        # Обновляем счетчик популярности
-        for name in unique_sets_in_order:
-            popularity_map[name] = popularity_map.get(name, 0) + 1
-
-    logging.info(f"Расчет популярности завершен. Найдено {len(popularity_map)} уникальных композиций.")
-    return popularity_map
\ No newline at end of file
+        return None
+
+    await asyncio.to_thread(store.prune, window_from)
+    await asyncio.to_thread(store.set_watermark, sync_started.strftime('%Y-%m-%d %H:%M:%S'))
+
+    popularity_map = await asyncio.to_thread(store.popularity, window_from)
+    logging.info(f"Загружено {loaded} новых заказов. "
+                 f"Расчет популярности завершен. Найдено {len(popularity_map)} уникальных композиций.")
+    return popularity_map
+
+
+def get_crm_popularity(store_path=CRM_STORE_PATH, order_method=CRM_ORDER_METHOD):
+    """
+    Получает список заказов из RetailCRM за последние 2 месяца со способом order_method
+    и рассчитывает популярность каждой композиции.
+    Синхронная обёртка над fetch_crm_popularity для вызова из пула обработки.
+
+    Возвращает: dict, где ключ - название композиции, значение - количество заказов.
+    """
+    popularity_map = asyncio.run(_fetch_popularity_once(store_path, order_method))
+    return popularity_map if popularity_map is not None else {}
+
+
+async def _fetch_popularity_once(store_path, order_method):
+    # Каждый asyncio.run - новый event loop, поэтому у синхронного вызова своя сессия, закрываемая в конце
+    async with RetailCrmClient() as client:
+        return await fetch_crm_popularity(await asyncio.to_thread(PopularityStore, store_path), order_method, client)
@@ -0,0 +1,95 @@
+"""
+Общая часть выполнения задачи для процесса бота (main.py) и процессов-обработчиков (worker.py):
+клиент Bot API, выбор функции обработки, реестр готовых отчётов и отправка результата пользователю.
+Модуль не создаёт Dispatcher и не регистрирует обработчики сообщений, поэтому worker.py может импортировать его.
+"""
+import os
+import asyncio
+from functools import partial
+from aiogram import Bot
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.types import BufferedInputFile, InlineKeyboardMarkup, InlineKeyboardButton
+from dotenv import load_dotenv
+
+from job_registry import JobRegistry, create_backend
+from task_queue import JOB_BACKEND
+
+# --- ЗАГРУЗКА ПЕРЕМЕННЫХ ИЗ .ENV ---
+load_dotenv()
+BOT_TOKEN = os.getenv("BOT_TOKEN")
+# Свой сервер Bot API (локальный telegram-bot-api или заменитель для нагрузочного теста)
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL")
+
+# --- ИНИЦИАЛИЗАЦИЯ БОТА ---
+session = AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL)) if TELEGRAM_API_URL else None
+bot = Bot(token=BOT_TOKEN, session=session)
+# Готовые отчёты, ожидающие решения об отправке, по id задачи из callback_data.
+# С общей очередью отчёт сохраняет процесс worker.py, поэтому реестр тоже общий
+job_registry = JobRegistry(create_backend('sqlite') if JOB_BACKEND == 'sqlite' else None)
+
+
+def processing_call(inputs, profile):
+    """
+    Функция обработки и её первый аргумент: один файл или пакет файлов.
+    Остальные аргументы - словарь популярности и функция прогресса.
+    """
+    # file_processing и batch (pandas, numpy, openpyxl) импортируются только при первой обработке
+    from file_processing import process_excel_files
+    from batch import process_batch
+    if len(inputs) == 1:
+        return partial(process_excel_files, profile=profile.name), inputs[0][1]
+    # Пакет обрабатывается внутри одной задачи, поэтому отдельный пул процессов не нужен
+    return partial(process_batch, workers=1, profile=profile.name), inputs
+
+
+async def announce_job(chat_id, profile, snapshot):
+    """Сообщает пользователю профиль и возраст данных популярности. Возвращает словарь популярности."""
+    from profiles import profile_registry
+    if len(profile_registry.profiles) > 1:
+        await bot.send_message(chat_id, f"Поставщик: {profile.title}.")
+    if snapshot is not None:
+        await bot.send_message(chat_id, f"Популярность композиций: {snapshot.describe_age()}.")
+        return snapshot.data
+    await bot.send_message(chat_id, "Данные о популярности из CRM недоступны, округление без учёта популярности.")
+    return {}
+
+
+async def deliver_results(chat_id, user_id, job_id, inputs, result, profile):
+    """Отправляет результат задачи: один отчёт или по отчёту на каждый файл пакета."""
+    from file_processing import ReportResult
+    from batch import output_name
+    if len(inputs) == 1:
+        return await send_result(chat_id, user_id, job_id, result, profile)
+    for index, (source_name, batch_result) in enumerate(result, 1):
+        if isinstance(batch_result, ReportResult):
+            batch_result.file_name = output_name(batch_result, source_name)
+        else:
+            batch_result = f"{source_name}: {batch_result}"
+        await send_result(chat_id, user_id, f"{job_id}-{index}", batch_result, profile)
+
+
+async def send_result(chat_id, user_id, result_id, result, profile):
+    """Отправляет готовый отчёт с кнопками отправки на почту или сообщение об ошибке."""
+    from file_processing import ReportResult
+    if isinstance(result, ReportResult):
+        caption = "Вот ваш обработанный файл."
+        if result.from_cache:
+            caption += " Такой отчёт уже обрабатывался, файл взят из кэша."
+        await bot.send_document(chat_id, BufferedInputFile(result.content, filename=result.file_name),
+                                caption=caption)
+
+        await asyncio.to_thread(job_registry.save, result_id, user_id, result.file_name, result.content, profile.name)
+        keyboard = InlineKeyboardMarkup(inline_keyboard=[
+            [
+                InlineKeyboardButton(text="✅", callback_data=f"send_email_yes_{result_id}"),
+                InlineKeyboardButton(text="❌", callback_data=f"send_email_no_{result_id}")
+            ]
+        ])
+        await bot.send_message(
+            chat_id,
+            f"Отправить на почту {', '.join(profile.email_to)}?",
+            reply_markup=keyboard
+        )
+    else:
+        await bot.send_message(chat_id, f"Произошла ошибка при обработке файла: {result}")
@@ -1,63 +1,316 @@
 import os
+import time
+import asyncio
 import smtplib
 import logging
+import sqlite3
 from datetime import datetime
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 from email.mime.base import MIMEBase
 from email import encoders
 from email.header import Header
+from email.policy import compat32
 from dotenv import load_dotenv
 
+from metrics import metrics
+
 # --- ЗАГРУЗКА ПЕРЕМЕННЫХ ИЗ .ENV ---
 load_dotenv()
 EMAIL_PASSWORD = os.getenv("EMAIL_PASSWORD")
 EMAIL_FROM = os.getenv("EMAIL_FROM")
+# Можно указать несколько адресов через запятую
 EMAIL_TO = os.getenv("EMAIL_TO")
 
 # --- ДАННЫЕ ДЛЯ ОТПРАВКИ EMAIL ---
-SMTP_SERVER = 'smtp.mail.ru'
-SMTP_PORT = 465
+SMTP_SERVER = os.getenv("SMTP_SERVER", 'smtp.mail.ru')
+SMTP_PORT = int(os.getenv("SMTP_PORT", "465"))
+SMTP_USE_SSL = os.getenv("SMTP_USE_SSL", "1") == "1"
+SMTP_TIMEOUT = 30
 
+# --- ОЧЕРЕДЬ ОТПРАВКИ ---
+EMAIL_OUTBOX_PATH = os.getenv("EMAIL_OUTBOX_PATH", "outbox.sqlite")
+EMAIL_MAX_ATTEMPTS = int(os.getenv("EMAIL_MAX_ATTEMPTS", "5"))
+EMAIL_RETRY_DELAY = 10  # Задержка перед первой повторной попыткой, дальше удваивается
+EMAIL_BATCH_SIZE = 20  # Сколько писем отправляется за одно SMTP-соединение
+# Сколько бот ждёт результата отправки, прежде чем ответить пользователю (дальше письмо уходит в фоне)
+EMAIL_SEND_TIMEOUT = float(os.getenv("EMAIL_SEND_TIMEOUT", "120"))
+
+STATUS_PENDING = 'pending'
+STATUS_FAILED = 'failed'
+
+# --- РЕЗУЛЬТАТ ОТПРАВКИ ДЛЯ БОТА ---
+SEND_SENT = 'sent'
+SEND_QUEUED = 'queued'  # За EMAIL_SEND_TIMEOUT письмо не ушло, но попытки продолжаются
+SEND_FAILED = 'failed'
+
+# Письмо сериализуется так же, как раньше, но сразу в байты и с CRLF, как требует SMTP
+SMTP_POLICY = compat32.clone(linesep='\r\n')
 
-async def send_email_with_attachment(file_path):
-    """Отправляет файл по email."""
-    if not EMAIL_PASSWORD or not EMAIL_FROM or not EMAIL_TO:
-        logging.error("Не найдены переменные окружения для отправки email. Убедитесь, что они есть в файле .env.")
-        return False
 
+class TransientEmailError(Exception):
+    """Временная ошибка отправки: письмо остаётся в очереди для повторной попытки."""
+
+
+def parse_recipients(value):
+    return [address.strip() for address in (value or '').split(',') if address.strip()]
+
+
+def build_message(file_name, content, recipients):
+    """Собирает письмо с вложением и возвращает его в виде байтов."""
     msg = MIMEMultipart()
     msg['From'] = EMAIL_FROM
-    msg['To'] = EMAIL_TO
+    msg['To'] = ', '.join(recipients)
     msg['Subject'] = f"Отчёт по остаткам - {datetime.now().strftime('%d.%m.%Y')}"
 
     body = "Здравствуйте! Высылаю остатки.\n\nС уважением, Анна Сидорова."
     msg.attach(MIMEText(body, 'plain'))
 
+    part = MIMEBase("application", "octet-stream")
+    part.set_payload(content)
+    encoders.encode_base64(part)
+
+    part.add_header(
+        "Content-Disposition",
+        "attachment",
+        filename=Header(file_name, 'utf-8').encode()
+    )
+    msg.attach(part)
+    return msg.as_bytes(policy=SMTP_POLICY)
+
+
+class Outbox:
+    """Постоянная очередь писем в SQLite: неотправленные письма переживают перезапуск бота."""
+
+    def __init__(self, path=EMAIL_OUTBOX_PATH):
+        self.path = path
+        with sqlite3.connect(self.path) as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS outbox (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    file_name TEXT NOT NULL,
+                    recipients TEXT NOT NULL,
+                    message BLOB NOT NULL,
+                    status TEXT NOT NULL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    next_attempt REAL NOT NULL,
+                    error TEXT
+                )
+            """)
+
+    def add(self, file_name, recipients, message):
+        with sqlite3.connect(self.path) as conn:
+            cursor = conn.execute(
+                "INSERT INTO outbox (file_name, recipients, message, status, next_attempt) VALUES (?, ?, ?, ?, ?)",
+                (file_name, ','.join(recipients), message, STATUS_PENDING, time.time()))
+            return cursor.lastrowid
+
+    def due(self, limit=EMAIL_BATCH_SIZE):
+        """Письма, которые пора отправить: (id, file_name, recipients, message, attempts)."""
+        with sqlite3.connect(self.path) as conn:
+            return conn.execute(
+                "SELECT id, file_name, recipients, message, attempts FROM outbox "
+                "WHERE status = ? AND next_attempt <= ? ORDER BY id LIMIT ?",
+                (STATUS_PENDING, time.time(), limit)).fetchall()
+
+    def next_attempt_in(self):
+        """Через сколько секунд подойдёт очередь ближайшего письма (None - очередь пуста)."""
+        with sqlite3.connect(self.path) as conn:
+            row = conn.execute("SELECT MIN(next_attempt) FROM outbox WHERE status = ?", (STATUS_PENDING,)).fetchone()
+        return None if row[0] is None else max(0.0, row[0] - time.time())
+
+    def mark_sent(self, message_id):
+        """Отправленное письмо больше не нужно - удаляем его, чтобы очередь не росла."""
+        with sqlite3.connect(self.path) as conn:
+            conn.execute("DELETE FROM outbox WHERE id = ?", (message_id,))
+
+    def mark_failed(self, message_id, attempts, error):
+        with sqlite3.connect(self.path) as conn:
+            conn.execute("UPDATE outbox SET status = ?, attempts = ?, error = ? WHERE id = ?",
+                         (STATUS_FAILED, attempts, error, message_id))
+
+    def mark_retry(self, message_id, attempts, error):
+        delay = EMAIL_RETRY_DELAY * 2 ** (attempts - 1)
+        with sqlite3.connect(self.path) as conn:
+            conn.execute("UPDATE outbox SET attempts = ?, next_attempt = ?, error = ? WHERE id = ?",
+                         (attempts, time.time() + delay, error, message_id))
+        return delay
+
+
+class MailSender:
+    """
+    Фоновая отправка писем из Outbox. SMTP-операции, сборка письма и запросы к очереди выполняются
+    в отдельном потоке, все письма, накопившиеся в очереди, уходят через одно авторизованное соединение,
+    временные ошибки повторяются с экспоненциальной задержкой.
+    """
+
+    def __init__(self, outbox=None):
+        self.outbox = outbox
+        self._task = None
+        self._wakeup = None
+        self._waiters = {}
+        # Результаты пачки не применяются, пока send ставит письмо и регистрирует ожидание по его id
+        self._lock = None
+
+    def start(self):
+        if self._task is None:
+            self.outbox = self.outbox or Outbox()
+            self._wakeup = asyncio.Event()
+            self._lock = asyncio.Lock()
+            self._task = asyncio.create_task(self._run())
+            logging.info("Фоновая отправка почты запущена.")
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def send(self, file_name, content, recipients=None, timeout=EMAIL_SEND_TIMEOUT):
+        """
+        Ставит письмо в очередь и ждёт результата отправки.
+        Возвращает SEND_SENT, SEND_FAILED при окончательной ошибке или SEND_QUEUED, если за timeout
+        письмо не ушло: отправка продолжится в фоне.
+        """
+        self.start()
+        recipients = recipients or parse_recipients(EMAIL_TO)
+        message = await asyncio.to_thread(build_message, file_name, content, recipients)
+        async with self._lock:
+            message_id = await asyncio.to_thread(self.outbox.add, file_name, recipients, message)
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters[message_id] = waiter
+        self._wakeup.set()
+        logging.info(f"Письмо {message_id} с файлом {file_name} поставлено в очередь для {', '.join(recipients)}")
+        try:
+            return SEND_SENT if await asyncio.wait_for(asyncio.shield(waiter), timeout) else SEND_FAILED
+        except asyncio.TimeoutError:
+            logging.warning(f"Письмо {message_id} пока не отправлено, попытки продолжатся в фоне.")
+            return SEND_QUEUED
+
+    async def _run(self):
+        while True:
+            try:
+                batch = await asyncio.to_thread(self.outbox.due)
+                if batch:
+                    results = await asyncio.to_thread(self._deliver_batch, batch)
+                    async with self._lock:
+                        finished = await asyncio.to_thread(self._apply_results, batch, results)
+                        for message_id, sent in finished.items():
+                            self._resolve(message_id, sent)
+                    continue
+                delay = await asyncio.to_thread(self.outbox.next_attempt_in)
+            except Exception as e:
+                logging.error(f"Ошибка фоновой отправки почты: {e}", exc_info=True)
+                delay = EMAIL_RETRY_DELAY
+
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+
+    def _deliver_batch(self, batch):
+        """
+        Отправляет пачку писем через одно соединение (выполняется в потоке).
+        Возвращает dict: id письма -> None (отправлено) или исключение.
+        """
+        results = {}
+        try:
+            logging.info("Попытка установить соединение с SMTP-сервером...")
+            with self._connect() as server:
+                server.login(EMAIL_FROM, EMAIL_PASSWORD)
+                for message_id, file_name, recipients, message, _ in batch:
+                    try:
+                        server.sendmail(EMAIL_FROM, recipients.split(','), message)
+                        results[message_id] = None
+                        logging.info(f"Файл {file_name} успешно отправлен на почту {recipients}")
+                    except smtplib.SMTPServerDisconnected:
+                        # Соединение потеряно - остальные письма пачки уйдут в следующий раз
+                        raise
+                    except smtplib.SMTPResponseException as e:
+                        results[message_id] = _classify_smtp_error(e)
+                    except smtplib.SMTPRecipientsRefused as e:
+                        results[message_id] = _classify_refused(e)
+        except smtplib.SMTPAuthenticationError as e:
+            logging.error("Ошибка аутентификации SMTP. Проверьте логин/пароль приложения.")
+            error = e
+        except smtplib.SMTPResponseException as e:
+            error = _classify_smtp_error(e)
+        except (smtplib.SMTPException, OSError) as e:
+            error = TransientEmailError(str(e))
+        else:
+            return results
+
+        for message_id, *_ in batch:
+            results.setdefault(message_id, error)
+        return results
+
+    def _connect(self):
+        if SMTP_USE_SSL:
+            return smtplib.SMTP_SSL(SMTP_SERVER, SMTP_PORT, timeout=SMTP_TIMEOUT)
+        return smtplib.SMTP(SMTP_SERVER, SMTP_PORT, timeout=SMTP_TIMEOUT)
+
+    def _apply_results(self, batch, results):
+        """
+        Записывает результаты пачки в очередь (выполняется в потоке).
+        Возвращает dict: id письма -> True/False для писем, судьба которых решена.
+        """
+        finished = {}
+        for message_id, file_name, _, _, attempts in batch:
+            error = results.get(message_id)
+            attempts += 1
+            if error is None:
+                self.outbox.mark_sent(message_id)
+                finished[message_id] = True
+            elif isinstance(error, TransientEmailError) and attempts < EMAIL_MAX_ATTEMPTS:
+                delay = self.outbox.mark_retry(message_id, attempts, str(error))
+                logging.warning(f"Не удалось отправить письмо {message_id} ({error}), повтор через {delay} с.")
+            else:
+                self.outbox.mark_failed(message_id, attempts, str(error))
+                logging.error(f"Не удалось отправить email с файлом {file_name}: {error}")
+                finished[message_id] = False
+        return finished
+
+    def _resolve(self, message_id, sent):
+        waiter = self._waiters.pop(message_id, None)
+        if waiter is not None and not waiter.done():
+            waiter.set_result(sent)
+
+
+def _classify_smtp_error(error):
+    """Коды 4xx - временные ошибки сервера, их имеет смысл повторить."""
+    if 400 <= error.smtp_code < 500:
+        return TransientEmailError(f"{error.smtp_code} {error.smtp_error!r}")
+    return error
+
+
+def _classify_refused(error):
+    """Сервер отклонил всех получателей: повторять имеет смысл, только если все отказы временные (4xx)."""
+    codes = [code for code, _ in error.recipients.values()]
+    if codes and all(400 <= code < 500 for code in codes):
+        return TransientEmailError(f"получатели временно отклонены: {error.recipients!r}")
+    return error
+
+
+# Общий отправитель процесса
+mail_sender = MailSender()
+
+
+async def send_email_with_attachment(file_name, content, recipients=None):
+    """
+    Отправляет файл по email через фоновую очередь, не блокируя event loop.
+    content - содержимое вложения в байтах, recipients - список адресов (по умолчанию EMAIL_TO).
+    Возвращает SEND_SENT, SEND_QUEUED (письмо ещё в очереди) или SEND_FAILED.
+    """
+    if not EMAIL_PASSWORD or not EMAIL_FROM or not EMAIL_TO:
+        logging.error("Не найдены переменные окружения для отправки email. Убедитесь, что они есть в файле .env.")
+        return SEND_FAILED
+
     try:
-        with open(file_path, "rb") as attachment:
-            part = MIMEBase("application", "octet-stream")
-            part.set_payload(attachment.read())
-        encoders.encode_base64(part)
-
-        file_name = os.path.basename(file_path)
-        part.add_header(
-            "Content-Disposition",
-            "attachment",
-            filename=Header(file_name, 'utf-8').encode()
-        )
-        msg.attach(part)
-
-        logging.info("Попытка установить соединение с SMTP-сервером...")
-        with smtplib.SMTP_SSL(SMTP_SERVER, SMTP_PORT) as server:
-            server.login(EMAIL_FROM, EMAIL_PASSWORD)
-            server.sendmail(EMAIL_FROM, EMAIL_TO, msg.as_string())
-        logging.info(f"Файл {os.path.basename(file_path)} успешно отправлен на почту {EMAIL_TO}")
-        return True
-
-    except smtplib.SMTPAuthenticationError:
-        logging.error("Ошибка аутентификации SMTP. Проверьте логин/пароль приложения.")
-        return False
+        with metrics.span('send_email_with_attachment') as span:
+            result = await mail_sender.send(file_name, content, recipients)
+            span.add(f'emails_{result}')
+        return result
     except Exception as e:
         logging.error(f"Не удалось отправить email: {e}", exc_info=True)
-        return False
+        return SEND_FAILED
@@ -1,185 +1,445 @@
 import os
-import shutil
 import pandas as pd
 import logging
+import threading
 import numpy as np
-import math
+from io import BytesIO
 from datetime import datetime
+from openpyxl import load_workbook
+from openpyxl.utils.cell import range_boundaries
+from pandas.io.parsers import TextParser
 
 # --- ИМПОРТ ИЗ НОВОГО МОДУЛЯ ---
 from crm_connector import get_crm_popularity
+from reference_cache import COL_INDEX_COMPOSITION_KEY, COL_INDEX_CRM_NAME, COL_INDEX_PLANT_NAME
+from report_writer import render_report
+from result_cache import result_cache, report_cache_key
+from history_archive import history_archive
+from profiles import profile_registry, REPORT_RANGE
+from metrics import metrics
 
 # --- КОНСТАНТЫ ---
-FILE_OST_KOMUS = 'Остатки_Комус.xlsx'
-FILE_OST_LESKOVSKY = 'Остатки ИП Лесковский.xlsx'
-TEMP_FOLDER = "temp_files"
-
-REPORT_RANGE = 'D13:F83'
-REPORT_COPY_RANGE = 'F13:F74'
-KOMUS_LIST_1 = 'счет остатков new (копия)'
-KOMUS_COLUMNS_1 = [0, 1, 2]
-KOMUS_LIST_2 = 'Состав композиций (копия)'
-# Загружаем колонки: [2] Состав композиции (для calculate_formulas), [4] Название в СРМ, [5] Название растений
-KOMUS_COLUMNS_FOR_ROUNDING = [2, 4, 5]
-COL_INDEX_COMPOSITION_KEY = 0  # Индекс 0 в новом фрейме komus_df_2_all (Состав композиции)
-COL_INDEX_CRM_NAME = 1  # Индекс 1 в новом фрейме komus_df_2_all (Название в СРМ)
-COL_INDEX_PLANT_NAME = 2  # Индекс 2 в новом фрейме komus_df_2_all (Название растений)
-LESKOVSKY_SHEET = 'Лист1'
-
-
-def calculate_formulas(komus_sheet1_df, komus_sheet2_df):
-    """
-    Вычисляет значения для столбца D, имитируя формулы Excel.
-    Использует колонку "Состав композиции", которая теперь имеет индекс 0 в komus_sheet2_df.
-    """
-    results = []
-    # komus_sheet1_df.iloc[:, 1] - Артикул, komus_sheet1_df.iloc[:, 2] - Остаток (VPR)
-    vlookup_dict = dict(zip(komus_sheet1_df.iloc[:, 1], komus_sheet1_df.iloc[:, 2]))
 
-    # Колонка с ключом - это индекс 0 в komus_sheet2_df, т.е. исходный столбец 2
-    countif_dict = komus_sheet2_df.iloc[:, COL_INDEX_COMPOSITION_KEY].value_counts().to_dict()
+# Папка для построчной расшифровки calculate_formulas (режим отладки, по умолчанию выключен)
+FORMULAS_AUDIT_DIR = os.getenv("FORMULAS_AUDIT_DIR")
+# Папка для отчётов об изменениях округления относительно предыдущего запуска (по умолчанию выключено)
+ROUNDING_DELTA_DIR = os.getenv("ROUNDING_DELTA_DIR")
 
-    logging.info("Начало расчёта формул.")
 
-    for i, item in enumerate(komus_sheet2_df.iloc[:, COL_INDEX_COMPOSITION_KEY]):
-        vlookup_result = vlookup_dict.get(item)
-        countif_result = countif_dict.get(item)
+def calculate_formulas(komus_sheet1_df, komus_sheet2_df, countif_dict=None, audit_path=None, index=None):
+    """
+    Вычисляет значения для столбца D, имитируя формулы Excel: ВПР(артикул) / СЧЁТЕСЛИ(артикул).
+    Использует колонку "Состав композиции", которая теперь имеет индекс 0 в komus_sheet2_df.
+    countif_dict можно передать готовым из кэша справочника.
+    index - ReferenceIndex того же справочника: ВПР и СЧЁТЕСЛИ берутся по готовым кодам строк.
+    audit_path - если указан, построчная расшифровка расчёта сохраняется в CSV.
 
-        # Обработка NaN/None в VPR
-        if vlookup_result is None or pd.isna(vlookup_result):
-            vlookup_result = 0
+    Возвращает: numpy-массив значений в порядке строк komus_sheet2_df.
+    """
+    logging.info("Начало расчёта формул.")
+    items = komus_sheet2_df.iloc[:, COL_INDEX_COMPOSITION_KEY].reset_index(drop=True)
+    if index is not None:
+        vlookup_result, countif_result = _lookup_by_index(komus_sheet1_df, index)
+    else:
+        vlookup_result, countif_result = _lookup_by_key(komus_sheet1_df, items, countif_dict)
 
-        logging.info(f"Строка {i + 2}: Артикул: '{item}', ВПР: {vlookup_result}, СЧЁТЕСЛИ: {countif_result}")
+    # Деление только там, где СЧЁТЕСЛИ > 0, иначе результат 0
+    results = np.zeros(len(items), dtype=float)
+    np.divide(vlookup_result, countif_result, out=results, where=countif_result > 0)
 
-        if countif_result is None or countif_result == 0:
-            results.append(0)
-            logging.info(f"   --> Результат: 0 (ошибка или нулевое значение)")
-        else:
-            result = vlookup_result / countif_result
-            results.append(result)
-            logging.info(f"   --> Результат: {result}")
+    if audit_path:
+        _write_formulas_audit(audit_path, items, vlookup_result, countif_result, results)
 
+    logging.info(f"Расчёт формул завершён. Строк: {len(results)}")
     return results
 
 
-def apply_rounding_logic(df_data, calculated_data, popularity_map):
+def _lookup_by_key(komus_sheet1_df, items, countif_dict):
+    """ВПР и СЧЁТЕСЛИ по значениям артикулов (без индекса справочника)."""
+    # komus_sheet1_df.iloc[:, 1] - Артикул, komus_sheet1_df.iloc[:, 2] - Остаток (VPR)
+    # Остатки в колонке 2 приходят из отчёта, поэтому справочник ВПР строится на каждый запуск.
+    # Как и в dict(zip(...)), при повторе артикула побеждает последнее значение, а NaN-артикулы не находятся.
+    vlookup = pd.Series(komus_sheet1_df.iloc[:, 2].to_numpy(), index=komus_sheet1_df.iloc[:, 1].to_numpy())
+    vlookup = vlookup[vlookup.index.notna() & ~vlookup.index.duplicated(keep='last')]
+
+    # Колонка с ключом - это индекс 0 в komus_sheet2_df, т.е. исходный столбец 2
+    if countif_dict is None:
+        countif_dict = items.value_counts().to_dict()
+
+    # Обработка NaN/None в VPR: не найденный артикул или пустой остаток считаются нулём
+    vlookup_result = items.map(vlookup).astype(float).fillna(0).to_numpy()
+    countif_result = items.map(countif_dict).astype(float).fillna(0).to_numpy()
+    return vlookup_result, countif_result
+
+
+def _lookup_by_index(komus_sheet1_df, index):
+    """ВПР и СЧЁТЕСЛИ по индексу: остаток берётся из заранее найденной строки листа остатков."""
+    stock = komus_sheet1_df.iloc[:, 2].to_numpy()
+    found = index.item_rows >= 0
+    vlookup_result = np.zeros(len(index.item_rows), dtype=float)
+    vlookup_result[found] = pd.Series(stock[index.item_rows[found]]).astype(float).fillna(0).to_numpy()
+    return vlookup_result, index.item_counts
+
+
+def _write_formulas_audit(audit_path, items, vlookup_result, countif_result, results):
+    """Сохраняет построчную расшифровку calculate_formulas (бывший построчный лог) в CSV."""
+    audit_df = pd.DataFrame({
+        'Строка': np.arange(len(items)) + 2,
+        'Артикул': items.to_numpy(),
+        'ВПР': vlookup_result,
+        'СЧЁТЕСЛИ': countif_result,
+        'Результат': results,
+    })
+    audit_df.to_csv(audit_path, index=False, encoding='utf-8-sig')
+    logging.info(f"Расшифровка расчёта формул сохранена: {audit_path}")
+
+
+def apply_rounding_logic(df_data, calculated_data, popularity_map, index=None):
     """
     Применяет сложную логику округления: группировка по растению,
     суммирование дробных частей, распределение целого бонуса по популярности.
+    index - ReferenceIndex справочника df_data: группы и популярность берутся по готовым кодам.
+
+    Все шаги выполняются над numpy-массивами: округление вниз, суммы дробных частей по группам,
+    сортировка внутри групп (популярность, затем значение - по убыванию) и раздача +1
+    первым композициям группы по рангу.
     """
     logging.info("Начало применения сложной логики округления.")
+    values, popularity, plant_codes = _rounding_inputs(df_data, calculated_data, popularity_map, index)
+    return pd.Series(_allocate(values, popularity, plant_codes), dtype=float)
 
-    # 1. Создаем рабочий DataFrame
-    df = df_data.copy()
-    df['Calculated_Value'] = calculated_data
-    df['Final_Value'] = 0.0
 
-    # Обнуляем отрицательные значения и фильтруем, оставляя только те, где остаток > 0
-    df['Calculated_Value'] = df['Calculated_Value'].apply(lambda x: max(0, x))
-    df_positive = df[df['Calculated_Value'] > 0].copy()
+def _rounding_inputs(df_data, calculated_data, popularity_map, index=None):
+    """
+    Входные данные округления по строкам df_data: остаток (отрицательные и NaN обнулены),
+    популярность (0, если нет в CRM) и код группы по Названию растений (-1 - растение не указано).
+    """
+    values = np.asarray(calculated_data, dtype=float)
+    values = np.where(values > 0, values, 0.0)
+    if index is not None:
+        return values, index.popularity(popularity_map), index.plant_codes
+    plant_codes, _ = pd.factorize(df_data.iloc[:, COL_INDEX_PLANT_NAME])
+    popularity = df_data.iloc[:, COL_INDEX_CRM_NAME].map(popularity_map).fillna(0).to_numpy(dtype=float)
+    return values, popularity, plant_codes
 
-    if df_positive.empty:
-        # Возвращаем серию нулей, сохраняя длину и порядок исходных данных
-        return pd.Series(np.zeros(len(calculated_data)), dtype=float)
 
-        # 2. Добавляем популярность (0, если нет в CRM)
-    df_positive['Popularity'] = df_positive.iloc[:, COL_INDEX_CRM_NAME].apply(lambda x: popularity_map.get(x, 0))
+def _allocate(values, popularity, plant_codes):
+    """
+    Округление с распределением бонуса. Группы независимы друг от друга, поэтому функцию можно
+    вызывать и для части строк - достаточно передать все строки затронутых групп в исходном порядке.
+    """
+    result = np.zeros(len(values), dtype=float)
 
-    # 3. Группируем по Названию растений
-    grouped = df_positive.groupby(df_positive.columns[COL_INDEX_PLANT_NAME])
+    # 1. Только композиции с остатком > 0 и с названием растения, остальные остаются нулевыми
+    positions = np.flatnonzero((values > 0) & (plant_codes >= 0))
+    if positions.size == 0:
+        return result
 
-    # 4. Обработка каждой группы
-    for plant_name, group in grouped:
+    # 2. Перенумеровываем группы подряд для выбранных строк
+    plant_codes = np.unique(plant_codes[positions], return_inverse=True)[1]
+    popularity = popularity[positions]
 
-        # a. Расчет бонуса
-        # Получаем дробные части: X.YY -> 0.YY
-        fractional_parts = group['Calculated_Value'].apply(lambda x: x - math.floor(x))
-        total_fraction = fractional_parts.sum()
-        # Округляем сумму вниз для получения целого бонуса
-        integer_bonus = math.floor(total_fraction)
+    group_values = values[positions]
+    floor_values = np.floor(group_values)
+    # Получаем дробные части: X.YY -> 0.YY
+    fractional_parts = group_values - floor_values
 
-        logging.info(
-            f"Группа '{plant_name}': Композиций: {len(group)}, Сумма дробных частей: {total_fraction:.2f}, Бонус: {integer_bonus}")
+    # 3. Бонус группы - сумма дробных частей, округлённая вниз
+    integer_bonus = np.floor(_group_sums(fractional_parts, plant_codes))
 
-        # b. Сортировка по популярности (убывание)
-        # Внутри группы сортируем по популярности, при равной популярности - по исходному значению (для тай-брейка)
-        group_sorted = group.sort_values(by=['Popularity', 'Calculated_Value'], ascending=[False, False]).copy()
+    # 4. Сортировка внутри группы по популярности и значению (по убыванию), при равенстве - исходный порядок
+    order = np.lexsort((-group_values, -popularity, plant_codes))
+    sorted_codes = plant_codes[order]
+    group_starts = np.r_[0, np.cumsum(np.bincount(plant_codes))[:-1]]
+    rank_in_group = np.arange(order.size) - group_starts[sorted_codes]
 
-        # c. Распределение бонуса
-        for index, row in group_sorted.iterrows():
-            floor_value = math.floor(row['Calculated_Value'])
-            bonus = 0
+    # 5. Целая часть + бонус: +1 получают первые integer_bonus композиций группы
+    bonus = (rank_in_group < integer_bonus[sorted_codes]).astype(float)
+    result[positions[order]] = floor_values[order] + bonus
 
-            if integer_bonus > 0:
-                # Если бонус есть, даем +1 самой популярной/крупной композиции
-                bonus = 1
-                integer_bonus -= 1
+    logging.info(
+        f"Округление завершено. Групп: {len(group_starts)}, композиций: {positions.size}, "
+        f"раздано бонусов: {int(bonus.sum())}")
+    return result
 
-            # d. Определение финального значения (целая часть + бонус)
-            group_sorted.loc[index, 'Final_Value'] = floor_value + bonus
 
-        # e. Обновление основного DataFrame с округленными значениями
-        df_positive.loc[group_sorted.index, 'Final_Value'] = group_sorted['Final_Value']
+def _group_sums(values, codes):
+    """
+    Суммы values по группам codes в исходном порядке строк.
+    Группы одного размера суммируются построчно в матрице, что даёт тот же результат,
+    что и Series.sum() для каждой группы отдельно (попарное суммирование numpy).
+    """
+    sizes = np.bincount(codes)
+    starts = np.r_[0, np.cumsum(sizes)[:-1]]
+    values_by_group = values[np.argsort(codes, kind='stable')]
+
+    sums = np.zeros(sizes.size, dtype=float)
+    for size in np.unique(sizes):
+        groups = np.flatnonzero(sizes == size)
+        matrix = values_by_group[starts[groups][:, None] + np.arange(size)]
+        sums[groups] = matrix.sum(axis=1)
+    return sums
 
-    # 5. Форматирование результата в серию, соответствующую длине и порядку исходных данных
-    # Создаем серию нулей, соответствующую длине и порядку исходных данных (df_data)
-    result_series = pd.Series(np.zeros(len(calculated_data)), dtype=float)
 
-    # Обновляем значениями только те индексы, которые были обработаны (где > 0)
-    for original_index in df_positive.index:
-        result_series.loc[original_index] = df_positive.loc[original_index, 'Final_Value']
+class RoundingState:
+    """Входы и результат последнего округления по строкам справочника с хэшем digest."""
 
-    logging.info("Округление завершено.")
-    return result_series
+    def __init__(self, digest, values, popularity, result):
+        self.digest = digest
+        self.values = values
+        self.popularity = popularity
+        self.result = result
 
 
-def process_excel_files(input_file_path):
+class IncrementalRounding:
+    """
+    Округление с пересчётом только изменившихся групп. Хранит остатки, популярность и результат
+    предыдущего запуска; группа растения пересчитывается, если у любой её композиции изменился
+    остаток или популярность, остальные группы берут результат прошлого запуска без изменений.
+    """
+
+    def __init__(self):
+        self._state = None
+        self._lock = threading.Lock()
+
+    def apply(self, df_data, calculated_data, popularity_map, index, delta_path=None):
+        """
+        То же, что apply_rounding_logic с индексом справочника.
+        Возвращает (Series результата, DataFrame изменений или None для первого запуска).
+        delta_path - если указан, изменения сохраняются в CSV.
+        """
+        logging.info("Начало применения сложной логики округления.")
+        values, popularity, plant_codes = _rounding_inputs(df_data, calculated_data, popularity_map, index)
+        with self._lock:
+            previous = self._state
+
+        if previous is None or previous.digest != index.digest:
+            result = _allocate(values, popularity, plant_codes)
+            delta = None
+        else:
+            changed = (values != previous.values) | (popularity != previous.popularity)
+            changed_groups = np.unique(plant_codes[changed & (plant_codes >= 0)])
+            rows = np.isin(plant_codes, changed_groups)
+            result = previous.result.copy()
+            if rows.any():
+                result[rows] = _allocate(values[rows], popularity[rows], plant_codes[rows])
+            delta = _rounding_delta(df_data, previous, values, popularity, result)
+            logging.info(
+                f"Инкрементальное округление: пересчитано групп {changed_groups.size}, строк {int(rows.sum())}, "
+                f"изменилось результатов {len(delta)}")
+            if delta_path:
+                delta.to_csv(delta_path, index=False, encoding='utf-8-sig')
+                logging.info(f"Изменения округления сохранены: {delta_path}")
+
+        with self._lock:
+            self._state = RoundingState(index.digest, values, popularity, result)
+        return pd.Series(result.copy(), dtype=float), delta
+
+
+def _rounding_delta(df_data, previous, values, popularity, result):
+    """Композиции, у которых изменился результат округления, и причина изменения."""
+    rows = np.flatnonzero(result != previous.result)
+    value_changed = values[rows] != previous.values[rows]
+    popularity_changed = popularity[rows] != previous.popularity[rows]
+    reasons = np.where(value_changed, 'остаток', np.where(popularity_changed, 'популярность',
+                                                          'перераспределение бонуса в группе'))
+    return pd.DataFrame({
+        'Строка': rows + 2,
+        'Состав композиции': df_data.iloc[rows, COL_INDEX_COMPOSITION_KEY].to_numpy(),
+        'Название в СРМ': df_data.iloc[rows, COL_INDEX_CRM_NAME].to_numpy(),
+        'Название растений': df_data.iloc[rows, COL_INDEX_PLANT_NAME].to_numpy(),
+        'Остаток было': previous.values[rows],
+        'Остаток стало': values[rows],
+        'Популярность было': previous.popularity[rows],
+        'Популярность стало': popularity[rows],
+        'Результат было': previous.result[rows],
+        'Результат стало': result[rows],
+        'Причина': reasons,
+    })
+
+
+# Состояние округления по профилям: каждый запуск пересчитывает только группы, изменившиеся с прошлого
+_incremental_rounding = {}
+_incremental_rounding_lock = threading.Lock()
+
+
+def incremental_rounding_for(profile):
+    with _incremental_rounding_lock:
+        return _incremental_rounding.setdefault(profile.name, IncrementalRounding())
+
+
+class ReportResult:
+    """Готовый отчёт: имя файла для пользователя и содержимое xlsx в памяти."""
+
+    def __init__(self, file_name, content, from_cache=False):
+        self.file_name = file_name
+        self.content = content
+        # True, если отчёт взят из кэша результатов, а не посчитан заново
+        self.from_cache = from_cache
+
+
+def read_report_range(source, report_range=REPORT_RANGE):
+    """
+    Читает блок report_range первого листа отчёта МойСклад без загрузки всей книги в DataFrame.
+    source - путь к файлу или содержимое файла в байтах.
+
+    Для .xlsx строки читаются потоково (openpyxl read_only) и разбираются так же, как это делает
+    pd.read_excel(header=None, usecols=..., skiprows=..., nrows=...); .xls читается через pandas.
+    """
+    min_col, min_row, max_col, max_row = range_boundaries(report_range)
+    # Как и раньше, nrows = конец - начало: последняя строка диапазона не читается
+    nrows = max_row - min_row
+    if isinstance(source, bytes):
+        # .xlsx - это zip-архив, всё остальное (.xls) читается через pandas
+        is_xlsx = source.startswith(b'PK')
+        source = BytesIO(source)
+    else:
+        is_xlsx = not str(source).lower().endswith('.xls')
+    if not is_xlsx:
+        return pd.read_excel(source, header=None, usecols=list(range(min_col - 1, max_col)),
+                             skiprows=min_row - 1, nrows=nrows)
+
+    workbook = load_workbook(source, read_only=True, data_only=True, keep_links=False)
+    try:
+        worksheet = workbook.worksheets[0]
+        worksheet.reset_dimensions()
+        rows = [[_convert_cell(cell) for cell in row]
+                for row in worksheet.iter_rows(min_row=min_row, max_row=min_row + nrows)]
+    finally:
+        workbook.close()
+
+    # Как и pd.read_excel, читаем на строку больше и отбрасываем пустые ячейки в конце строк
+    # и пустые строки в конце блока
+    for row in rows:
+        while row and row[-1] == '':
+            row.pop()
+    while rows and not rows[-1]:
+        rows.pop()
+    width = max((len(row) for row in rows), default=0)
+    rows = [row + [''] * (width - len(row)) for row in rows]
+    return TextParser(rows, header=None, usecols=list(range(min_col - 1, max_col))).read(nrows)
+
+
+def _convert_cell(cell):
+    """Значение ячейки openpyxl в том виде, в каком его отдаёт pd.read_excel."""
+    if cell.value is None:
+        return ''
+    if cell.data_type == 'e':
+        return np.nan
+    if cell.data_type == 'n':
+        value = int(cell.value)
+        return value if value == cell.value else float(cell.value)
+    return cell.value
+
+
+def _output_file_name(profile):
+    today_date = datetime.now().strftime('%d.%m')
+    return f'{profile.output_name} {today_date}.xlsx'
+
+
+def _report_progress(progress, text):
+    """Сообщает о ходе обработки, если вызывающая сторона передала колбэк."""
+    if progress is not None:
+        progress(text)
+
+
+def process_excel_files(input_file, popularity_map=None, progress=None, profile=None):
+    """
+    Обработка отчёта с замером стадий и, если включено командой /profile, профилированием.
+    Аргументы и результат - как у _process_excel_files.
+    """
+    with metrics.maybe_profile('process_excel_files'), metrics.span('process_excel_files') as span:
+        result = _process_excel_files(input_file, popularity_map, progress, profile)
+        if not isinstance(result, ReportResult):
+            span.add('failed_jobs')
+        return result
+
+
+def _process_excel_files(input_file, popularity_map=None, progress=None, profile=None):
     """
     Основная логика обработки файлов, теперь включающая получение данных из CRM
     и сложную логику округления.
+    input_file - путь к отчёту МойСклад или его содержимое в байтах.
+    popularity_map - готовый снимок популярности; если не передан, запрашивается из CRM.
+    progress - необязательный колбэк progress(text) для сообщений о ходе обработки.
+    profile - имя профиля поставщика (см. profiles.py); по умолчанию - профиль по умолчанию.
+
+    Возвращает: ReportResult или строку с описанием ошибки.
     """
-    logging.info(f"Начало обработки файла: {input_file_path}")
+    if isinstance(input_file, bytes):
+        logging.info(f"Начало обработки файла из памяти ({len(input_file)} байт)")
+    else:
+        logging.info(f"Начало обработки файла: {input_file}")
     try:
+        profile = profile_registry.get(profile)
+        _report_progress(progress, "Чтение файлов...")
         # 1. ЗАГРУЗКА ДАННЫХ ИЗ ФАЙЛОВ
-        start_col = REPORT_RANGE.split(':')[0][0]
-        end_col = REPORT_RANGE.split(':')[1][0]
-        start_row = int(''.join(filter(str.isdigit, REPORT_RANGE.split(':')[0])))
-        end_row = int(''.join(filter(str.isdigit, REPORT_RANGE.split(':')[1])))
+        start_row = int(''.join(filter(str.isdigit, profile.report_range.split(':')[0])))
 
         # Чтение данных из входного файла (для VPR)
-        report_df = pd.read_excel(
-            input_file_path,
-            header=None,
-            usecols=f'{start_col}:{end_col}',
-            skiprows=start_row - 1,
-            nrows=end_row - start_row
-        )
+        with metrics.span('read_report') as span:
+            report_df = read_report_range(input_file, profile.report_range)
+            span.add('report_rows', len(report_df))
         report_df_sorted = report_df.sort_values(by=report_df.columns[0]).reset_index(drop=True)
-        start_row_f = int(''.join(filter(str.isdigit, REPORT_COPY_RANGE.split(':')[0]))) - 1 - (start_row - 1)
-        end_row_f = int(''.join(filter(str.isdigit, REPORT_COPY_RANGE.split(':')[1]))) - (start_row - 1)
+        copy_range = profile.report_copy_range
+        start_row_f = int(''.join(filter(str.isdigit, copy_range.split(':')[0]))) - 1 - (start_row - 1)
+        end_row_f = int(''.join(filter(str.isdigit, copy_range.split(':')[1]))) - (start_row - 1)
         data_from_report = report_df_sorted.iloc[start_row_f:end_row_f, 2]
 
-        # Чтение данных из Остатки_Комус.xlsx
-        komus_df_1 = pd.read_excel(FILE_OST_KOMUS, sheet_name=KOMUS_LIST_1, header=None, usecols=KOMUS_COLUMNS_1,
-                                   skiprows=1)
-        # Загружаем колонки [2, 4, 5] для calculate_formulas и apply_rounding_logic
-        komus_df_2_all = pd.read_excel(FILE_OST_KOMUS, sheet_name=KOMUS_LIST_2, header=None,
-                                       usecols=KOMUS_COLUMNS_FOR_ROUNDING,
-                                       skiprows=1)
+        # Данные из Остатки_Комус.xlsx берутся из кэша и перечитываются только при замене файла
+        with metrics.span('load_reference'):
+            reference = profile.reference_cache.get()
+        # Первый лист дополняется остатками из отчёта, поэтому работаем с копией
+        komus_df_1 = reference.komus_df_1.copy()
+        # Колонки [2, 4, 5] для calculate_formulas и apply_rounding_logic
+        komus_df_2_all = reference.komus_df_2_all
+
+        # Получаем данные о популярности из CRM, если снимок не передан (нужны и для ключа кэша)
+        if popularity_map is None:
+            _report_progress(progress, "Получение популярности из CRM...")
+            popularity_map = get_crm_popularity(profile.crm_store, profile.crm_order_method)
+
+        # Тот же отчёт с тем же справочником, шаблоном и популярностью уже считался - отдаём готовый файл.
+        # В режиме расшифровки формул кэш не используется, чтобы расшифровка писалась на каждый запуск.
+        cache_key = None
+        if result_cache.enabled and not FORMULAS_AUDIT_DIR:
+            profile.template_cache.get()  # Перечитывает шаблон и его хэш, если файл заменили
+            cache_key = report_cache_key(report_df, reference.digest, profile.template_cache.digest, popularity_map,
+                                         profile.cache_key)
+            content = result_cache.get(cache_key)
+            if content is not None:
+                new_file_name = _output_file_name(profile)
+                logging.info(f"Отчёт взят из кэша результатов: {new_file_name} ({len(content)} байт)")
+                history_archive.append_cached(profile.name, cache_key)
+                return ReportResult(new_file_name, content, from_cache=True)
 
         # 2. ПОДГОТОВКА И РАСЧЕТ
+        _report_progress(progress, "Расчёт остатков...")
         komus_df_1.iloc[:len(data_from_report), 2] = data_from_report.values
-        calculated_data = calculate_formulas(komus_df_1, komus_df_2_all)
+        audit_path = None
+        if FORMULAS_AUDIT_DIR:
+            os.makedirs(FORMULAS_AUDIT_DIR, exist_ok=True)
+            audit_path = os.path.join(FORMULAS_AUDIT_DIR, f"formulas_{datetime.now().strftime('%Y%m%d_%H%M%S_%f')}.csv")
+        with metrics.span('calculate_formulas') as span:
+            calculated_data = calculate_formulas(komus_df_1, komus_df_2_all, reference.countif_dict, audit_path,
+                                                 index=reference.index)
+            span.add('compositions', len(calculated_data))
 
         # 3. НОВАЯ ЛОГИКА ОКРУГЛЕНИЯ
-        # Получаем данные о популярности из CRM
-        popularity_map = get_crm_popularity()
-
         # --- ДЕБАГ: Выводим словарь популярности ---
         logging.info(f"Словарь популярности (Название композиции: Кол-во заказов): {popularity_map}")
 
         # Применяем новую логику округления
-        calculated_series = apply_rounding_logic(komus_df_2_all, calculated_data, popularity_map)
+        delta_path = None
+        if ROUNDING_DELTA_DIR:
+            os.makedirs(ROUNDING_DELTA_DIR, exist_ok=True)
+            delta_path = os.path.join(ROUNDING_DELTA_DIR,
+                                      f"rounding_delta_{datetime.now().strftime('%Y%m%d_%H%M%S_%f')}.csv")
+        with metrics.span('apply_rounding_logic') as span:
+            calculated_series, delta = incremental_rounding_for(profile).apply(
+                komus_df_2_all, calculated_data, popularity_map, reference.index, delta_path)
+            if delta is not None:
+                span.add('rounding_changes', len(delta))
 
         # ----------------------------------------------------
         # --- БЛОК ТЕСТИРОВАНИЯ: Замена '1' на '2' ---
@@ -203,23 +463,22 @@ def process_excel_files(input_file_path):
         # ----------------------------------------------------
 
 
-        # 4. ЗАПИСЬ В ФАЙЛ
-        with pd.ExcelWriter(FILE_OST_LESKOVSKY, engine='openpyxl', mode='a', if_sheet_exists='overlay') as writer:
-            calculated_series.to_excel(
-                writer,
-                sheet_name=LESKOVSKY_SHEET,
-                index=False,
-                header=False,
-                startrow=1,
-                startcol=2
-            )
+        # Расчёт и итоговые значения дописываются в архив истории для запросов /history
+        with metrics.span('history_archive'):
+            history_archive.append(profile.name, komus_df_2_all, calculated_data, calculated_series,
+                                   popularity_map, cache_key)
 
-        today_date = datetime.now().strftime('%d.%m')
-        new_file_name = f'Остатки ИП Лесковский {today_date}.xlsx'
-        shutil.copyfile(FILE_OST_LESKOVSKY, new_file_name)
+        # 4. ЗАПИСЬ РЕЗУЛЬТАТА (в памяти, шаблон на диске не изменяется)
+        _report_progress(progress, "Запись результата...")
+        new_file_name = _output_file_name(profile)
+        with metrics.span('render_report') as span:
+            content = render_report(calculated_series.to_numpy(), profile.template_cache, profile.template_sheet)
+            span.add('bytes_written', len(content))
+        if cache_key is not None:
+            result_cache.put(cache_key, content)
 
-        logging.info(f"Файл успешно обработан. Создан: {new_file_name}")
-        return new_file_name
+        logging.info(f"Файл успешно обработан: {new_file_name} ({len(content)} байт)")
+        return ReportResult(new_file_name, content)
 
     except FileNotFoundError as e:
         logging.error(f"Ошибка: Файл не найден: {e}")
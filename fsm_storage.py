@@ -0,0 +1,80 @@
+import os
+import json
+import asyncio
+import logging
+import sqlite3
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage
+from aiogram.fsm.storage.memory import MemoryStorage
+from dotenv import load_dotenv
+
+# --- ЗАГРУЗКА ПЕРЕМЕННЫХ ИЗ .ENV ---
+load_dotenv()
+# Где хранится состояние пользователей (FSM): 'memory' или 'sqlite' (общее для нескольких процессов бота)
+FSM_STORAGE = os.getenv("FSM_STORAGE", "memory")
+FSM_STORAGE_PATH = os.getenv("FSM_STORAGE_PATH", "fsm.sqlite")
+
+
+class SQLiteStorage(BaseStorage):
+    """
+    Хранилище состояния aiogram в SQLite-файле. Несколько процессов бота с одним токеном
+    (реплики в режиме webhook) видят одно и то же состояние пользователя.
+    Запросы к файлу выполняются в потоке, чтобы ожидание блокировки SQLite не останавливало event loop.
+    """
+
+    def __init__(self, path=FSM_STORAGE_PATH):
+        self.path = path
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS fsm (
+                    key TEXT PRIMARY KEY,
+                    state TEXT,
+                    data TEXT NOT NULL DEFAULT '{}'
+                )
+            """)
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    def _execute(self, query, params):
+        with self._connect() as conn:
+            conn.execute(query, params)
+
+    def _fetchone(self, query, params):
+        with self._connect() as conn:
+            return conn.execute(query, params).fetchone()
+
+    @staticmethod
+    def _key(key):
+        return ':'.join(str(part) for part in (key.bot_id, key.chat_id, key.user_id, key.thread_id,
+                                               key.business_connection_id, key.destiny))
+
+    async def set_state(self, key, state=None):
+        state = state.state if isinstance(state, State) else state
+        query = "INSERT INTO fsm (key, state) VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET state = ?"
+        await asyncio.to_thread(self._execute, query, (self._key(key), state, state))
+
+    async def get_state(self, key):
+        row = await asyncio.to_thread(self._fetchone, "SELECT state FROM fsm WHERE key = ?", (self._key(key),))
+        return row[0] if row else None
+
+    async def set_data(self, key, data):
+        value = json.dumps(dict(data), ensure_ascii=False)
+        query = "INSERT INTO fsm (key, data) VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET data = ?"
+        await asyncio.to_thread(self._execute, query, (self._key(key), value, value))
+
+    async def get_data(self, key):
+        row = await asyncio.to_thread(self._fetchone, "SELECT data FROM fsm WHERE key = ?", (self._key(key),))
+        return json.loads(row[0]) if row else {}
+
+    async def close(self):
+        pass
+
+
+def create_storage(kind=FSM_STORAGE):
+    if kind == 'sqlite':
+        return SQLiteStorage()
+    if kind != 'memory':
+        logging.warning(f"Неизвестный тип хранилища состояния '{kind}', используется память.")
+    return MemoryStorage()
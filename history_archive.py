@@ -0,0 +1,331 @@
+"""
+Архив истории расчётов: каждый посчитанный отчёт (остаток по формулам, итоговое значение после
+округления и популярность по каждой строке справочника) дописывается в Parquet-набор,
+разбитый по профилю и дате: <HISTORY_ARCHIVE_DIR>/profile=<имя>/date=<ГГГГ-ММ-ДД>/<запуск>.parquet.
+
+Запросы читают только нужные колонки, а папки других профилей и дней не открывают вовсе,
+поэтому скорость почти не зависит от глубины архива.
+
+Склейка файлов прошедших дней в один (запускать по расписанию из корня проекта):
+    python history_archive.py --compact
+"""
+import os
+import sys
+import json
+import uuid
+import logging
+import argparse
+import threading
+from collections import OrderedDict
+from datetime import datetime, date, timedelta
+from urllib.parse import unquote
+from dotenv import load_dotenv
+
+try:
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+    import pyarrow.parquet as pq
+except ImportError:  # Без pyarrow расчёты не архивируются, /history сообщает, что архив недоступен
+    pa = None
+
+from reference_cache import COL_INDEX_COMPOSITION_KEY, COL_INDEX_CRM_NAME, COL_INDEX_PLANT_NAME
+from result_cache import RESULT_CACHE_SIZE
+
+# --- ЗАГРУЗКА ПЕРЕМЕННЫХ ИЗ .ENV ---
+load_dotenv()
+# Папка архива истории расчётов (пустое значение - архив выключен)
+HISTORY_ARCHIVE_DIR = os.getenv("HISTORY_ARCHIVE_DIR", "history")
+# За сколько дней по умолчанию строятся ряды и скорость расхода в /history
+HISTORY_DAYS = int(os.getenv("HISTORY_DAYS", "90"))
+
+ARCHIVE_COLUMNS = ('run_id', 'run_at', 'plant', 'composition', 'crm_name', 'calculated', 'final_value', 'popularity')
+VALUE_COLUMNS = ('calculated', 'final_value', 'popularity')
+# Метаданные файла дня: имена склеенных в него файлов запусков (см. compact)
+COMPACTED_FROM = b'compacted_from'
+SCAN_ATTEMPTS = 3  # Сколько раз запрос перечитывает папки, если compact удалил файлы прямо во время чтения
+
+
+def depletion_rate(points):
+    """
+    Скорость изменения по ряду [(дата 'ГГГГ-ММ-ДД', значение)] - наклон прямой методом наименьших
+    квадратов, в единицах в день (отрицательная - остаток убывает). None, если точек меньше двух.
+    """
+    if len(points) < 2:
+        return None
+    first = date.fromisoformat(points[0][0])
+    xs = [(date.fromisoformat(day) - first).days for day, _ in points]
+    ys = [value for _, value in points]
+    mean_x = sum(xs) / len(xs)
+    mean_y = sum(ys) / len(ys)
+    spread = sum((x - mean_x) ** 2 for x in xs)
+    if spread == 0:
+        return None
+    return sum((x - mean_x) * (y - mean_y) for x, y in zip(xs, ys)) / spread
+
+
+def days_until_empty(points, rate):
+    """Через сколько дней при текущей скорости расхода остаток дойдёт до нуля (None - не убывает)."""
+    if rate is None or rate >= 0 or not points:
+        return None
+    return points[-1][1] / -rate
+
+
+def _latest_per_day(rows, value):
+    """Из сумм по запускам [{date, run_at, value}] оставляет последний запуск каждого дня: [(дата, значение)]."""
+    latest = {}
+    for row in rows:
+        current = latest.get(row['date'])
+        if current is None or row['run_at'] > current[0]:
+            latest[row['date']] = (row['run_at'], row[value])
+    return [(day, latest[day][1]) for day in sorted(latest)]
+
+
+class HistoryArchive:
+    """
+    Parquet-архив расчётов. Дописывание - отдельный файл на запуск, поэтому писать в архив могут
+    одновременно несколько процессов (бот, пул пакетной обработки, worker.py) без блокировок.
+    """
+
+    def __init__(self, directory=HISTORY_ARCHIVE_DIR, cached_runs=RESULT_CACHE_SIZE):
+        self.directory = directory
+        # Строки последних запусков по ключу кэша результатов: отчёт из кэша тоже попадает в историю
+        self.cached_runs = cached_runs
+        self._runs = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return pa is not None and bool(self.directory)
+
+    @property
+    def _partitioning(self):
+        return ds.partitioning(pa.schema([('profile', pa.string()), ('date', pa.string())]), flavor='hive')
+
+    # --- ЗАПИСЬ ---
+    def append(self, profile, komus_df_2_all, calculated_data, final_values, popularity_map, cache_key=None,
+               run_at=None):
+        """
+        Дописывает запуск: по строке на каждую строку справочника komus_df_2_all.
+        run_at - время запуска (по умолчанию сейчас), для загрузки старых расчётов задним числом.
+        Возвращает True, если запуск записан. Ошибка записи не должна мешать отправке отчёта,
+        поэтому она только логируется.
+        """
+        if not self.enabled:
+            return False
+        try:
+            popularity = komus_df_2_all.iloc[:, COL_INDEX_CRM_NAME].map(popularity_map).fillna(0)
+            columns = {
+                'plant': komus_df_2_all.iloc[:, COL_INDEX_PLANT_NAME],
+                'composition': komus_df_2_all.iloc[:, COL_INDEX_COMPOSITION_KEY],
+                'crm_name': komus_df_2_all.iloc[:, COL_INDEX_CRM_NAME],
+            }
+            table = pa.table({
+                **{name: pa.array([None if _is_missing(value) else _text(value) for value in column], pa.string())
+                   for name, column in columns.items()},
+                'calculated': pa.array(calculated_data, pa.float64(), from_pandas=True),
+                'final_value': pa.array(final_values, pa.float64(), from_pandas=True),
+                'popularity': pa.array(popularity.to_numpy(dtype='int64'), pa.int64()),
+            })
+            # Строки одного растения идут подряд, файл лучше сжимается
+            table = table.sort_by([('plant', 'ascending'), ('composition', 'ascending')])
+            if cache_key is not None and self.cached_runs > 0:
+                with self._lock:
+                    self._runs[cache_key] = table
+                    self._runs.move_to_end(cache_key)
+                    while len(self._runs) > self.cached_runs:
+                        self._runs.popitem(last=False)
+            return self._write(profile, table, run_at)
+        except Exception as e:
+            logging.warning(f"Не удалось записать расчёт в архив истории: {e}")
+            return False
+
+    def append_cached(self, profile, cache_key):
+        """Отчёт отдан из кэша результатов: повторяет в архиве строки запуска с тем же ключом, если они в памяти."""
+        if not self.enabled:
+            return False
+        with self._lock:
+            table = self._runs.get(cache_key)
+        if table is None:
+            return False
+        try:
+            return self._write(profile, table)
+        except Exception as e:
+            logging.warning(f"Не удалось записать расчёт в архив истории: {e}")
+            return False
+
+    def _write(self, profile, table, run_at=None):
+        run_at = (run_at or datetime.now()).replace(microsecond=0)
+        run_id = f"{run_at.strftime('%H%M%S')}-{uuid.uuid4().hex[:8]}"
+        rows = len(table)
+        table = table.append_column('run_id', pa.array([run_id] * rows, pa.string()))
+        table = table.append_column('run_at', pa.array([run_at] * rows, pa.timestamp('s')))
+        table = table.append_column('profile', pa.array([profile] * rows, pa.string()))
+        table = table.append_column('date', pa.array([run_at.date().isoformat()] * rows, pa.string()))
+        ds.write_dataset(table.select(list(ARCHIVE_COLUMNS) + ['profile', 'date']), self.directory,
+                         format='parquet', partitioning=self._partitioning,
+                         basename_template=f"{run_id}-{{i}}.parquet", existing_data_behavior='overwrite_or_ignore')
+        logging.info(f"Расчёт записан в архив истории: профиль {profile}, строк {rows}")
+        return True
+
+    # --- ЗАПРОСЫ ---
+    def _scan(self, profile, days, columns, condition):
+        """
+        Читает колонки columns строк профиля за последние days дней, подходящих под condition.
+        Папки других профилей и дней не открываются вовсе.
+        """
+        since = (date.today() - timedelta(days=days)).isoformat()
+        for attempt in range(SCAN_ATTEMPTS):
+            try:
+                paths = []
+                for day_path in self._partition_dirs(profile, since):
+                    paths.extend(self._day_files(day_path))
+                if not paths:
+                    return None
+                dataset = ds.dataset(paths, format='parquet', partitioning=self._partitioning,
+                                     partition_base_dir=self.directory)
+                return dataset.to_table(columns=list(columns), filter=condition)
+            except FileNotFoundError:
+                # compact склеил день между листингом и чтением и удалил файлы запусков
+                if attempt == SCAN_ATTEMPTS - 1:
+                    raise
+
+    @staticmethod
+    def _day_files(day_path):
+        """
+        Файлы дня без тех, что уже склеены в файл дня: compact удаляет их только после записи склейки,
+        и до удаления те же строки лежат в двух файлах.
+        """
+        names = [name for name in os.listdir(day_path) if name.endswith('.parquet')]
+        compacted = _compacted_sources(day_path, names)
+        return [os.path.join(day_path, name) for name in names if name not in compacted]
+
+    def _partition_dirs(self, profile, since):
+        if not self.enabled or not os.path.isdir(self.directory):
+            return []
+        # Имена папок закодированы как в URI (segment_encoding pyarrow по умолчанию)
+        profile_dirs = [name for name in os.listdir(self.directory) if unquote(name) == f'profile={profile}']
+        if not profile_dirs:
+            return []
+        profile_path = os.path.join(self.directory, profile_dirs[0])
+        return [os.path.join(profile_path, name) for name in sorted(os.listdir(profile_path))
+                if name.startswith('date=') and name[len('date='):] >= since]
+
+    def series(self, profile, name, days=HISTORY_DAYS, value='final_value'):
+        """
+        Ряд по растению, композиции или названию в CRM name за последние days дней: сумма value
+        по совпавшим строкам в последнем запуске каждого дня, [(дата 'ГГГГ-ММ-ДД', значение)].
+        """
+        if value not in VALUE_COLUMNS:
+            raise ValueError(f"Неизвестная колонка архива: {value}")
+        condition = (ds.field('plant') == name) | (ds.field('composition') == name) | (ds.field('crm_name') == name)
+        table = self._scan(profile, days, ('date', 'run_at', value), condition)
+        if table is None or table.num_rows == 0:
+            return []
+        per_run = table.group_by(['date', 'run_at']).aggregate([(value, 'sum')])
+        return _latest_per_day(per_run.rename_columns(['date', 'run_at', value]).to_pylist(), value)
+
+    def depletion(self, profile, days=HISTORY_DAYS, limit=10):
+        """
+        Растения с самым быстрым расходом итогового остатка за последние days дней:
+        [(растение, единиц в день, последний остаток, дней до нуля или None)], сначала самые быстрые.
+        """
+        table = self._scan(profile, days, ('date', 'run_at', 'plant', 'final_value'), ds.field('plant').is_valid())
+        if table is None or table.num_rows == 0:
+            return []
+        per_run = table.group_by(['plant', 'date', 'run_at']).aggregate([('final_value', 'sum')])
+        per_run = per_run.rename_columns(['plant', 'date', 'run_at', 'final_value'])
+        by_plant = {}
+        for row in per_run.to_pylist():
+            by_plant.setdefault(row['plant'], []).append(row)
+
+        ranking = []
+        for plant, rows in by_plant.items():
+            points = _latest_per_day(rows, 'final_value')
+            rate = depletion_rate(points)
+            if rate is not None and rate < 0:
+                ranking.append((plant, rate, points[-1][1], days_until_empty(points, rate)))
+        ranking.sort(key=lambda item: item[1])
+        return ranking[:limit]
+
+    # --- ОБСЛУЖИВАНИЕ ---
+    def compact(self, before=None):
+        """
+        Склеивает файлы запусков каждого дня раньше before (по умолчанию - сегодня) в один файл.
+        Сегодняшние файлы не трогаются: в них ещё пишут. Возвращает количество склеенных дней.
+        """
+        if not self.enabled or not os.path.isdir(self.directory):
+            return 0
+        before = (before or date.today()).isoformat()
+        compacted = 0
+        for profile_dir in sorted(os.listdir(self.directory)):
+            profile_path = os.path.join(self.directory, profile_dir)
+            if not os.path.isdir(profile_path):
+                continue
+            for date_dir in sorted(os.listdir(profile_path)):
+                if date_dir.split('=', 1)[-1] >= before:
+                    continue
+                day_path = os.path.join(profile_path, date_dir)
+                names = [name for name in os.listdir(day_path) if name.endswith('.parquet')]
+                merged = _compacted_sources(day_path, names)
+                # Файлы, уже склеенные в файл дня, но не удалённые (склейка прервалась), только удаляются:
+                # их строки есть в файле дня, и повторная склейка записала бы их дважды
+                for name in merged.intersection(names):
+                    os.remove(os.path.join(day_path, name))
+                files = sorted(os.path.join(day_path, name) for name in names if name not in merged)
+                if len(files) < 2:
+                    continue
+                # Читаются только перечисленные файлы, поэтому запуск, дописанный во время склейки, не теряется
+                table = ds.dataset(files, format='parquet').to_table(columns=list(ARCHIVE_COLUMNS))
+                table = table.sort_by([('plant', 'ascending'), ('run_at', 'ascending')])
+                sources = json.dumps([os.path.basename(path) for path in files]).encode('utf-8')
+                table = table.replace_schema_metadata({**(table.schema.metadata or {}), COMPACTED_FROM: sources})
+                target = os.path.join(day_path, f"day-{uuid.uuid4().hex[:8]}.parquet")
+                pq.write_table(table, target + '.tmp')
+                os.replace(target + '.tmp', target)
+                for path in files:
+                    os.remove(path)
+                compacted += 1
+        logging.info(f"Архив истории: склеено дней {compacted}")
+        return compacted
+
+
+def _compacted_sources(day_path, names):
+    """Имена файлов запусков, которые файлы дня среди names уже содержат (метаданные COMPACTED_FROM)."""
+    compacted = set()
+    for name in names:
+        if name.startswith('day-'):
+            metadata = pq.read_schema(os.path.join(day_path, name)).metadata or {}
+            compacted.update(json.loads(metadata.get(COMPACTED_FROM, b'[]')))
+    return compacted
+
+
+def _is_missing(value):
+    return value is None or value != value
+
+
+def _text(value):
+    """Значение справочника как строка. Коды, прочитанные из Excel как 12345.0, хранятся как '12345'."""
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+# Общий архив истории процесса
+history_archive = HistoryArchive()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Обслуживание архива истории расчётов")
+    parser.add_argument('--compact', action='store_true', help="склеить файлы прошедших дней")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    if not history_archive.enabled:
+        logging.error("Архив истории выключен: нужен pyarrow и непустой HISTORY_ARCHIVE_DIR.")
+        return 1
+    if args.compact:
+        history_archive.compact()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
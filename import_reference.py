@@ -0,0 +1,47 @@
+"""
+Импорт справочника: переводит нужные листы Остатки_Комус.xlsx в бинарный снимок рядом с книгой
+(Остатки_Комус.snapshot/), который бот и пакетная обработка читают вместо книги.
+Запускать после каждой замены книги; пока снимок не обновлён, используется сама книга.
+
+Запуск из корня проекта:
+    python import_reference.py
+    python import_reference.py путь/к/Остатки_Комус.xlsx
+    python import_reference.py --profile другой_поставщик
+"""
+import sys
+import logging
+import argparse
+
+from reference_cache import export_snapshot
+from profiles import profile_registry
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Импорт справочника Остатки_Комус.xlsx в бинарный снимок")
+    parser.add_argument('workbook', nargs='?', help="книга справочника (по умолчанию - из профиля)")
+    parser.add_argument('--profile', help="профиль поставщика из profiles.json")
+    parser.add_argument('--all', action='store_true', help="импортировать справочники всех профилей")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    profiles = list(profile_registry.profiles.values()) if args.all else [profile_registry.get(args.profile)]
+    failed = 0
+    for profile in profiles:
+        failed += _import(args.workbook or profile.reference, profile.reference_sheets)
+    return 1 if failed else 0
+
+
+def _import(workbook, sheets):
+    try:
+        path, meta = export_snapshot(workbook, sheets)
+    except (OSError, ValueError, TypeError) as e:
+        print(f"Не удалось импортировать справочник: {e}", file=sys.stderr)
+        return 1
+
+    rows = ', '.join(f"{name}: {frame['rows']} строк" for name, frame in meta['frames'].items())
+    print(f"Снимок сохранён: {path} ({rows}, хэш {meta['source_digest'][:12]})")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
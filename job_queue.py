@@ -0,0 +1,219 @@
+import os
+import uuid
+import asyncio
+import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from dotenv import load_dotenv
+
+from metrics import metrics
+
+# --- ЗАГРУЗКА ПЕРЕМЕННЫХ ИЗ .ENV ---
+load_dotenv()
+# Сколько задач обрабатывается одновременно
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "2"))
+# Максимальное количество задач, ожидающих в очереди
+JOB_QUEUE_SIZE = int(os.getenv("JOB_QUEUE_SIZE", "20"))
+# Максимальное количество незавершённых задач одного пользователя
+JOB_MAX_PER_USER = int(os.getenv("JOB_MAX_PER_USER", "3"))
+# Тип пула: 'thread' или 'process'
+JOB_EXECUTOR = os.getenv("JOB_EXECUTOR", "thread")
+
+# --- СТАТУСЫ ЗАДАЧ ---
+STATUS_QUEUED = 'queued'
+STATUS_RUNNING = 'running'
+STATUS_DONE = 'done'
+STATUS_FAILED = 'failed'
+STATUS_CANCELLED = 'cancelled'
+
+
+class QueueFullError(Exception):
+    """Очередь (общая или пользователя) заполнена, задача не принята."""
+
+
+class Job:
+    """
+    Задача обработки: синхронная функция с аргументами, которую выполнит пул.
+    on_status - async-колбэк (job, text), через который задача сообщает о позиции в очереди и прогрессе.
+    """
+
+    def __init__(self, user_id, func, args, on_status=None):
+        self.id = uuid.uuid4().hex[:8]
+        self.user_id = user_id
+        self.func = func
+        self.args = args
+        self.on_status = on_status
+        self.status = STATUS_QUEUED
+        self.future = asyncio.get_running_loop().create_future()
+
+    async def wait(self):
+        """Ждёт завершения задачи и возвращает результат функции."""
+        return await self.future
+
+
+class JobQueue:
+    """
+    Ограниченная очередь задач с пулом потоков или процессов.
+    Тяжёлая обработка выполняется вне event loop, поэтому бот продолжает отвечать во время работы пула.
+    """
+
+    def __init__(self, workers=JOB_WORKERS, max_size=JOB_QUEUE_SIZE, max_per_user=JOB_MAX_PER_USER,
+                 executor_kind=JOB_EXECUTOR):
+        self.workers = workers
+        self.max_size = max_size
+        self.max_per_user = max_per_user
+        self.executor_kind = executor_kind
+        self._pending = deque()
+        self._running = {}
+        self._condition = None
+        self._executor = None
+        self._tasks = []
+
+    # --- ЖИЗНЕННЫЙ ЦИКЛ ---
+    def start(self):
+        if self._tasks:
+            return
+        if self.executor_kind == 'process':
+            self._executor = ProcessPoolExecutor(max_workers=self.workers)
+        else:
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='job')
+        self._condition = asyncio.Condition()
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        logging.info(f"Пул задач запущен: {self.workers} ({self.executor_kind}), размер очереди {self.max_size}.")
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        for job in list(self._pending):
+            self._finish(job, STATUS_CANCELLED)
+        self._pending.clear()
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+        logging.info("Пул задач остановлен.")
+
+    # --- ПОСТАНОВКА И ОТМЕНА ---
+    async def submit(self, user_id, func, *args, on_status=None):
+        """
+        Ставит задачу в очередь. Бросает QueueFullError, если общая очередь
+        или лимит задач пользователя исчерпаны.
+        """
+        if len(self._pending) >= self.max_size:
+            raise QueueFullError("Очередь обработки заполнена, попробуйте позже.")
+        if len(self.user_jobs(user_id)) >= self.max_per_user:
+            raise QueueFullError(f"У вас уже {self.max_per_user} файла в обработке, дождитесь результата.")
+
+        job = Job(user_id, func, args, on_status=on_status)
+        async with self._condition:
+            self._pending.append(job)
+            self._condition.notify()
+        self._update_gauges()
+        logging.info(f"Задача {job.id} пользователя {user_id} поставлена в очередь. Позиция: {self.position(job)}")
+        await self._notify(job, f"Файл в очереди, позиция: {self.position(job)}.")
+        return job
+
+    def cancel(self, user_id):
+        """
+        Отменяет все задачи пользователя. Ожидающие задачи снимаются с очереди;
+        у выполняющихся результат отбрасывается (поток нельзя прервать принудительно).
+        Возвращает количество отменённых задач.
+        """
+        cancelled = 0
+        for job in self.user_jobs(user_id):
+            if job.status == STATUS_CANCELLED:
+                # Уже отменена, но поток ещё не вернулся - задача остаётся в _running до его завершения
+                continue
+            if job.status == STATUS_QUEUED:
+                self._pending.remove(job)
+            self._finish(job, STATUS_CANCELLED)
+            cancelled += 1
+        if cancelled:
+            self._update_gauges()
+            logging.info(f"Пользователь {user_id} отменил задач: {cancelled}")
+        return cancelled
+
+    # --- СОСТОЯНИЕ ---
+    def position(self, job):
+        """Позиция задачи в очереди, начиная с 1 (0 - задача уже выполняется или завершена)."""
+        try:
+            return self._pending.index(job) + 1
+        except ValueError:
+            return 0
+
+    def user_jobs(self, user_id):
+        jobs = [job for job in self._pending if job.user_id == user_id]
+        jobs += [job for job in self._running.values() if job.user_id == user_id]
+        return jobs
+
+    @property
+    def depth(self):
+        return len(self._pending)
+
+    @property
+    def active(self):
+        return len(self._running)
+
+    # --- ВНУТРЕННЯЯ ЛОГИКА ---
+    async def _worker(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            async with self._condition:
+                await self._condition.wait_for(lambda: self._pending)
+                job = self._pending.popleft()
+            job.status = STATUS_RUNNING
+            self._running[job.id] = job
+            self._update_gauges()
+            await self._announce_positions()
+            await self._notify(job, "Начинаю обработку файла...")
+
+            args = job.args
+            if self.executor_kind != 'process':
+                # В пуле потоков функция может сообщать о прогрессе через последний аргумент
+                args = args + (self._progress_callback(loop, job),)
+            try:
+                result = await loop.run_in_executor(self._executor, job.func, *args)
+            except Exception as e:
+                logging.error(f"Ошибка при выполнении задачи {job.id}: {e}", exc_info=True)
+                self._finish(job, STATUS_FAILED, error=e)
+            else:
+                self._finish(job, STATUS_DONE, result=result)
+            finally:
+                self._running.pop(job.id, None)
+                self._update_gauges()
+
+    def _update_gauges(self):
+        metrics.set_gauge('job_queue_depth', self.depth)
+        metrics.set_gauge('jobs_running', self.active)
+
+    def _finish(self, job, status, result=None, error=None):
+        if job.future.done():
+            return
+        job.status = status
+        metrics.inc('jobs_total', status=status)
+        if status == STATUS_DONE:
+            job.future.set_result(result)
+        elif status == STATUS_FAILED:
+            job.future.set_exception(error)
+        else:
+            job.future.cancel()
+
+    def _progress_callback(self, loop, job):
+        def progress(text):
+            if job.status == STATUS_RUNNING:
+                asyncio.run_coroutine_threadsafe(self._notify(job, text), loop)
+
+        return progress
+
+    async def _announce_positions(self):
+        for job in list(self._pending):
+            await self._notify(job, f"Файл в очереди, позиция: {self.position(job)}.")
+
+    async def _notify(self, job, text):
+        if job.on_status is None:
+            return
+        try:
+            await job.on_status(job, text)
+        except Exception as e:
+            logging.warning(f"Не удалось сообщить статус задачи {job.id}: {e}")
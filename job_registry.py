@@ -0,0 +1,160 @@
+import os
+import time
+import asyncio
+import hashlib
+import logging
+import sqlite3
+import threading
+from dotenv import load_dotenv
+
+# --- ЗАГРУЗКА ПЕРЕМЕННЫХ ИЗ .ENV ---
+load_dotenv()
+# Сколько секунд хранится готовый отчёт, ожидающий решения об отправке
+JOB_RESULT_TTL = int(os.getenv("JOB_RESULT_TTL", "86400"))
+# Где хранятся отчёты: 'memory' или 'sqlite' (переживает перезапуск бота)
+JOB_REGISTRY_BACKEND = os.getenv("JOB_REGISTRY_BACKEND", "memory")
+JOB_REGISTRY_PATH = os.getenv("JOB_REGISTRY_PATH", "jobs.sqlite")
+# Как часто фоновая задача удаляет просроченные отчёты, в секундах
+JOB_JANITOR_INTERVAL = int(os.getenv("JOB_JANITOR_INTERVAL", "600"))
+
+
+class JobRecord:
+    """Результат задачи: готовый отчёт, его хэш, срок хранения и профиль поставщика."""
+
+    def __init__(self, job_id, user_id, file_name, content, digest, expires_at, profile=None):
+        self.job_id = job_id
+        self.user_id = user_id
+        self.file_name = file_name
+        self.content = content
+        self.digest = digest
+        self.expires_at = expires_at
+        self.profile = profile
+
+
+class MemoryBackend:
+    """Хранение отчётов в памяти процесса."""
+
+    def __init__(self):
+        self._records = {}
+        self._lock = threading.Lock()
+
+    def put(self, record):
+        with self._lock:
+            self._records[record.job_id] = record
+
+    def get(self, job_id):
+        with self._lock:
+            return self._records.get(job_id)
+
+    def delete(self, job_id):
+        with self._lock:
+            self._records.pop(job_id, None)
+
+    def evict_expired(self, now):
+        with self._lock:
+            expired = [job_id for job_id, record in self._records.items() if record.expires_at <= now]
+            for job_id in expired:
+                del self._records[job_id]
+        return len(expired)
+
+
+class SQLiteBackend:
+    """Хранение отчётов в SQLite-файле: результаты переживают перезапуск бота."""
+
+    def __init__(self, path=JOB_REGISTRY_PATH):
+        self.path = path
+        with sqlite3.connect(self.path) as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY,
+                    user_id INTEGER,
+                    file_name TEXT NOT NULL,
+                    content BLOB NOT NULL,
+                    digest TEXT NOT NULL,
+                    expires_at REAL NOT NULL,
+                    profile TEXT
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS jobs_expires_at ON jobs(expires_at)")
+
+    def put(self, record):
+        with sqlite3.connect(self.path) as conn:
+            conn.execute("INSERT OR REPLACE INTO jobs (id, user_id, file_name, content, digest, expires_at, profile) "
+                         "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                         (record.job_id, record.user_id, record.file_name, record.content, record.digest,
+                          record.expires_at, record.profile))
+
+    def get(self, job_id):
+        with sqlite3.connect(self.path) as conn:
+            row = conn.execute("SELECT id, user_id, file_name, content, digest, expires_at, profile FROM jobs "
+                               "WHERE id = ?", (job_id,)).fetchone()
+        return JobRecord(*row) if row else None
+
+    def delete(self, job_id):
+        with sqlite3.connect(self.path) as conn:
+            conn.execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+
+    def evict_expired(self, now):
+        with sqlite3.connect(self.path) as conn:
+            return conn.execute("DELETE FROM jobs WHERE expires_at <= ?", (now,)).rowcount
+
+
+def create_backend(kind=JOB_REGISTRY_BACKEND):
+    if kind == 'sqlite':
+        return SQLiteBackend()
+    if kind != 'memory':
+        logging.warning(f"Неизвестный тип хранилища задач '{kind}', используется память.")
+    return MemoryBackend()
+
+
+class JobRegistry:
+    """
+    Реестр результатов задач по короткому id, который передаётся в callback_data кнопок.
+    Фоновая задача-уборщик удаляет отчёты с истёкшим сроком хранения.
+    Методы синхронные: с SQLite-хранилищем их вызывают из обработчиков через asyncio.to_thread.
+    """
+
+    def __init__(self, backend=None, ttl=JOB_RESULT_TTL):
+        self.backend = backend or create_backend()
+        self.ttl = ttl
+        self._janitor = None
+
+    def save(self, job_id, user_id, file_name, content, profile=None):
+        record = JobRecord(job_id, user_id, file_name, content, hashlib.sha256(content).hexdigest(),
+                           time.time() + self.ttl, profile)
+        self.backend.put(record)
+        return record
+
+    def get(self, job_id):
+        """Запись задачи или None, если её нет или срок хранения истёк."""
+        record = self.backend.get(job_id)
+        if record is None or record.expires_at <= time.time():
+            return None
+        return record
+
+    def delete(self, job_id):
+        self.backend.delete(job_id)
+
+    def evict_expired(self):
+        evicted = self.backend.evict_expired(time.time())
+        if evicted:
+            logging.info(f"Удалено просроченных отчётов: {evicted}")
+        return evicted
+
+    def start_janitor(self, interval=JOB_JANITOR_INTERVAL):
+        if self._janitor is None:
+            self._janitor = asyncio.create_task(self._run_janitor(interval))
+
+    async def stop_janitor(self):
+        if self._janitor is not None:
+            self._janitor.cancel()
+            await asyncio.gather(self._janitor, return_exceptions=True)
+            self._janitor = None
+
+    async def _run_janitor(self, interval):
+        while True:
+            try:
+                await asyncio.to_thread(self.evict_expired)
+            except Exception as e:
+                logging.error(f"Ошибка при очистке реестра задач: {e}", exc_info=True)
+            await asyncio.sleep(interval)
@@ -1,16 +1,29 @@
 import os
-import shutil
+import time
+# Отсчёт времени запуска начинается до импорта aiogram и модулей бота
+STARTED_AT = time.perf_counter()
 import asyncio
 import logging
-from aiogram import Bot, Dispatcher, types, F, Router
-from aiogram.filters import CommandStart
-from aiogram.types import FSInputFile, InlineKeyboardMarkup, InlineKeyboardButton
-from aiogram.fsm.storage.memory import MemoryStorage
+from aiohttp import web
+from aiogram import Dispatcher, types, F, Router
+from aiogram.filters import CommandStart, Command
+from aiogram.fsm.context import FSMContext
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
 from dotenv import load_dotenv
 
 # Импортируем функции из наших новых файлов
-from file_processing import process_excel_files
-from email_sender import send_email_with_attachment
+# file_processing и batch (pandas, numpy, openpyxl) импортируются в фоне через processing_warmup
+# profiles тоже загружается в фоне: он подтягивает кэши справочника и шаблона
+from email_sender import send_email_with_attachment, mail_sender, parse_recipients, SEND_SENT, SEND_QUEUED
+from job_queue import JobQueue, QueueFullError, STATUS_QUEUED, STATUS_RUNNING, STATUS_CANCELLED
+from popularity_snapshot import PopularityScheduler
+from retailcrm_client import crm_client
+from task_queue import SQLiteTaskQueue, JOB_BACKEND
+# Бот, реестр отчётов и отправка результата общие с процессами worker.py
+from delivery import bot, job_registry, BOT_TOKEN, processing_call, announce_job, deliver_results
+from fsm_storage import create_storage
+from metrics import metrics, start_metrics_server
+from warmup import processing_warmup, STARTUP_MODE
 
 # --- НАСТРОЙКА ЛОГИРОВАНИЯ ---
 logging.basicConfig(
@@ -20,15 +33,33 @@ logging.basicConfig(
 
 # --- ЗАГРУЗКА ПЕРЕМЕННЫХ ИЗ .ENV ---
 load_dotenv()
-BOT_TOKEN = os.getenv("BOT_TOKEN")
 EMAIL_TO = os.getenv("EMAIL_TO")
-TEMP_FOLDER = "temp_files"
+# Пользователи, которым доступны служебные команды /stats и /profile (через запятую); пусто - команды отключены
+ADMIN_IDS = {int(user_id) for user_id in os.getenv("ADMIN_IDS", "").split(',') if user_id.strip()}
+# Способ получения обновлений: 'polling' или 'webhook' (несколько реплик бота за одним адресом)
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+# Публичный адрес, на который Telegram присылает обновления (без пути), например https://bot.example.com
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
 
 # --- ИНИЦИАЛИЗАЦИЯ БОТА ---
-storage = MemoryStorage()
-bot = Bot(token=BOT_TOKEN)
+storage = create_storage()
 dp = Dispatcher(storage=storage)
 router = Router()
+job_queue = JobQueue()
+# С общей очередью документы обрабатывают процессы worker.py, а бот только ставит задачи
+task_queue = SQLiteTaskQueue() if JOB_BACKEND == 'sqlite' else None
+# Планировщик популярности по умолчанию запускается сразу, планировщики других профилей - при первом обращении
+popularity_scheduler = PopularityScheduler()
+popularity_schedulers = {(popularity_scheduler.store_path, popularity_scheduler.order_method): popularity_scheduler}
+# Документы альбома приходят отдельными сообщениями: копим их по media_group_id и обрабатываем одним пакетом
+MEDIA_GROUP_DELAY = 1.0  # Сколько секунд ждать остальные документы альбома
+media_groups = {}
+media_group_tasks = set()
+HISTORY_POINTS = 15  # Сколько последних дней ряда показывать в /history
 
 
 # --- ОБРАБОТЧИКИ СООБЩЕНИЙ ---
@@ -40,71 +71,272 @@ async def send_welcome(message: types.Message):
 
 
 @router.message(F.document)
-async def handle_document(message: types.Message):
+async def handle_document(message: types.Message, state: FSMContext):
     if not message.document.file_name.endswith(('.xls', '.xlsx')):
         logging.warning("Получен файл неверного формата.")
         return await message.answer("Пожалуйста, отправьте файл в формате .xls или .xlsx.")
 
     logging.info(f"Получен файл от пользователя {message.from_user.id}: {message.document.file_name}")
-    await message.answer("Файл получен, начинаю обработку...")
+    # Профиль, выбранный командой /supplier
+    chosen = (await state.get_data()).get('profile')
+    if task_queue is not None:
+        return await enqueue_document(message, chosen)
+    if message.media_group_id is None:
+        return await process_documents([message], chosen)
 
-    if not os.path.exists(TEMP_FOLDER):
-        os.makedirs(TEMP_FOLDER)
-        logging.info(f"Создана временная папка: {TEMP_FOLDER}")
+    group = media_groups.setdefault(message.media_group_id, [])
+    group.append(message)
+    if len(group) == 1:
+        task = asyncio.create_task(process_media_group(message.media_group_id, chosen))
+        media_group_tasks.add(task)
+        task.add_done_callback(media_group_tasks.discard)
 
-    output_file_name = None
+
+async def process_media_group(media_group_id, chosen):
+    await asyncio.sleep(MEDIA_GROUP_DELAY)
+    await process_documents(media_groups.pop(media_group_id), chosen)
+
+
+async def enqueue_document(message, chosen):
+    """
+    Ставит документ в общую очередь, не скачивая его: файл по file_id скачает процесс worker.py.
+    Документы альбома собираются в одну задачу самой очередью.
+    """
+    delay = MEDIA_GROUP_DELAY if message.media_group_id else 0.0
     try:
-        file_path = os.path.join(TEMP_FOLDER, message.document.file_name)
-        await bot.download(message.document, destination=file_path)
-        logging.info(f"Файл сохранен во временную папку: {file_path}")
-
-        output_file_name = process_excel_files(file_path)
-
-        if os.path.exists(output_file_name):
-            await message.answer_document(FSInputFile(output_file_name), caption="Вот ваш обработанный файл.")
-
-            keyboard = InlineKeyboardMarkup(inline_keyboard=[
-                [
-                    InlineKeyboardButton(text="✅", callback_data="send_email_yes"),
-                    InlineKeyboardButton(text="❌", callback_data="send_email_no")
-                ]
-            ])
-            await message.answer(
-                f"Отправить на почту {EMAIL_TO}?",
-                reply_markup=keyboard
-            )
-        else:
-            await message.answer(f"Произошла ошибка при обработке файла: {output_file_name}")
+        job_id, created = await asyncio.to_thread(
+            task_queue.put, message.from_user.id, message.chat.id, message.document.file_id,
+            message.document.file_name, chosen, message.media_group_id, delay)
+    except QueueFullError as e:
+        return await message.answer(str(e))
+    if created:
+        position = await asyncio.to_thread(task_queue.position, job_id)
+        status_message = await message.answer(f"Файл получен и поставлен в очередь, позиция: {position}.")
+        await asyncio.to_thread(task_queue.set_status_message, job_id, status_message.message_id)
+
+
+async def process_documents(messages, chosen=None):
+    """Обрабатывает один документ или альбом документов одной задачей в очереди."""
+    message = messages[0]
+    started = time.perf_counter()
+    if len(messages) == 1:
+        status_message = await message.answer("Файл получен, начинаю обработку...")
+    else:
+        status_message = await message.answer(f"Получено файлов: {len(messages)}, обрабатываю пакетом...")
+
+    try:
+        # Файлы скачиваются сразу в память, на диск ничего не пишется
+        inputs = []
+        for document_message in messages:
+            buffer = await bot.download(document_message.document)
+            inputs.append((document_message.document.file_name, buffer.getvalue()))
+            logging.info(f"Файл {document_message.document.file_name} загружен в память: "
+                         f"{len(inputs[-1][1])} байт")
+
+        if not processing_warmup.ready:
+            await status_message.edit_text("Бот только что запущен, подготавливаю обработку...")
+        await processing_warmup.wait()
+        from profiles import profile_registry
+
+        # Весь альбом обрабатывается по профилю первого файла
+        profile = profile_registry.resolve(message.from_user.id, inputs[0][0], chosen)
+        # Популярность берётся из фонового снимка профиля и не ждёт CRM
+        popularity_map = await announce_job(message.chat.id, profile, await scheduler_for(profile).get())
+
+        async def on_status(job, text):
+            await status_message.edit_text(text)
+
+        func, data = processing_call(inputs, profile)
+        try:
+            job = await job_queue.submit(message.from_user.id, func, data, popularity_map, on_status=on_status)
+        except QueueFullError as e:
+            return await message.answer(str(e))
+
+        try:
+            result = await job.wait()
+        except asyncio.CancelledError:
+            if job.status != STATUS_CANCELLED:
+                raise
+            return await message.answer("Обработка файла отменена.")
+
+        await deliver_results(message.chat.id, message.from_user.id, job.id, inputs, result, profile)
 
     except Exception as e:
         logging.error(f"Критическая ошибка в handle_document: {e}", exc_info=True)
         await message.answer(f"Произошла ошибка: {e}")
     finally:
-        pass
+        duration = time.perf_counter() - started
+        metrics.observe('stage_duration_seconds', duration, stage='handle_document')
+        logging.info(f"Стадия handle_document: {duration:.3f} с")
+
+
+def scheduler_for(profile):
+    """Планировщик популярности профиля; профили с общим хранилищем CRM делят один планировщик."""
+    key = (profile.crm_store, profile.crm_order_method)
+    scheduler = popularity_schedulers.get(key)
+    if scheduler is None:
+        scheduler = PopularityScheduler(store_path=profile.crm_store, order_method=profile.crm_order_method)
+        popularity_schedulers[key] = scheduler
+        scheduler.start()
+    return scheduler
+
+
+@router.message(Command("cancel"))
+async def cancel_jobs(message: types.Message):
+    if task_queue is not None:
+        cancelled = await asyncio.to_thread(task_queue.cancel, message.from_user.id)
+    else:
+        cancelled = job_queue.cancel(message.from_user.id)
+    if cancelled:
+        await message.answer(f"Отменено задач: {cancelled}.")
+    else:
+        await message.answer("У вас нет файлов в обработке.")
+
+
+@router.message(Command("status"))
+async def show_status(message: types.Message):
+    # С общей очередью задачи видны любой реплике бота, без неё - только локальному пулу
+    if task_queue is not None:
+        jobs = await asyncio.to_thread(task_queue.user_jobs, message.from_user.id)
+    else:
+        jobs = [(job.id, job.status, job_queue.position(job), []) for job in job_queue.user_jobs(message.from_user.id)]
+    if not jobs:
+        return await message.answer("У вас нет файлов в обработке.")
+
+    lines = []
+    for job_id, status, position, files in jobs:
+        name = ', '.join(files) or f"Задача {job_id}"
+        if status == STATUS_QUEUED:
+            lines.append(f"{name}: в очереди, позиция {position}.")
+        elif status == STATUS_RUNNING:
+            lines.append(f"{name}: обрабатывается.")
+        else:
+            lines.append(f"{name}: отменяется.")
+    await message.answer('\n'.join(lines))
+
+
+@router.message(Command("refresh"))
+async def refresh_popularity(message: types.Message, state: FSMContext):
+    await message.answer("Обновляю данные о популярности из CRM...")
+    profile_registry = await load_profile_registry()
+    chosen = (await state.get_data()).get('profile')
+    scheduler = scheduler_for(profile_registry.resolve(message.from_user.id, chosen=chosen))
+    if await scheduler.refresh():
+        await message.answer(f"Готово: {scheduler.snapshot.describe_age()}.")
+    elif scheduler.snapshot is not None:
+        await message.answer(f"CRM недоступна. Используются {scheduler.snapshot.describe_age()}.")
+    else:
+        await message.answer("CRM недоступна, данных о популярности нет.")
+
+
+@router.message(Command("supplier"))
+async def choose_supplier(message: types.Message, state: FSMContext):
+    """/supplier - список профилей, /supplier <имя> - обрабатывать следующие файлы по этому профилю."""
+    profile_registry = await load_profile_registry()
+    parts = message.text.split()
+    if len(parts) > 1:
+        if parts[1] not in profile_registry.profiles:
+            return await message.answer(f"Профиль {parts[1]} не найден.")
+        # Выбор хранится в состоянии пользователя, общем для реплик бота при FSM_STORAGE=sqlite
+        await state.update_data(profile=parts[1])
+        title = profile_registry.get(parts[1]).title
+        return await message.answer(f"Следующие файлы будут обработаны для поставщика {title}.")
+
+    current = profile_registry.resolve(message.from_user.id, chosen=(await state.get_data()).get('profile'))
+    lines = [f"{'• ' if profile is current else '  '}{profile.name} - {profile.title}"
+             for profile in profile_registry.profiles.values()]
+    await message.answer("Профили поставщиков:\n" + "\n".join(lines) + "\n\nВыбор: /supplier <имя>")
+
+
+@router.message(Command("history"))
+async def show_history(message: types.Message, state: FSMContext):
+    """
+    /history - растения, остаток которых убывает быстрее всего;
+    /history <растение или композиция> [дней] - ряд итоговых остатков и скорость расхода.
+    """
+    from history_archive import history_archive, depletion_rate, days_until_empty, HISTORY_DAYS
+    if not history_archive.enabled:
+        return await message.answer("Архив истории расчётов недоступен.")
+    profile_registry = await load_profile_registry()
+    profile = profile_registry.resolve(message.from_user.id, chosen=(await state.get_data()).get('profile'))
+
+    parts = message.text.split(maxsplit=1)
+    query = parts[1].strip() if len(parts) > 1 else ''
+    days = HISTORY_DAYS
+    words = query.rsplit(maxsplit=1)
+    if words and words[-1].isdigit():
+        days = int(words[-1])
+        query = words[0] if len(words) > 1 else ''
+
+    if not query:
+        ranking = await asyncio.to_thread(history_archive.depletion, profile.name, days)
+        if not ranking:
+            return await message.answer(f"За {days} дн. нет растений с убывающим остатком.")
+        lines = [f"{plant}: {-rate:.1f} в день, сейчас {last:g}"
+                 + (f", закончится через {left:.0f} дн." if left is not None else "")
+                 for plant, rate, last, left in ranking]
+        return await message.answer(f"Быстрее всего расходуются за {days} дн.:\n" + "\n".join(lines)
+                                    + "\n\nРяд по растению: /history <название> [дней]")
+
+    points = await asyncio.to_thread(history_archive.series, profile.name, query, days)
+    if not points:
+        return await message.answer(f"Нет расчётов для «{query}» за {days} дн.")
+    lines = [f"{day[8:10]}.{day[5:7]}: {value:g}" for day, value in points[-HISTORY_POINTS:]]
+    text = f"Остаток «{query}» за {days} дн. (дней с расчётами: {len(points)}):\n" + "\n".join(lines)
+    rate = depletion_rate(points)
+    if rate is not None:
+        text += f"\n\nИзменение: {rate:+.1f} в день"
+        left = days_until_empty(points, rate)
+        if left is not None:
+            text += f", закончится примерно через {left:.0f} дн."
+    await message.answer(text)
+
+
+@router.message(Command("stats"))
+async def show_stats(message: types.Message):
+    if message.from_user.id not in ADMIN_IDS:
+        return
+    await message.answer(metrics.summary())
+
+
+@router.message(Command("profile"))
+async def enable_profiling(message: types.Message):
+    if message.from_user.id not in ADMIN_IDS:
+        return
+    parts = message.text.split()
+    jobs = int(parts[1]) if len(parts) > 1 and parts[1].isdigit() else 1
+    metrics.profile_next(jobs)
+    await message.answer(f"Профилирование включено для следующих задач: {jobs}.")
 
 
 @router.callback_query(F.data.startswith('send_email_'))
 async def handle_email_request(callback_query: types.CallbackQuery):
-    output_file_name = None
+    message = callback_query.message
     try:
-        message = callback_query.message
-        user_choice = callback_query.data.split('_')[-1]
+        # callback_data: send_email_<yes|no>_<id задачи>[-<номер файла в пакете>]
+        parts = callback_query.data.split('_')
+        user_choice = parts[2]
+        job_id = parts[3] if len(parts) > 3 else ''
 
         await callback_query.answer()
 
-        file_list = [f for f in os.listdir('.') if
-                     f.startswith('Остатки ИП Лесковский') and f != 'Остатки ИП Лесковский.xlsx']
-        if file_list:
-            output_file_name = max(file_list, key=os.path.getmtime)
+        # Отчёт берётся из реестра по id задачи, поэтому искать файл на диске не нужно
+        report = await asyncio.to_thread(job_registry.get, job_id)
+        await asyncio.to_thread(job_registry.delete, job_id)
 
         if user_choice == 'yes':
-            if output_file_name and os.path.exists(output_file_name):
-                if await send_email_with_attachment(output_file_name):
-                    await message.answer(f"Файл успешно отправлен на почту {EMAIL_TO}.")
+            if report is not None:
+                recipients = report_recipients(report)
+                result = await send_email_with_attachment(report.file_name, report.content, recipients)
+                if result == SEND_SENT:
+                    await message.answer(f"Файл успешно отправлен на почту {', '.join(recipients)}.")
+                elif result == SEND_QUEUED:
+                    await message.answer(f"Почтовый сервер пока не принял письмо. Отправка на {', '.join(recipients)} "
+                                         f"продолжится автоматически, файл придёт позже.")
                 else:
                     await message.answer("Не удалось отправить файл. Проверьте логи.")
             else:
-                logging.warning(f"Файл для отправки не найден: {output_file_name}")
+                logging.warning(f"Отчёт задачи {job_id} не найден (уже отправлен или срок хранения истёк).")
                 await message.answer("Ошибка: не удалось найти файл для отправки.")
         else:
             logging.info("Пользователь выбрал 'нет'. Отправка отменена.")
@@ -113,16 +345,56 @@ async def handle_email_request(callback_query: types.CallbackQuery):
     except Exception as e:
         logging.error(f"Критическая ошибка в handle_email_request: {e}", exc_info=True)
         await message.answer(f"Произошла ошибка при обработке запроса: {e}")
-    finally:
-        if os.path.exists(TEMP_FOLDER):
-            shutil.rmtree(TEMP_FOLDER)
-            logging.info(f"Временная папка '{TEMP_FOLDER}' удалена.")
-        if output_file_name and os.path.exists(output_file_name):
-            os.remove(output_file_name)
-            logging.info(f"Обработанный файл '{output_file_name}' удален.")
+
+
+async def load_profile_registry():
+    """Реестр профилей; profiles подтягивает pandas, поэтому первый импорт выполняется в потоке."""
+    def load():
+        from profiles import profile_registry
+        return profile_registry
+
+    return await asyncio.to_thread(load)
+
+
+async def start_profile_schedulers():
+    """Запускает фоновое обновление популярности для всех профилей."""
+    try:
+        for profile in (await load_profile_registry()).profiles.values():
+            scheduler_for(profile)
+    except Exception as e:
+        logging.error(f"Не удалось запустить обновление популярности профилей: {e}", exc_info=True)
+
+
+def report_recipients(report):
+    """Получатели профиля, по которому сделан отчёт; если профиль уже удалён из конфигурации - EMAIL_TO."""
+    from profiles import profile_registry
+    if report.profile in profile_registry.profiles:
+        return profile_registry.get(report.profile).email_to
+    return parse_recipients(EMAIL_TO)
 
 
 # --- ЗАПУСК БОТА ---
+async def run_webhook():
+    """
+    Принимает обновления по webhook. Ответ Telegram отправляется сразу, обработчики выполняются в фоне,
+    поэтому медленный обработчик не задерживает следующие обновления.
+    """
+    app = web.Application()
+    SimpleRequestHandler(dispatcher=dp, bot=bot, secret_token=WEBHOOK_SECRET).register(app, path=WEBHOOK_PATH)
+    setup_application(app, dp, bot=bot)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT).start()
+    logging.info(f"Webhook принимает обновления на {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+    try:
+        if WEBHOOK_URL:
+            # Каждая реплика регистрирует один и тот же адрес, повторная регистрация безвредна
+            await bot.set_webhook(f"{WEBHOOK_URL}{WEBHOOK_PATH}", secret_token=WEBHOOK_SECRET)
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
+
 async def main() -> None:
     dp.include_router(router)
     if BOT_TOKEN is None:
@@ -130,8 +402,35 @@ async def main() -> None:
         print(
             "Ошибка: Токен бота не найден. Пожалуйста, убедитесь, что вы создали файл .env и добавили в него BOT_TOKEN.")
         return
-    logging.info("Бот запущен. Ожидание сообщений...")
-    await dp.start_polling(bot)
+    job_queue.start()
+    popularity_scheduler.start()
+    job_registry.start_janitor()
+    mail_sender.start()
+    metrics_runner = await start_metrics_server(metrics)
+    # С общей очередью обработка идёт в worker.py, и прогревать стек обработки в боте незачем
+    if task_queue is None:
+        processing_warmup.start()
+        if STARTUP_MODE == 'eager':
+            await processing_warmup.wait()
+    profile_schedulers = asyncio.create_task(start_profile_schedulers())
+    startup = time.perf_counter() - STARTED_AT
+    metrics.set_gauge('startup_seconds', startup)
+    logging.info(f"Бот запущен за {startup:.3f} с (режим {STARTUP_MODE}, {BOT_MODE}). Ожидание сообщений...")
+    try:
+        if BOT_MODE == 'webhook':
+            await run_webhook()
+        else:
+            await dp.start_polling(bot)
+    finally:
+        await asyncio.gather(profile_schedulers, return_exceptions=True)
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
+        await mail_sender.stop()
+        await job_registry.stop_janitor()
+        for scheduler in popularity_schedulers.values():
+            await scheduler.stop()
+        await crm_client.close()
+        await job_queue.stop()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,182 @@
+import os
+import time
+import bisect
+import cProfile
+import logging
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+from aiohttp import web
+from dotenv import load_dotenv
+
+# --- ЗАГРУЗКА ПЕРЕМЕННЫХ ИЗ .ENV ---
+load_dotenv()
+# Порт HTTP-эндпоинта /metrics в формате Prometheus (не задан - эндпоинт не запускается)
+METRICS_PORT = os.getenv("METRICS_PORT")
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+# Папка для профилей cProfile, включаемых командой /profile
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profile_dumps")
+
+METRICS_PREFIX = 'komus_bot_'
+DURATION_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+
+class Span:
+    """Запущенная стадия: длительность измеряется автоматически, счётчики добавляются через add()."""
+
+    def __init__(self, registry, name):
+        self.registry = registry
+        self.name = name
+        self.duration = None
+
+    def add(self, counter, value=1):
+        """Увеличивает счётчик <counter>_total, привязанный к стадии."""
+        self.registry.inc(f'{counter}_total', value, stage=self.name)
+
+
+class Metrics:
+    """
+    Счётчики и гистограммы длительностей стадий обработки.
+    Потокобезопасны: стадии выполняются и в event loop, и в пуле обработки.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+        self._gauges = {}
+        self._profile_remaining = 0
+
+    # --- ЗАПИСЬ ---
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def set_gauge(self, name, value, **labels):
+        with self._lock:
+            self._gauges[(name, tuple(sorted(labels.items())))] = value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = {'buckets': [0] * len(DURATION_BUCKETS), 'sum': 0.0, 'count': 0}
+            index = bisect.bisect_left(DURATION_BUCKETS, value)
+            if index < len(DURATION_BUCKETS):
+                histogram['buckets'][index] += 1
+            histogram['sum'] += value
+            histogram['count'] += 1
+
+    @contextmanager
+    def span(self, name):
+        """Измеряет длительность стадии name и пишет её в лог и гистограмму stage_duration_seconds."""
+        span = Span(self, name)
+        started = time.perf_counter()
+        status = 'ok'
+        try:
+            yield span
+        except BaseException:
+            status = 'error'
+            raise
+        finally:
+            span.duration = time.perf_counter() - started
+            self.observe('stage_duration_seconds', span.duration, stage=name)
+            self.inc('stage_runs_total', stage=name, status=status)
+            logging.info(f"Стадия {name}: {span.duration:.3f} с ({status})")
+
+    # --- ПРОФИЛИРОВАНИЕ ---
+    def profile_next(self, jobs):
+        """Включает cProfile для следующих jobs задач обработки."""
+        with self._lock:
+            self._profile_remaining = jobs
+
+    @contextmanager
+    def maybe_profile(self, name):
+        """Профилирует блок, если профилирование включено командой /profile; профиль сохраняется в PROFILE_DIR."""
+        with self._lock:
+            enabled = self._profile_remaining > 0
+            if enabled:
+                self._profile_remaining -= 1
+        if not enabled:
+            yield
+            return
+
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            os.makedirs(PROFILE_DIR, exist_ok=True)
+            path = os.path.join(PROFILE_DIR, f"{name}_{datetime.now().strftime('%Y%m%d_%H%M%S_%f')}.prof")
+            profiler.dump_stats(path)
+            logging.info(f"Профиль сохранён: {path}")
+
+    # --- ВЫВОД ---
+    def render_prometheus(self):
+        """Все метрики в текстовом формате Prometheus."""
+        lines = []
+        with self._lock:
+            for (name, labels), value in sorted(self._counters.items()):
+                lines.append(f'{METRICS_PREFIX}{name}{_format_labels(labels)} {value}')
+            for (name, labels), value in sorted(self._gauges.items()):
+                lines.append(f'{METRICS_PREFIX}{name}{_format_labels(labels)} {value}')
+            for (name, labels), histogram in sorted(self._histograms.items()):
+                cumulative = 0
+                for bound, count in zip(DURATION_BUCKETS, histogram['buckets']):
+                    cumulative += count
+                    lines.append(f'{METRICS_PREFIX}{name}_bucket{_format_labels(labels + (("le", bound),))} '
+                                 f'{cumulative}')
+                lines.append(f'{METRICS_PREFIX}{name}_bucket{_format_labels(labels + (("le", "+Inf"),))} '
+                             f'{histogram["count"]}')
+                lines.append(f'{METRICS_PREFIX}{name}_sum{_format_labels(labels)} {histogram["sum"]}')
+                lines.append(f'{METRICS_PREFIX}{name}_count{_format_labels(labels)} {histogram["count"]}')
+        return '\n'.join(lines) + '\n'
+
+    def summary(self):
+        """Короткая сводка для команды /stats: среднее время стадий и счётчики."""
+        lines = []
+        with self._lock:
+            for (name, labels), histogram in sorted(self._histograms.items()):
+                if name != 'stage_duration_seconds' or not histogram['count']:
+                    continue
+                stage = dict(labels).get('stage')
+                average = histogram['sum'] / histogram['count']
+                lines.append(f"{stage}: {histogram['count']} раз, в среднем {average:.2f} с")
+            for (name, labels), value in sorted(self._counters.items()):
+                if name == 'stage_runs_total':
+                    continue
+                label_text = ', '.join(f'{key}={val}' for key, val in labels)
+                lines.append(f"{name}{f' ({label_text})' if label_text else ''}: {value:g}")
+            for (name, labels), value in sorted(self._gauges.items()):
+                lines.append(f"{name}: {value:g}")
+        return '\n'.join(lines) or "Пока нет данных."
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{value}"' for key, value in labels) + '}'
+
+
+async def start_metrics_server(registry, port=METRICS_PORT, host=METRICS_HOST):
+    """Запускает HTTP-эндпоинт /metrics. Возвращает runner для остановки или None, если порт не задан."""
+    if not port:
+        return None
+
+    async def handle_metrics(request):
+        return web.Response(text=registry.render_prometheus(), content_type='text/plain', charset='utf-8')
+
+    app = web.Application()
+    app.router.add_get('/metrics', handle_metrics)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, int(port)).start()
+    logging.info(f"Метрики доступны на http://{host}:{port}/metrics")
+    return runner
+
+
+# Общий реестр метрик процесса
+metrics = Metrics()
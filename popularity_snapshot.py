@@ -0,0 +1,128 @@
+import os
+import asyncio
+import logging
+from datetime import datetime, timedelta
+from dotenv import load_dotenv
+
+from crm_connector import (fetch_crm_popularity, PopularityStore, CRM_POPULARITY_DAYS, CRM_STORE_PATH,
+                           CRM_ORDER_METHOD)
+
+# --- ЗАГРУЗКА ПЕРЕМЕННЫХ ИЗ .ENV ---
+load_dotenv()
+# Интервал фонового обновления популярности, в секундах
+POPULARITY_REFRESH_INTERVAL = int(os.getenv("POPULARITY_REFRESH_INTERVAL", "900"))
+
+
+class PopularitySnapshot:
+    """Последний успешно полученный словарь популярности и время его получения."""
+
+    def __init__(self, data, fetched_at, stale=False):
+        self.data = data
+        self.fetched_at = fetched_at
+        # True, если последнее обновление не удалось и используется предыдущий снимок
+        self.stale = stale
+
+    @property
+    def id(self):
+        """Идентификатор снимка - время получения данных."""
+        return self.fetched_at.strftime('%Y%m%d%H%M%S')
+
+    def describe_age(self):
+        minutes = int((datetime.now() - self.fetched_at).total_seconds() // 60)
+        text = f"данные CRM от {self.fetched_at.strftime('%d.%m %H:%M')} ({minutes} мин назад)"
+        if self.stale:
+            text += ", CRM сейчас недоступна"
+        return text
+
+
+class PopularityScheduler:
+    """
+    Фоновая задача в event loop бота: периодически обновляет популярность из CRM
+    и хранит последний удачный снимок, чтобы загрузки не ждали CRM.
+    У каждого профиля свой планировщик: свой способ оформления заказов и своё хранилище.
+    """
+
+    def __init__(self, interval=POPULARITY_REFRESH_INTERVAL, store_path=CRM_STORE_PATH, order_method=CRM_ORDER_METHOD):
+        self.interval = interval
+        self.store_path = store_path
+        self.order_method = order_method
+        self.snapshot = None
+        self._task = None
+        self._refresh_lock = asyncio.Lock()
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+            logging.info(f"Фоновое обновление популярности запущено, интервал {self.interval} с.")
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def refresh(self):
+        """Обновляет снимок из CRM. Возвращает True, если данные получены."""
+        async with self._refresh_lock:
+            store = await asyncio.to_thread(PopularityStore, self.store_path)
+            popularity_map = await fetch_crm_popularity(store, self.order_method)
+            if popularity_map is not None:
+                self.snapshot = PopularitySnapshot(popularity_map, datetime.now())
+                logging.info(f"Снимок популярности обновлён: {len(popularity_map)} композиций.")
+                return True
+
+            if self.snapshot is not None:
+                self.snapshot.stale = True
+                logging.warning(f"CRM недоступна, используется старый снимок: {self.snapshot.describe_age()}")
+            else:
+                self.snapshot = await asyncio.to_thread(self._load_from_store, True)
+            return False
+
+    async def get(self):
+        """
+        Текущий снимок или None, если его ещё нет. Загрузка никогда не ждёт CRM: снимок
+        заполняет фоновая задача - сначала из локального хранилища, затем из CRM.
+        """
+        return self.snapshot
+
+    async def _run(self):
+        if self.snapshot is None:
+            # Пока идёт первая синхронизация с CRM, загрузки получают популярность прошлой синхронизации
+            snapshot = await asyncio.to_thread(self._load_from_store, False)
+            if self.snapshot is None:  # /refresh мог успеть раньше
+                self.snapshot = snapshot
+        while True:
+            try:
+                await self.refresh()
+            except Exception as e:
+                logging.error(f"Ошибка фонового обновления популярности: {e}", exc_info=True)
+            await asyncio.sleep(self.interval)
+
+    def _load_from_store(self, stale):
+        """
+        Снимок из локального хранилища заказов прошлой синхронизации: при старте, до первого ответа CRM,
+        или если CRM недоступна (stale=True).
+        """
+        snapshot = load_store_snapshot(self.store_path, stale=stale)
+        if snapshot is not None:
+            reason = "CRM недоступна" if stale else "до синхронизации с CRM"
+            logging.warning(f"Популярность взята из локального хранилища ({reason}): {snapshot.describe_age()}.")
+        return snapshot
+
+
+def load_store_snapshot(store_path, stale=False):
+    """
+    Снимок популярности из локального хранилища заказов на момент последней синхронизации или None.
+    Так популярность получают процессы worker.py: синхронизацию с CRM ведёт процесс бота.
+    """
+    try:
+        store = PopularityStore(store_path)
+        watermark = store.get_watermark()
+        if not watermark:
+            return None
+        window_from = datetime.now() - timedelta(days=CRM_POPULARITY_DAYS)
+        data = store.popularity(window_from.strftime('%Y-%m-%d'))
+    except Exception as e:
+        logging.error(f"Не удалось прочитать хранилище популярности: {e}")
+        return None
+    return PopularitySnapshot(data, datetime.strptime(watermark, '%Y-%m-%d %H:%M:%S'), stale=stale)
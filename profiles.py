@@ -0,0 +1,120 @@
+import os
+import re
+import json
+import logging
+from dotenv import load_dotenv
+
+from crm_connector import CRM_STORE_PATH, CRM_ORDER_METHOD
+from email_sender import EMAIL_TO, parse_recipients
+from reference_cache import ReferenceCache, reference_cache, FILE_OST_KOMUS, KOMUS_LIST_1, KOMUS_LIST_2
+from report_writer import TemplateCache, default_template_cache, FILE_OST_LESKOVSKY, LESKOVSKY_SHEET
+
+# --- ЗАГРУЗКА ПЕРЕМЕННЫХ ИЗ .ENV ---
+load_dotenv()
+# Файл с профилями поставщиков (пример - profiles.example.json). Если файла нет, работает один профиль
+# с настройками по умолчанию (Комус -> ИП Лесковский)
+PROFILES_PATH = os.getenv("PROFILES_PATH", "profiles.json")
+
+# --- НАСТРОЙКИ ПРОФИЛЯ ПО УМОЛЧАНИЮ ---
+DEFAULT_PROFILE_NAME = 'komus'
+REPORT_RANGE = 'D13:F83'
+REPORT_COPY_RANGE = 'F13:F74'
+OUTPUT_NAME = 'Остатки ИП Лесковский'
+
+
+class Profile:
+    """
+    Пара "справочник поставщика - шаблон отчёта" со своими диапазонами, способом заказа в CRM
+    и получателями. Кэши справочника и шаблона общие для всех задач профиля.
+    """
+
+    def __init__(self, name, title=None, reference=FILE_OST_KOMUS, reference_sheets=(KOMUS_LIST_1, KOMUS_LIST_2),
+                 template=FILE_OST_LESKOVSKY, template_sheet=LESKOVSKY_SHEET, output_name=OUTPUT_NAME,
+                 report_range=REPORT_RANGE, report_copy_range=REPORT_COPY_RANGE,
+                 crm_order_method=CRM_ORDER_METHOD, crm_store=None, email_to=None, users=(), file_pattern=None):
+        self.name = name
+        self.title = title or name
+        self.reference = reference
+        self.reference_sheets = tuple(reference_sheets)
+        self.template = template
+        self.template_sheet = template_sheet
+        self.output_name = output_name
+        self.report_range = report_range
+        self.report_copy_range = report_copy_range
+        self.crm_order_method = crm_order_method
+        # У каждого профиля своё хранилище заказов CRM
+        if crm_store is None:
+            crm_store = CRM_STORE_PATH if name == DEFAULT_PROFILE_NAME else f"crm_popularity_{name}.sqlite"
+        self.crm_store = crm_store
+        self.email_to = email_to or parse_recipients(EMAIL_TO)
+        # Пользователи Telegram, чьи файлы по умолчанию относятся к профилю
+        self.users = set(users)
+        # Регулярное выражение для имени загруженного файла
+        self.file_pattern = re.compile(file_pattern, re.IGNORECASE) if file_pattern else None
+
+        # Профиль с файлами по умолчанию использует общие кэши процесса
+        if (reference, self.reference_sheets) == (FILE_OST_KOMUS, (KOMUS_LIST_1, KOMUS_LIST_2)):
+            self.reference_cache = reference_cache
+        else:
+            self.reference_cache = ReferenceCache(reference, self.reference_sheets)
+        self.template_cache = default_template_cache if template == FILE_OST_LESKOVSKY else TemplateCache(template)
+
+    @property
+    def cache_key(self):
+        """Настройки профиля, от которых зависит результат (для ключа кэша результатов)."""
+        return f"{self.report_range}|{self.report_copy_range}|{self.template_sheet}"
+
+
+class ProfileRegistry:
+    """Профили по имени и выбор профиля для загруженного файла."""
+
+    def __init__(self, profiles, default_name):
+        self.profiles = profiles
+        self.default_name = default_name
+
+    @property
+    def default(self):
+        return self.profiles[self.default_name]
+
+    def get(self, name=None):
+        """Профиль по имени (None - профиль по умолчанию). Бросает KeyError для неизвестного имени."""
+        return self.profiles[name or self.default_name]
+
+    def resolve(self, user_id, file_name=None, chosen=None):
+        """
+        Профиль для файла пользователя: выбранный командой /supplier (chosen - имя из состояния пользователя),
+        затем профиль, к которому привязан пользователь, затем профиль с подходящим шаблоном имени файла,
+        иначе профиль по умолчанию.
+        """
+        if chosen in self.profiles:
+            return self.profiles[chosen]
+        for profile in self.profiles.values():
+            if user_id in profile.users:
+                return profile
+        if file_name:
+            for profile in self.profiles.values():
+                if profile.file_pattern and profile.file_pattern.search(file_name):
+                    return profile
+        return self.default
+
+
+def load_profiles(path=PROFILES_PATH):
+    """
+    Читает профили из JSON-файла вида {"default": "имя", "profiles": {"имя": {настройки Profile}}}.
+    Если файла нет - реестр из одного профиля по умолчанию.
+    """
+    if not os.path.exists(path):
+        return ProfileRegistry({DEFAULT_PROFILE_NAME: Profile(DEFAULT_PROFILE_NAME)}, DEFAULT_PROFILE_NAME)
+
+    with open(path, encoding='utf-8') as f:
+        config = json.load(f)
+    profiles = {name: Profile(name, **settings) for name, settings in config['profiles'].items()}
+    default_name = config.get('default') or next(iter(profiles))
+    if default_name not in profiles:
+        raise ValueError(f"Профиль по умолчанию '{default_name}' не описан в {path}")
+    logging.info(f"Загружены профили из {path}: {', '.join(profiles)} (по умолчанию {default_name})")
+    return ProfileRegistry(profiles, default_name)
+
+
+# Общий реестр профилей процесса
+profile_registry = load_profiles()
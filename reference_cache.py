@@ -0,0 +1,137 @@
+import os
+import json
+import hashlib
+import logging
+import threading
+import pandas as pd
+
+from reference_index import load_or_build_index
+from reference_snapshot import snapshot_path, load_snapshot, write_snapshot
+
+# --- КОНСТАНТЫ ---
+FILE_OST_KOMUS = 'Остатки_Комус.xlsx'
+KOMUS_LIST_1 = 'счет остатков new (копия)'
+KOMUS_COLUMNS_1 = [0, 1, 2]
+KOMUS_LIST_2 = 'Состав композиций (копия)'
+# Загружаем колонки: [2] Состав композиции (для calculate_formulas), [4] Название в СРМ, [5] Название растений
+KOMUS_COLUMNS_FOR_ROUNDING = [2, 4, 5]
+COL_INDEX_COMPOSITION_KEY = 0  # Индекс 0 в новом фрейме komus_df_2_all (Состав композиции)
+COL_INDEX_CRM_NAME = 1  # Индекс 1 в новом фрейме komus_df_2_all (Название в СРМ)
+COL_INDEX_PLANT_NAME = 2  # Индекс 2 в новом фрейме komus_df_2_all (Название растений)
+
+
+class ReferenceData:
+    """
+    Разобранный справочник Остатки_Комус.xlsx: оба листа и заранее
+    посчитанные данные для calculate_formulas.
+    """
+
+    def __init__(self, komus_df_1, komus_df_2_all, countif_dict, mtime, digest, index=None):
+        self.komus_df_1 = komus_df_1
+        self.komus_df_2_all = komus_df_2_all
+        # Количество вхождений каждого артикула в "Состав композиций" (СЧЁТЕСЛИ)
+        self.countif_dict = countif_dict
+        # Скомпилированный индекс для расчёта по целочисленным кодам (ReferenceIndex)
+        self.index = index
+        self.mtime = mtime
+        # Хэш книги; индекс справочника строится по ключу из хэша и параметров чтения (см. source_key)
+        self.digest = digest
+
+
+class ReferenceCache:
+    """
+    Держит справочник в памяти и перечитывает его, только если файл заменили:
+    сначала сравнивается mtime, а при его изменении - хэш содержимого.
+    Если рядом с книгой есть актуальный снимок (см. import_reference.py), данные берутся из него.
+    """
+
+    def __init__(self, path=FILE_OST_KOMUS, sheets=(KOMUS_LIST_1, KOMUS_LIST_2)):
+        self.path = path
+        # Листы справочника: (остатки по артикулам, состав композиций)
+        self.sheets = sheets
+        self._data = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        """Возвращает актуальный ReferenceData, при необходимости перечитывая файл."""
+        with self._lock:
+            stat = os.stat(self.path)
+            if self._data is not None and self._data.mtime == (stat.st_mtime_ns, stat.st_size):
+                return self._data
+
+            digest = file_digest(self.path)
+            if self._data is not None and self._data.digest == digest:
+                # Файл перезаписан тем же содержимым - разбирать заново не нужно
+                self._data.mtime = (stat.st_mtime_ns, stat.st_size)
+                return self._data
+
+            self._data = self._load((stat.st_mtime_ns, stat.st_size), digest)
+            return self._data
+
+    def invalidate(self):
+        with self._lock:
+            self._data = None
+
+    def _load(self, mtime, digest):
+        params = read_params(self.sheets)
+        frames = load_snapshot(snapshot_path(self.path), digest, params)
+        if frames is not None:
+            logging.info(f"Загрузка справочника {self.path} из снимка...")
+            komus_df_1, komus_df_2_all = frames['komus_df_1'], frames['komus_df_2_all']
+        else:
+            logging.info(f"Загрузка справочника {self.path} в кэш (снимка нет, читается книга)...")
+            komus_df_1, komus_df_2_all = read_reference_workbook(self.path, self.sheets)
+
+        countif_dict = komus_df_2_all.iloc[:, COL_INDEX_COMPOSITION_KEY].value_counts().to_dict()
+        index = load_or_build_index(self.path, komus_df_1, komus_df_2_all, source_key(digest, params),
+                                    COL_INDEX_COMPOSITION_KEY, COL_INDEX_CRM_NAME, COL_INDEX_PLANT_NAME)
+        logging.info(
+            f"Справочник загружен: {len(komus_df_1)} артикулов, {len(komus_df_2_all)} композиций.")
+        return ReferenceData(komus_df_1, komus_df_2_all, countif_dict, mtime, digest, index)
+
+
+def read_reference_workbook(path=FILE_OST_KOMUS, sheets=(KOMUS_LIST_1, KOMUS_LIST_2)):
+    """Читает нужные колонки обоих листов справочника за один проход по книге."""
+    with pd.ExcelFile(path) as workbook:
+        komus_df_1 = workbook.parse(sheets[0], header=None, usecols=KOMUS_COLUMNS_1, skiprows=1)
+        komus_df_2_all = workbook.parse(sheets[1], header=None, usecols=KOMUS_COLUMNS_FOR_ROUNDING, skiprows=1)
+    return komus_df_1, komus_df_2_all
+
+
+def export_snapshot(path=FILE_OST_KOMUS, sheets=(KOMUS_LIST_1, KOMUS_LIST_2)):
+    """Строит снимок справочника рядом с книгой. Возвращает (путь к снимку, метаданные)."""
+    digest = file_digest(path)
+    komus_df_1, komus_df_2_all = read_reference_workbook(path, sheets)
+    target = snapshot_path(path)
+    meta = write_snapshot(target, {'komus_df_1': komus_df_1, 'komus_df_2_all': komus_df_2_all}, digest,
+                          read_params(sheets))
+    return target, meta
+
+
+def read_params(sheets):
+    """
+    Параметры, с которыми из книги получены фреймы справочника и его индекс. Снимок и индекс лежат рядом
+    с книгой, поэтому профиль с другими листами той же книги не должен принять их за свои.
+    """
+    return {
+        'sheets': list(sheets),
+        'columns': [KOMUS_COLUMNS_1, KOMUS_COLUMNS_FOR_ROUNDING],
+        'index_columns': [COL_INDEX_COMPOSITION_KEY, COL_INDEX_CRM_NAME, COL_INDEX_PLANT_NAME],
+    }
+
+
+def source_key(digest, params):
+    """Ключ актуальности индекса: хэш книги вместе с параметрами её чтения."""
+    return hashlib.sha256(json.dumps([digest, params], ensure_ascii=False).encode('utf-8')).hexdigest()
+
+
+def file_digest(path):
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+# Общий кэш процесса
+reference_cache = ReferenceCache()
@@ -0,0 +1,116 @@
+import os
+import logging
+import numpy as np
+import pandas as pd
+
+# --- КОНСТАНТЫ ---
+INDEX_VERSION = 1  # Увеличивается при изменении состава массивов индекса
+INDEX_SUFFIX = '.index.npz'
+INDEX_ARRAYS = ('item_rows', 'item_counts', 'crm_codes', 'crm_names', 'plant_codes')
+
+
+class ReferenceIndex:
+    """
+    Скомпилированный индекс справочника: артикулы, названия в CRM и растения заменены
+    целочисленными кодами, поэтому ВПР, СЧЁТЕСЛИ и поиск популярности сводятся к индексации массивов.
+    Все массивы, кроме crm_names, идут в порядке строк листа "Состав композиций".
+    """
+
+    def __init__(self, item_rows, item_counts, crm_codes, crm_names, plant_codes, digest):
+        # Строка листа остатков, из которой ВПР берёт остаток композиции (-1 - артикул не найден)
+        self.item_rows = item_rows
+        # СЧЁТЕСЛИ: сколько раз артикул композиции встречается в "Составе композиций"
+        self.item_counts = item_counts
+        # Код названия в CRM (-1 - названия нет) и таблица названий по кодам
+        self.crm_codes = crm_codes
+        self.crm_names = crm_names
+        # Код группы по названию растения (-1 - растение не указано)
+        self.plant_codes = plant_codes
+        self.digest = digest
+        # Пара (снимок популярности, популярность по кодам) подменяется одним присваиванием:
+        # индекс общий для потоков, и они не должны увидеть снимок от одного словаря, а массив от другого
+        self._popularity_cache = (None, None)
+
+    def popularity(self, popularity_map):
+        """
+        Популярность для каждой строки "Состава композиций" (0, если названия нет в CRM).
+        Снимок популярности раскладывается по кодам один раз и переиспользуется, пока не сменится.
+        """
+        source, by_code = self._popularity_cache
+        if popularity_map is not source:
+            by_code = pd.Series(self.crm_names, dtype=object).map(popularity_map).fillna(0).to_numpy(dtype=float)
+            self._popularity_cache = (popularity_map, by_code)
+        popularity = np.zeros(len(self.crm_codes), dtype=float)
+        known = self.crm_codes >= 0
+        popularity[known] = by_code[self.crm_codes[known]]
+        return popularity
+
+    def save(self, path):
+        """Сохраняет индекс без pickle. Файл подменяется атомарно: параллельные процессы не увидят его недописанным."""
+        arrays = {name: getattr(self, name) for name in INDEX_ARRAYS}
+        arrays['crm_names'] = self.crm_names.astype(str)
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        with open(temp_path, 'wb') as f:
+            np.savez(f, version=INDEX_VERSION, digest=self.digest, **arrays)
+        os.replace(temp_path, path)
+
+
+def build_index(komus_df_1, komus_df_2_all, digest, key_column, crm_column, plant_column):
+    """Строит индекс по обоим листам справочника (см. ReferenceIndex)."""
+    items = komus_df_2_all.iloc[:, key_column].reset_index(drop=True)
+
+    # Как и ВПР в calculate_formulas: при повторе артикула берётся последняя строка, NaN-артикулы не находятся
+    rows = pd.Series(np.arange(len(komus_df_1)), index=komus_df_1.iloc[:, 1].to_numpy())
+    rows = rows[rows.index.notna() & ~rows.index.duplicated(keep='last')]
+    item_rows = items.map(rows).fillna(-1).to_numpy(dtype=np.int64)
+    item_counts = items.map(items.value_counts()).astype(float).fillna(0).to_numpy()
+
+    crm_codes, crm_names = pd.factorize(komus_df_2_all.iloc[:, crm_column])
+    plant_codes, _ = pd.factorize(komus_df_2_all.iloc[:, plant_column])
+    return ReferenceIndex(item_rows, item_counts, crm_codes.astype(np.int64), np.asarray(crm_names, dtype=object),
+                          plant_codes.astype(np.int64), digest)
+
+
+def index_path(workbook_path):
+    """Файл индекса лежит рядом с книгой: Остатки_Комус.xlsx -> Остатки_Комус.index.npz."""
+    return os.path.splitext(workbook_path)[0] + INDEX_SUFFIX
+
+
+def load_index(path, digest, rows_count):
+    """Загружает индекс, если он построен для книги с тем же хэшем и той же версии. Иначе None."""
+    try:
+        with np.load(path, allow_pickle=False) as data:
+            if int(data['version']) != INDEX_VERSION or str(data['digest']) != digest:
+                return None
+            arrays = {name: data[name] for name in INDEX_ARRAYS}
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        logging.warning(f"Не удалось прочитать индекс справочника {path}: {e}")
+        return None
+
+    if len(arrays['item_rows']) != rows_count:
+        return None
+    arrays['crm_names'] = arrays['crm_names'].astype(object)
+    return ReferenceIndex(digest=digest, **arrays)
+
+
+def load_or_build_index(workbook_path, komus_df_1, komus_df_2_all, digest, key_column, crm_column, plant_column):
+    """Индекс из файла рядом с книгой; если его нет или он устарел - строит заново и сохраняет."""
+    path = index_path(workbook_path)
+    index = load_index(path, digest, len(komus_df_2_all))
+    if index is not None:
+        logging.info(f"Индекс справочника загружен из {path}")
+        return index
+
+    index = build_index(komus_df_1, komus_df_2_all, digest, key_column, crm_column, plant_column)
+    if not all(isinstance(name, str) for name in index.crm_names):
+        # Названия сохраняются без pickle, поэтому индекс с нестроковыми названиями живёт только в памяти
+        logging.info("Индекс справочника построен в памяти (названия в CRM не только строки).")
+        return index
+    try:
+        index.save(path)
+        logging.info(f"Индекс справочника сохранён: {path}")
+    except OSError as e:
+        logging.warning(f"Не удалось сохранить индекс справочника {path}: {e}")
+    return index
@@ -0,0 +1,125 @@
+import os
+import json
+import shutil
+import logging
+from datetime import datetime
+import numpy as np
+import pandas as pd
+
+# --- КОНСТАНТЫ ---
+SNAPSHOT_SCHEMA_VERSION = 1  # Увеличивается при изменении формата снимка
+SNAPSHOT_SUFFIX = '.snapshot'
+SNAPSHOT_META = 'meta.json'
+# Числовые колонки хранятся в .npy и открываются через mmap, остальные - списком значений в JSON
+NUMERIC_KINDS = 'biuf'
+
+
+def snapshot_path(workbook_path):
+    """Снимок лежит рядом с книгой: Остатки_Комус.xlsx -> Остатки_Комус.snapshot/."""
+    return os.path.splitext(workbook_path)[0] + SNAPSHOT_SUFFIX
+
+
+def write_snapshot(path, frames, digest, params=None):
+    """
+    Сохраняет фреймы справочника (dict: имя -> DataFrame) в папку path.
+    digest - хэш исходной книги, params - параметры её чтения (листы, колонки);
+    по ним снимок проверяется на актуальность.
+    Папка подменяется целиком, поэтому читающие процессы не увидят снимок наполовину записанным.
+    """
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    shutil.rmtree(temp_path, ignore_errors=True)
+    os.makedirs(temp_path)
+
+    meta = {
+        'schema_version': SNAPSHOT_SCHEMA_VERSION,
+        'source_digest': digest,
+        'read_params': params,
+        'created_at': datetime.now().isoformat(timespec='seconds'),
+        'frames': {},
+    }
+    for name, frame in frames.items():
+        columns = []
+        for position, label in enumerate(frame.columns):
+            values = frame.iloc[:, position].to_numpy()
+            file_name = f"{name}_{position}"
+            if values.dtype.kind in NUMERIC_KINDS:
+                file_name += '.npy'
+                np.save(os.path.join(temp_path, file_name), values, allow_pickle=False)
+            else:
+                file_name += '.json'
+                with open(os.path.join(temp_path, file_name), 'w', encoding='utf-8') as f:
+                    json.dump([_encode_value(value) for value in values], f, ensure_ascii=False)
+            columns.append({'label': _encode_value(label), 'dtype': str(values.dtype), 'file': file_name})
+        meta['frames'][name] = {'rows': len(frame), 'columns': columns}
+
+    with open(os.path.join(temp_path, SNAPSHOT_META), 'w', encoding='utf-8') as f:
+        json.dump(meta, f, ensure_ascii=False, indent=2)
+
+    old_path = f"{path}.{os.getpid()}.old"
+    if os.path.exists(path):
+        os.replace(path, old_path)
+    os.replace(temp_path, path)
+    shutil.rmtree(old_path, ignore_errors=True)
+    return meta
+
+
+def load_snapshot(path, digest, params=None):
+    """
+    Загружает фреймы справочника из снимка. Возвращает dict: имя -> DataFrame
+    или None, если снимка нет, он другой версии или построен не по книге с хэшем digest
+    либо с другими параметрами чтения params.
+    """
+    meta_path = os.path.join(path, SNAPSHOT_META)
+    try:
+        with open(meta_path, encoding='utf-8') as f:
+            meta = json.load(f)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        logging.warning(f"Не удалось прочитать снимок справочника {path}: {e}")
+        return None
+
+    if meta.get('schema_version') != SNAPSHOT_SCHEMA_VERSION:
+        logging.info(f"Снимок справочника {path} другой версии, используется книга.")
+        return None
+    if meta.get('source_digest') != digest:
+        logging.info(f"Снимок справочника {path} устарел (книга изменилась), используется книга.")
+        return None
+    if meta.get('read_params') != params:
+        logging.info(f"Снимок справочника {path} построен с другими листами или колонками, используется книга.")
+        return None
+
+    try:
+        frames = {}
+        for name, frame_meta in meta['frames'].items():
+            data = {}
+            for column in frame_meta['columns']:
+                data[column['label']] = _load_column(os.path.join(path, column['file']), column['dtype'])
+                if len(data[column['label']]) != frame_meta['rows']:
+                    raise ValueError(f"колонка {column['file']} не совпадает по длине")
+            # copy=False: колонки остаются отдельными блоками, и числовые колонки ссылаются на mmap, а не копируются
+            frames[name] = pd.DataFrame(data, index=pd.RangeIndex(frame_meta['rows']), copy=False)
+    except (OSError, ValueError, KeyError) as e:
+        logging.warning(f"Снимок справочника {path} повреждён, используется книга: {e}")
+        return None
+    return frames
+
+
+def _load_column(file_path, dtype):
+    if file_path.endswith('.npy'):
+        # Снимок только читается, поэтому массив можно не копировать в память процесса
+        return np.load(file_path, mmap_mode='r', allow_pickle=False)
+    with open(file_path, encoding='utf-8') as f:
+        values = json.load(f)
+    return np.array([np.nan if value is None else value for value in values], dtype=dtype)
+
+
+def _encode_value(value):
+    """Значение ячейки для JSON: пропуски - null, остальное - str, int или float как есть."""
+    if isinstance(value, float) and np.isnan(value):
+        return None
+    if isinstance(value, (np.integer, np.floating)):
+        value = value.item()
+    if value is None or isinstance(value, (str, int, float)):
+        return value
+    raise TypeError(f"значение {value!r} типа {type(value).__name__} не поддерживается снимком")
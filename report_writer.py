@@ -0,0 +1,59 @@
+import os
+import hashlib
+import logging
+import threading
+from io import BytesIO
+from openpyxl import load_workbook
+
+# --- КОНСТАНТЫ ---
+FILE_OST_LESKOVSKY = 'Остатки ИП Лесковский.xlsx'
+LESKOVSKY_SHEET = 'Лист1'
+OUTPUT_START_ROW = 2  # Первая строка данных (строка 1 - заголовок)
+OUTPUT_COLUMN = 3  # Колонка C - остаток
+
+
+class TemplateCache:
+    """
+    Шаблон отчёта в виде байтов. Файл на диске только читается и перечитывается,
+    если его заменили (изменился mtime или размер).
+    """
+
+    def __init__(self, path=FILE_OST_LESKOVSKY):
+        self.path = path
+        self._content = None
+        self._mtime = None
+        # Хэш содержимого шаблона - входит в ключ кэша результатов
+        self.digest = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        with self._lock:
+            stat = os.stat(self.path)
+            mtime = (stat.st_mtime_ns, stat.st_size)
+            if self._content is None or self._mtime != mtime:
+                with open(self.path, 'rb') as f:
+                    self._content = f.read()
+                self._mtime = mtime
+                self.digest = hashlib.sha256(self._content).hexdigest()
+                logging.info(f"Шаблон {self.path} загружен в память ({len(self._content)} байт).")
+            return self._content
+
+
+def render_report(values, template_cache=None, sheet=LESKOVSKY_SHEET):
+    """
+    Копирует шаблон в памяти, записывает values в колонку C листа sheet начиная со второй строки
+    и возвращает готовую книгу в виде байтов.
+    """
+    template_cache = template_cache or default_template_cache
+    workbook = load_workbook(BytesIO(template_cache.get()))
+    worksheet = workbook[sheet]
+    for offset, value in enumerate(values):
+        worksheet.cell(row=OUTPUT_START_ROW + offset, column=OUTPUT_COLUMN, value=float(value))
+
+    output = BytesIO()
+    workbook.save(output)
+    return output.getvalue()
+
+
+# Общий кэш шаблона процесса
+default_template_cache = TemplateCache()
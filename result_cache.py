@@ -0,0 +1,126 @@
+import os
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+import pandas as pd
+from dotenv import load_dotenv
+
+from metrics import metrics
+
+# --- ЗАГРУЗКА ПЕРЕМЕННЫХ ИЗ .ENV ---
+load_dotenv()
+# Сколько готовых отчётов держать в памяти (0 - кэш выключен)
+RESULT_CACHE_SIZE = int(os.getenv("RESULT_CACHE_SIZE", "32"))
+# Папка для хранения отчётов на диске между перезапусками (не задана - только память)
+RESULT_CACHE_DIR = os.getenv("RESULT_CACHE_DIR")
+RESULT_CACHE_DISK_SIZE = int(os.getenv("RESULT_CACHE_DISK_SIZE", "500"))
+
+CACHE_KEY_VERSION = 1  # Увеличивается при изменении логики расчёта, чтобы старые отчёты не использовались
+
+
+def report_cache_key(report_df, reference_digest, template_digest, popularity_map, settings=''):
+    """
+    Ключ результата: ячейки REPORT_RANGE отчёта, версия справочника и шаблона и содержимое
+    снимка популярности. По содержимому, а не по времени снимка: обновление CRM без изменений не сбрасывает кэш.
+    settings - настройки профиля, влияющие на результат (диапазоны, лист шаблона).
+    """
+    sha = hashlib.sha256(f"v{CACHE_KEY_VERSION}|{reference_digest}|{template_digest}|{settings}|".encode())
+    sha.update(repr(list(report_df.columns)).encode())
+    sha.update(pd.util.hash_pandas_object(report_df, index=False).to_numpy().tobytes())
+    sha.update(repr(sorted((str(name), str(count)) for name, count in popularity_map.items())).encode())
+    return sha.hexdigest()
+
+
+class ResultCache:
+    """
+    Готовые отчёты по ключу report_cache_key: LRU в памяти и, если задана папка, копия на диске.
+    Хранится только содержимое книги - имя файла с датой формируется заново при каждом запросе.
+    """
+
+    def __init__(self, max_size=RESULT_CACHE_SIZE, directory=RESULT_CACHE_DIR, disk_size=RESULT_CACHE_DISK_SIZE):
+        self.max_size = max_size
+        self.directory = directory
+        self.disk_size = disk_size
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.max_size > 0
+
+    def get(self, key):
+        """Содержимое отчёта в байтах или None."""
+        with self._lock:
+            content = self._items.get(key)
+            if content is not None:
+                self._items.move_to_end(key)
+        if content is None and self.directory:
+            content = self._read_file(key)
+            if content is not None:
+                self._remember(key, content)
+
+        result = 'hit' if content is not None else 'miss'
+        with self._lock:
+            if content is not None:
+                self.hits += 1
+            else:
+                self.misses += 1
+        metrics.inc('result_cache_requests_total', result=result)
+        return content
+
+    def put(self, key, content):
+        self._remember(key, content)
+        if self.directory:
+            try:
+                self._write_file(key, content)
+            except OSError as e:
+                logging.warning(f"Не удалось сохранить отчёт в кэш на диске: {e}")
+
+    def _remember(self, key, content):
+        with self._lock:
+            self._items[key] = content
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+            metrics.set_gauge('result_cache_items', len(self._items))
+
+    # --- ХРАНЕНИЕ НА ДИСКЕ ---
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.xlsx")
+
+    def _read_file(self, key):
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                content = f.read()
+            # Время изменения файла служит отметкой последнего использования для вытеснения
+            os.utime(path)
+            return content
+        except FileNotFoundError:
+            return None
+        except OSError as e:
+            logging.warning(f"Не удалось прочитать отчёт из кэша на диске: {e}")
+            return None
+
+    def _write_file(self, key, content):
+        os.makedirs(self.directory, exist_ok=True)
+        temp_path = f"{self._path(key)}.{os.getpid()}.tmp"
+        with open(temp_path, 'wb') as f:
+            f.write(content)
+        os.replace(temp_path, self._path(key))
+
+        files = [entry for entry in os.scandir(self.directory) if entry.name.endswith('.xlsx')]
+        if len(files) > self.disk_size:
+            files.sort(key=lambda entry: entry.stat().st_mtime)
+            for entry in files[:len(files) - self.disk_size]:
+                try:
+                    os.remove(entry.path)
+                except OSError:
+                    pass
+
+
+# Общий кэш результатов процесса
+result_cache = ResultCache()
@@ -0,0 +1,215 @@
+import os
+import time
+import random
+import asyncio
+import logging
+import aiohttp
+from dotenv import load_dotenv
+
+from metrics import metrics
+
+# --- ЗАГРУЗКА ПЕРЕМЕННЫХ ИЗ .ENV ---
+load_dotenv()
+RETAILCRM_BASE_URL = os.getenv("RETAILCRM_BASE_URL")
+RETAILCRM_API_KEY = os.getenv("RETAILCRM_API_KEY")
+RETAILCRM_SITE_CODE = os.getenv("RETAILCRM_SITE_CODE")
+
+CRM_API_VERSION = "v5"
+
+# --- НАСТРОЙКИ ЗАПРОСОВ ---
+# Отдельные таймауты на соединение и на чтение ответа: зависшая страница обрывается, а не держит загрузку
+CRM_CONNECT_TIMEOUT = float(os.getenv("CRM_CONNECT_TIMEOUT", "5"))
+CRM_READ_TIMEOUT = float(os.getenv("CRM_READ_TIMEOUT", "30"))
+# Повторы при 429 и 5xx: экспоненциальная задержка со случайным разбросом, не больше CRM_RETRY_MAX_DELAY
+CRM_MAX_RETRIES = int(os.getenv("CRM_MAX_RETRIES", "4"))
+CRM_RETRY_BASE_DELAY = float(os.getenv("CRM_RETRY_BASE_DELAY", "0.5"))
+CRM_RETRY_MAX_DELAY = float(os.getenv("CRM_RETRY_MAX_DELAY", "10"))
+# RetailCRM допускает 10 запросов в секунду на ключ: 8 в секунду плюс запас 2 не выходят за лимит ни в одну секунду
+CRM_RATE_LIMIT = float(os.getenv("CRM_RATE_LIMIT", "8"))
+CRM_RATE_BURST = int(os.getenv("CRM_RATE_BURST", "2"))
+# Сколько соединений с CRM держится открытыми одновременно
+CRM_CONCURRENCY = int(os.getenv("CRM_CONCURRENCY", "4"))
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+# Поля заказа, которые нужны для расчёта популярности
+ORDER_FIELDS = ('id', 'createdAt', 'items.properties')
+
+
+class CrmError(Exception):
+    """CRM вернула ошибку или недоступна."""
+
+
+class TokenBucket:
+    """
+    Ограничитель частоты запросов: в ведре до capacity жетонов, пополняется со скоростью rate в секунду.
+    Запрос забирает жетон или ждёт, пока он появится.
+    """
+
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = max(1, capacity)
+        self._tokens = float(self.capacity)
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        if self.rate <= 0:
+            return
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class RetailCrmClient:
+    """
+    Клиент API RetailCRM: одна сессия aiohttp с пулом соединений (keep-alive) на весь процесс,
+    ключ в заголовке X-API-KEY, таймауты, повторы при 429/5xx и ограничение частоты запросов.
+    Сессия привязана к event loop: если клиент вызван из другого цикла (asyncio.run в пуле обработки),
+    она создаётся заново.
+    """
+
+    def __init__(self, base_url=None, api_key=None, rate=CRM_RATE_LIMIT, burst=CRM_RATE_BURST,
+                 connect_timeout=CRM_CONNECT_TIMEOUT, read_timeout=CRM_READ_TIMEOUT, max_retries=CRM_MAX_RETRIES,
+                 concurrency=CRM_CONCURRENCY):
+        self.base_url = (base_url or RETAILCRM_BASE_URL or '').rstrip('/')
+        self.api_key = api_key or RETAILCRM_API_KEY
+        self.rate = rate
+        self.burst = burst
+        self.timeout = aiohttp.ClientTimeout(connect=connect_timeout, sock_connect=connect_timeout,
+                                             sock_read=read_timeout)
+        self.max_retries = max_retries
+        self.concurrency = concurrency
+        self._session = None
+        self._limiter = None
+        self._loop = None
+
+    @property
+    def configured(self):
+        return bool(self.base_url and self.api_key)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    def _get_session(self):
+        loop = asyncio.get_running_loop()
+        if self._session is None or self._session.closed or self._loop is not loop:
+            connector = aiohttp.TCPConnector(limit=self.concurrency, keepalive_timeout=60)
+            self._session = aiohttp.ClientSession(connector=connector, timeout=self.timeout,
+                                                  headers={'X-API-KEY': self.api_key or ''})
+            self._limiter = TokenBucket(self.rate, self.burst)
+            self._loop = loop
+        return self._session
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+    async def get(self, path, params=None, parse=None):
+        """
+        GET /api/v5/<path>. Возвращает разобранный JSON-ответ.
+        parse - необязательная корутина parse(response), разбирающая тело ответа вместо response.json()
+        (например, потоково); она должна вернуть dict с ключами success/errorMsg, как в ответе CRM.
+        Бросает CrmError, если CRM ответила success=false или повторы не помогли,
+        aiohttp.ClientError/asyncio.TimeoutError - при сетевой ошибке после всех повторов.
+        """
+        session = self._get_session()
+        url = f"{self.base_url}/api/{CRM_API_VERSION}/{path}"
+        for attempt in range(self.max_retries + 1):
+            await self._limiter.acquire()
+            retry_after = None
+            try:
+                async with session.get(url, params=params) as response:
+                    if response.status in RETRY_STATUSES:
+                        retry_after = _parse_retry_after(response.headers.get('Retry-After'))
+                        error = CrmError(f"CRM ответила {response.status} на запрос {path}")
+                    else:
+                        response.raise_for_status()
+                        data = await (parse(response) if parse else response.json(content_type=None))
+                        break
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                error = e
+
+            if attempt == self.max_retries:
+                raise error
+            delay = retry_after if retry_after is not None else _backoff(attempt)
+            metrics.inc('crm_retries_total')
+            logging.warning(f"Запрос к CRM {path} не удался ({str(error) or type(error).__name__}), "
+                            f"повтор {attempt + 1} из {self.max_retries} через {delay:.1f} с")
+            await asyncio.sleep(delay)
+
+        if not data.get('success'):
+            raise CrmError(f"Ошибка в ответе CRM: {data.get('errorMsg', 'Неизвестная ошибка')}")
+        metrics.inc('crm_requests_total')
+        return data
+
+    async def list_orders(self, filters, page=1, limit=100, fields=None, parse=None):
+        """
+        Страница заказов по фильтрам (dict без префикса filter[...]: {'createdAtFrom': ...}).
+        Список значений передаётся как filter[ключ][]. fields - поля заказа, которые нужно оставить
+        (например ORDER_FIELDS): API списка заказов не умеет отдавать часть полей, поэтому лишнее
+        отбрасывается сразу после разбора ответа, чтобы страницы не держали в памяти весь заказ.
+        parse - свой разбор тела ответа (см. get); fields к его результату не применяется.
+        """
+        params = [('limit', limit), ('page', page)]
+        for key, value in filters.items():
+            if isinstance(value, (list, tuple)):
+                params.extend((f'filter[{key}][]', item) for item in value)
+            else:
+                params.append((f'filter[{key}]', value))
+        data = await self.get('orders', params, parse)
+        if fields and not parse:
+            data['orders'] = [project(order, fields) for order in data.get('orders', [])]
+        return data
+
+    async def get_order(self, order_id, by='id', site=RETAILCRM_SITE_CODE):
+        """Заказ по внутреннему (by='id') или внешнему (by='externalId') ID."""
+        params = {'by': by}
+        if site:
+            params['site'] = site
+        data = await self.get(f'orders/{order_id}', params)
+        return data.get('order')
+
+
+def project(order, fields):
+    """Оставляет в заказе только поля fields; вложенные поля задаются через точку: 'items.properties'."""
+    result = {}
+    for field in fields:
+        name, _, nested = field.partition('.')
+        if name not in order:
+            continue
+        value = order[name]
+        if nested and isinstance(value, list):
+            value = [project(item, (nested,)) if isinstance(item, dict) else item for item in value]
+        elif nested and isinstance(value, dict):
+            value = project(value, (nested,))
+        if isinstance(result.get(name), list):
+            # Несколько вложенных полей одного списка ('items.properties', 'items.offer') сливаются поэлементно
+            value = [{**old, **new} for old, new in zip(result[name], value)]
+        result[name] = value
+    return result
+
+
+def _backoff(attempt):
+    """Экспоненциальная задержка с полным случайным разбросом, чтобы повторы нескольких задач не совпадали."""
+    return random.uniform(0, min(CRM_RETRY_MAX_DELAY, CRM_RETRY_BASE_DELAY * 2 ** attempt))
+
+
+def _parse_retry_after(value):
+    try:
+        return min(CRM_RETRY_MAX_DELAY, max(0.0, float(value)))
+    except (TypeError, ValueError):
+        return None
+
+
+# Общий клиент процесса бота
+crm_client = RetailCrmClient()
@@ -0,0 +1,254 @@
+import os
+import time
+import uuid
+import sqlite3
+import logging
+from dotenv import load_dotenv
+
+from job_queue import (QueueFullError, JOB_QUEUE_SIZE, JOB_MAX_PER_USER, STATUS_QUEUED, STATUS_RUNNING,
+                       STATUS_CANCELLED)
+
+# --- ЗАГРУЗКА ПЕРЕМЕННЫХ ИЗ .ENV ---
+load_dotenv()
+# Где выполняются задачи: 'local' - JobQueue в процессе бота, 'sqlite' - общая очередь для процессов worker.py
+JOB_BACKEND = os.getenv("JOB_BACKEND", "local")
+TASK_QUEUE_PATH = os.getenv("TASK_QUEUE_PATH", "tasks.sqlite")
+# Через сколько секунд без отметки от процесса-обработчика задача считается брошенной и возвращается в очередь
+TASK_STALE_AFTER = int(os.getenv("TASK_STALE_AFTER", "300"))
+TASK_MAX_ATTEMPTS = 3  # После стольких брошенных попыток задача снимается с очереди (см. drop_abandoned)
+
+
+class Task:
+    """Задача общей очереди: документы одного сообщения или альбома, которые обрабатываются вместе."""
+
+    def __init__(self, job_id, user_id, chat_id, status_message_id, profile, files, attempts):
+        self.job_id = job_id
+        self.user_id = user_id
+        self.chat_id = chat_id
+        self.status_message_id = status_message_id
+        self.profile = profile
+        # Список пар (file_id Telegram, имя файла) - файлы скачивает процесс-обработчик
+        self.files = files
+        self.attempts = attempts
+
+
+class SQLiteTaskQueue:
+    """
+    Очередь задач в SQLite-файле, общая для процессов бота (принимают документы) и процессов worker.py
+    (обрабатывают). Строка - один документ; документы альбома объединяются в задачу по job_id
+    и выдаются обработчику только после паузы group_delay, когда альбом пришёл целиком.
+    """
+
+    def __init__(self, path=TASK_QUEUE_PATH, max_size=JOB_QUEUE_SIZE, max_per_user=JOB_MAX_PER_USER,
+                 stale_after=TASK_STALE_AFTER):
+        self.path = path
+        self.max_size = max_size
+        self.max_per_user = max_per_user
+        self.stale_after = stale_after
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript("""
+                CREATE TABLE IF NOT EXISTS tasks (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    job_id TEXT NOT NULL,
+                    media_group_id TEXT,
+                    user_id INTEGER NOT NULL,
+                    chat_id INTEGER NOT NULL,
+                    status_message_id INTEGER,
+                    profile TEXT,
+                    file_id TEXT NOT NULL,
+                    file_name TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    available_at REAL NOT NULL,
+                    worker TEXT,
+                    heartbeat REAL,
+                    attempts INTEGER NOT NULL DEFAULT 0
+                );
+                CREATE INDEX IF NOT EXISTS tasks_status ON tasks(status, available_at);
+                CREATE INDEX IF NOT EXISTS tasks_job_id ON tasks(job_id);
+            """)
+
+    def _connect(self):
+        # isolation_level=None: транзакции открываются явно через BEGIN IMMEDIATE
+        return sqlite3.connect(self.path, timeout=30, isolation_level=None)
+
+    # --- ПОСТАНОВКА И ОТМЕНА ---
+    def put(self, user_id, chat_id, file_id, file_name, profile=None, media_group_id=None, delay=0.0):
+        """
+        Ставит документ в очередь. Документ альбома присоединяется к уже поставленной задаче альбома.
+        Возвращает (job_id, True, если создана новая задача). Бросает QueueFullError, если общая очередь
+        или лимит задач пользователя исчерпаны.
+        """
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = None
+                if media_group_id is not None:
+                    row = conn.execute("SELECT job_id FROM tasks WHERE media_group_id = ? AND status = ?",
+                                       (media_group_id, STATUS_QUEUED)).fetchone()
+                if row:
+                    job_id, created = row[0], False
+                    # Альбом ещё дополняется - откладываем выдачу всех его документов
+                    conn.execute("UPDATE tasks SET available_at = ? WHERE job_id = ?", (now + delay, job_id))
+                else:
+                    self._check_limits(conn, user_id)
+                    job_id, created = uuid.uuid4().hex[:8], True
+                conn.execute("""
+                    INSERT INTO tasks (job_id, media_group_id, user_id, chat_id, profile, file_id, file_name,
+                                       status, available_at)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                """, (job_id, media_group_id, user_id, chat_id, profile, file_id, file_name, STATUS_QUEUED,
+                      now + delay))
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        return job_id, created
+
+    def _check_limits(self, conn, user_id):
+        queued = conn.execute("SELECT COUNT(DISTINCT job_id) FROM tasks WHERE status = ?",
+                              (STATUS_QUEUED,)).fetchone()[0]
+        if queued >= self.max_size:
+            raise QueueFullError("Очередь обработки заполнена, попробуйте позже.")
+        active = conn.execute("SELECT COUNT(DISTINCT job_id) FROM tasks WHERE user_id = ? AND status IN (?, ?)",
+                              (user_id, STATUS_QUEUED, STATUS_RUNNING)).fetchone()[0]
+        if active >= self.max_per_user:
+            raise QueueFullError(f"У вас уже {self.max_per_user} файла в обработке, дождитесь результата.")
+
+    def set_status_message(self, job_id, message_id):
+        with self._connect() as conn:
+            conn.execute("UPDATE tasks SET status_message_id = ? WHERE job_id = ?", (message_id, job_id))
+
+    def cancel(self, user_id):
+        """
+        Отменяет все задачи пользователя: ожидающие удаляются из очереди, выполняющиеся помечаются
+        отменёнными, и обработчик не отправит их результат. Возвращает количество отменённых задач.
+        """
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            cancelled = conn.execute("SELECT COUNT(DISTINCT job_id) FROM tasks WHERE user_id = ? AND status IN (?, ?)",
+                                     (user_id, STATUS_QUEUED, STATUS_RUNNING)).fetchone()[0]
+            conn.execute("DELETE FROM tasks WHERE user_id = ? AND status = ?", (user_id, STATUS_QUEUED))
+            conn.execute("UPDATE tasks SET status = ? WHERE user_id = ? AND status = ?",
+                         (STATUS_CANCELLED, user_id, STATUS_RUNNING))
+            conn.execute("COMMIT")
+        if cancelled:
+            logging.info(f"Пользователь {user_id} отменил задач: {cancelled}")
+        return cancelled
+
+    # --- ВЫДАЧА ОБРАБОТЧИКАМ ---
+    def claim(self, worker):
+        """Забирает самую старую готовую задачу для обработчика worker. Возвращает Task или None."""
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._requeue_stale(conn, now)
+                row = conn.execute("""
+                    SELECT job_id FROM tasks WHERE status = ?
+                    GROUP BY job_id HAVING MAX(available_at) <= ?
+                    ORDER BY MIN(id) LIMIT 1
+                """, (STATUS_QUEUED, now)).fetchone()
+                if row is None:
+                    conn.execute("COMMIT")
+                    return None
+                job_id = row[0]
+                conn.execute("UPDATE tasks SET status = ?, worker = ?, heartbeat = ?, attempts = attempts + 1 "
+                             "WHERE job_id = ?", (STATUS_RUNNING, worker, now, job_id))
+                rows = conn.execute("""
+                    SELECT user_id, chat_id, status_message_id, profile, file_id, file_name, attempts
+                    FROM tasks WHERE job_id = ? ORDER BY id
+                """, (job_id,)).fetchall()
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        user_id, chat_id, status_message_id, profile, _, _, attempts = rows[0]
+        return Task(job_id, user_id, chat_id, status_message_id, profile,
+                    [(file_id, file_name) for *_, file_id, file_name, _ in rows], attempts)
+
+    def _requeue_stale(self, conn, now):
+        """
+        Задачи обработчиков, которые перестали отмечаться (процесс упал), возвращаются в очередь.
+        Задачи, исчерпавшие TASK_MAX_ATTEMPTS, остаются на месте до drop_abandoned, которая сообщит о них
+        пользователю; отменённые задачи упавшего обработчика просто удаляются.
+        """
+        stale_before = now - self.stale_after
+        conn.execute("DELETE FROM tasks WHERE status = ? AND heartbeat < ?", (STATUS_CANCELLED, stale_before))
+        requeued = conn.execute("UPDATE tasks SET status = ?, worker = NULL "
+                                "WHERE status = ? AND heartbeat < ? AND attempts < ?",
+                                (STATUS_QUEUED, STATUS_RUNNING, stale_before, TASK_MAX_ATTEMPTS)).rowcount
+        if requeued:
+            logging.warning(f"Возвращено в очередь документов брошенных задач: {requeued}")
+
+    def drop_abandoned(self):
+        """
+        Снимает с очереди брошенные задачи, которые уже TASK_MAX_ATTEMPTS раз не удалось довести до конца.
+        Возвращает список (job_id, chat_id, имена файлов): пользователям нужно сообщить, что файлы не обработаны.
+        """
+        stale_before = time.time() - self.stale_after
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                rows = conn.execute("SELECT job_id, chat_id, file_name FROM tasks "
+                                    "WHERE status = ? AND heartbeat < ? AND attempts >= ? ORDER BY id",
+                                    (STATUS_RUNNING, stale_before, TASK_MAX_ATTEMPTS)).fetchall()
+                conn.execute("DELETE FROM tasks WHERE status = ? AND heartbeat < ? AND attempts >= ?",
+                             (STATUS_RUNNING, stale_before, TASK_MAX_ATTEMPTS))
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        dropped = {}
+        for job_id, chat_id, file_name in rows:
+            dropped.setdefault((job_id, chat_id), []).append(file_name)
+        if dropped:
+            logging.warning(f"Сняты с очереди задачи после {TASK_MAX_ATTEMPTS} брошенных попыток: "
+                            f"{', '.join(job_id for job_id, _ in dropped)}")
+        return [(job_id, chat_id, files) for (job_id, chat_id), files in dropped.items()]
+
+    def heartbeat(self, job_id):
+        with self._connect() as conn:
+            conn.execute("UPDATE tasks SET heartbeat = ? WHERE job_id = ?", (time.time(), job_id))
+
+    def status(self, job_id):
+        """Статус задачи или None, если её уже нет в очереди."""
+        with self._connect() as conn:
+            row = conn.execute("SELECT status FROM tasks WHERE job_id = ? LIMIT 1", (job_id,)).fetchone()
+        return row[0] if row else None
+
+    def finish(self, job_id):
+        """Убирает завершённую (или отменённую) задачу из очереди."""
+        with self._connect() as conn:
+            conn.execute("DELETE FROM tasks WHERE job_id = ?", (job_id,))
+
+    # --- СОСТОЯНИЕ ---
+    def position(self, job_id):
+        """Позиция задачи в очереди, начиная с 1 (0 - задача уже выполняется или её нет)."""
+        with self._connect() as conn:
+            rows = conn.execute("SELECT job_id FROM tasks WHERE status = ? GROUP BY job_id ORDER BY MIN(id)",
+                                (STATUS_QUEUED,)).fetchall()
+        for position, (queued_job_id,) in enumerate(rows, 1):
+            if queued_job_id == job_id:
+                return position
+        return 0
+
+    def user_jobs(self, user_id):
+        """Незавершённые задачи пользователя: список (job_id, статус, позиция в очереди, имена файлов)."""
+        with self._connect() as conn:
+            rows = conn.execute("SELECT job_id, status, file_name FROM tasks WHERE user_id = ? ORDER BY id",
+                                (user_id,)).fetchall()
+            queued = [job_id for job_id, in conn.execute(
+                "SELECT job_id FROM tasks WHERE status = ? GROUP BY job_id ORDER BY MIN(id)", (STATUS_QUEUED,))]
+        positions = {job_id: position for position, job_id in enumerate(queued, 1)}
+        jobs = {}
+        for job_id, status, file_name in rows:
+            jobs.setdefault(job_id, (status, []))[1].append(file_name)
+        return [(job_id, status, positions.get(job_id, 0), files) for job_id, (status, files) in jobs.items()]
+
+    @property
+    def depth(self):
+        with self._connect() as conn:
+            return conn.execute("SELECT COUNT(DISTINCT job_id) FROM tasks WHERE status = ?",
+                                (STATUS_QUEUED,)).fetchone()[0]
@@ -0,0 +1,61 @@
+"""
+Исходные (до оптимизаций) реализации расчёта из первой версии file_processing.py.
+Тесты сравнивают с ними текущие реализации; построчное логирование убрано, логика не менялась.
+"""
+import math
+import numpy as np
+import pandas as pd
+
+COL_INDEX_COMPOSITION_KEY = 0
+COL_INDEX_CRM_NAME = 1
+COL_INDEX_PLANT_NAME = 2
+
+
+def calculate_formulas(komus_sheet1_df, komus_sheet2_df):
+    results = []
+    # komus_sheet1_df.iloc[:, 1] - Артикул, komus_sheet1_df.iloc[:, 2] - Остаток (VPR)
+    vlookup_dict = dict(zip(komus_sheet1_df.iloc[:, 1], komus_sheet1_df.iloc[:, 2]))
+    countif_dict = komus_sheet2_df.iloc[:, COL_INDEX_COMPOSITION_KEY].value_counts().to_dict()
+
+    for item in komus_sheet2_df.iloc[:, COL_INDEX_COMPOSITION_KEY]:
+        vlookup_result = vlookup_dict.get(item)
+        countif_result = countif_dict.get(item)
+        if vlookup_result is None or pd.isna(vlookup_result):
+            vlookup_result = 0
+        if countif_result is None or countif_result == 0:
+            results.append(0)
+        else:
+            results.append(vlookup_result / countif_result)
+    return results
+
+
+def apply_rounding_logic(df_data, calculated_data, popularity_map):
+    df = df_data.copy()
+    df['Calculated_Value'] = calculated_data
+    df['Final_Value'] = 0.0
+
+    df['Calculated_Value'] = df['Calculated_Value'].apply(lambda x: max(0, x))
+    df_positive = df[df['Calculated_Value'] > 0].copy()
+    if df_positive.empty:
+        return pd.Series(np.zeros(len(calculated_data)), dtype=float)
+
+    df_positive['Popularity'] = df_positive.iloc[:, COL_INDEX_CRM_NAME].apply(lambda x: popularity_map.get(x, 0))
+    grouped = df_positive.groupby(df_positive.columns[COL_INDEX_PLANT_NAME])
+
+    for plant_name, group in grouped:
+        fractional_parts = group['Calculated_Value'].apply(lambda x: x - math.floor(x))
+        integer_bonus = math.floor(fractional_parts.sum())
+        group_sorted = group.sort_values(by=['Popularity', 'Calculated_Value'], ascending=[False, False]).copy()
+        for index, row in group_sorted.iterrows():
+            floor_value = math.floor(row['Calculated_Value'])
+            bonus = 0
+            if integer_bonus > 0:
+                bonus = 1
+                integer_bonus -= 1
+            group_sorted.loc[index, 'Final_Value'] = floor_value + bonus
+        df_positive.loc[group_sorted.index, 'Final_Value'] = group_sorted['Final_Value']
+
+    result_series = pd.Series(np.zeros(len(calculated_data)), dtype=float)
+    for original_index in df_positive.index:
+        result_series.loc[original_index] = df_positive.loc[original_index, 'Final_Value']
+    return result_series
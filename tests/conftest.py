@@ -0,0 +1,37 @@
+import os
+import sys
+import shutil
+import logging
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.setdefault("BOT_TOKEN", "123456:test")
+
+FILE_OST_KOMUS = os.path.join(ROOT, 'Остатки_Комус.xlsx')
+FILE_OST_LESKOVSKY = os.path.join(ROOT, 'Остатки ИП Лесковский.xlsx')
+
+
+@pytest.fixture(autouse=True)
+def quiet_logging():
+    # Расчёт логирует словарь популярности и каждую стадию - в тестах это только шум
+    logging.disable(logging.INFO)
+    yield
+    logging.disable(logging.NOTSET)
+
+
+@pytest.fixture(scope='session')
+def workbooks(tmp_path_factory):
+    """Копии книг из корня проекта: кэш справочника пишет индекс и снимок рядом с книгой."""
+    directory = tmp_path_factory.mktemp('workbooks')
+    for path in (FILE_OST_KOMUS, FILE_OST_LESKOVSKY):
+        shutil.copy(path, directory)
+    return directory
+
+
+@pytest.fixture(scope='session')
+def reference(workbooks):
+    """Справочник, прочитанный напрямую через pd.read_excel, как в исходной версии."""
+    from reference_cache import read_reference_workbook
+    return read_reference_workbook(str(workbooks / 'Остатки_Комус.xlsx'))
+
@@ -0,0 +1,101 @@
+import time
+import threading
+import socketserver
+from collections import Counter
+from contextlib import asynccontextmanager
+from aiohttp.test_utils import TestServer
+
+
+@asynccontextmanager
+async def serve(app):
+    """Локальный HTTP-сервер с приложением aiohttp на свободном порту. Отдаёт базовый адрес."""
+    server = TestServer(app, host='127.0.0.1')
+    await server.start_server()
+    try:
+        yield str(server.make_url('')).rstrip('/')
+    finally:
+        await server.close()
+
+
+class SmtpStandIn:
+    """
+    SMTP-сервер на 127.0.0.1 со свободным портом, понимающий то, что нужно smtplib: EHLO, AUTH PLAIN,
+    MAIL, RCPT, DATA, RSET, QUIT. replies - функция (команда, адрес получателя, номер попытки) -> код
+    ответа или None (250), по ней сервер отклоняет RCPT или DATA. Запоминает соединения и принятые письма.
+    """
+
+    def __init__(self, replies=None):
+        self.replies = replies or (lambda command, recipient, attempt: None)
+        self.connections = 0
+        self.delivered = []  # (время, получатели, письмо)
+        self.attempts = Counter()  # Сколько раз письмо каждому получателю дошло до DATA
+        stand_in = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                stand_in.connections += 1
+                stand_in._session(self.rfile, self.wfile)
+
+        self.server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        self.port = self.server.server_address[1]
+
+    def __enter__(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _session(self, rfile, wfile):
+        def reply(line):
+            wfile.write(line.encode() + b'\r\n')
+
+        reply('220 stand-in ESMTP')
+        recipients = []
+        for raw in rfile:
+            command = raw.decode().strip()
+            verb = command.split(' ', 1)[0].upper()
+            if verb == 'EHLO':
+                reply('250-stand-in')
+                reply('250 AUTH PLAIN')
+            elif verb == 'AUTH':
+                reply('235 Authentication succeeded')
+            elif verb == 'MAIL':
+                recipients = []
+                reply('250 OK')
+            elif verb == 'RCPT':
+                recipient = command.split(':', 1)[1].strip().strip('<>')
+                code = self.replies('RCPT', recipient, self.attempts[recipient] + 1)
+                if code:
+                    self.attempts[recipient] += 1
+                    reply(f'{code} recipient rejected')
+                else:
+                    recipients.append(recipient)
+                    reply('250 OK')
+            elif verb == 'DATA':
+                reply('354 End data with <CR><LF>.<CR><LF>')
+                lines = []
+                for data in rfile:
+                    if data in (b'.\r\n', b'.\n'):
+                        break
+                    lines.append(data)
+                codes = []
+                for recipient in recipients:
+                    self.attempts[recipient] += 1
+                    codes.append(self.replies('DATA', recipient, self.attempts[recipient]))
+                code = next((code for code in codes if code), None)
+                if code:
+                    reply(f'{code} message rejected')
+                else:
+                    self.delivered.append((time.monotonic(), recipients, b''.join(lines)))
+                    reply('250 OK queued')
+            elif verb == 'RSET':
+                recipients = []
+                reply('250 OK')
+            elif verb == 'QUIT':
+                reply('221 Bye')
+                return
+            else:
+                reply('502 Command not implemented')
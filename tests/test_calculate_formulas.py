@@ -0,0 +1,48 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import baseline
+from file_processing import calculate_formulas
+from reference_cache import ReferenceCache
+
+
+def stock_variants(komus_df_1, workbooks):
+    """Лист остатков справочника с разными остатками: как в книге, из Остатки ИП Лесковский.xlsx и случайные."""
+    yield 'bundled', komus_df_1
+    leskovsky = pd.read_excel(workbooks / 'Остатки ИП Лесковский.xlsx', header=None, skiprows=1, usecols=[2])
+    stocks = leskovsky.iloc[:len(komus_df_1), 0].to_numpy()
+    df = komus_df_1.copy()
+    df.iloc[:len(stocks), 2] = stocks
+    yield 'leskovsky', df
+    for seed in range(5):
+        rng = np.random.default_rng(seed)
+        df = komus_df_1.copy()
+        values = rng.integers(-3, 30, len(df)).astype(float)
+        values[rng.random(len(df)) < 0.1] = np.nan
+        df.iloc[:, 2] = values
+        yield f'random-{seed}', df
+
+
+def test_matches_baseline_on_bundled_workbooks(reference, workbooks):
+    komus_df_1, komus_df_2_all = reference
+    data = ReferenceCache(str(workbooks / 'Остатки_Комус.xlsx')).get()
+    for name, df in stock_variants(komus_df_1, workbooks):
+        expected = np.asarray(baseline.calculate_formulas(df, komus_df_2_all), dtype=float)
+        for countif_dict in (None, data.countif_dict):
+            result = calculate_formulas(df, komus_df_2_all, countif_dict)
+            assert result.tobytes() == expected.tobytes(), name
+        # С индексом справочника ВПР и СЧЁТЕСЛИ берутся по готовым кодам строк
+        indexed = calculate_formulas(df, data.komus_df_2_all, index=data.index)
+        assert indexed.tobytes() == expected.tobytes(), name
+
+
+@pytest.mark.parametrize('duplicates', [0, 5])
+def test_duplicate_articles_match_baseline(reference, duplicates):
+    # При повторе артикула в листе остатков исходная версия берёт последнее значение (dict(zip(...)))
+    komus_df_1, komus_df_2_all = reference
+    extra = komus_df_1.iloc[:duplicates].copy()
+    extra.iloc[:, 2] = 7.0
+    df = pd.concat([komus_df_1, extra], ignore_index=True)
+    expected = np.asarray(baseline.calculate_formulas(df, komus_df_2_all), dtype=float)
+    assert calculate_formulas(df, komus_df_2_all).tobytes() == expected.tobytes()
@@ -0,0 +1,144 @@
+import asyncio
+from collections import Counter
+from datetime import datetime, timedelta
+import pytest
+from aiohttp import web
+
+import crm_connector
+from crm_connector import PopularityStore, fetch_crm_popularity, CRM_POPULARITY_DAYS, CRM_SYNC_OVERLAP_DAYS
+from retailcrm_client import RetailCrmClient
+from benchmarks.synthetic import make_orders, make_crm_app
+from helpers import serve
+
+
+class FakeCrm:
+    """Заменитель RetailCRM: заказы из списка orders, журнал запросов и отказ на выбранной странице."""
+
+    def __init__(self, orders):
+        self.orders = orders
+        self.requests = []
+        self.fail_page = None
+
+    def make_app(self):
+        app = make_crm_app(self.orders)
+
+        @web.middleware
+        async def record(request, handler):
+            self.requests.append(dict(request.query))
+            if self.fail_page is not None and request.query.get('page') == str(self.fail_page):
+                return web.json_response({'success': False, 'errorMsg': 'Internal error'}, status=500)
+            return await handler(request)
+
+        app.middlewares.append(record)
+        return app
+
+
+def expected_popularity(orders, window_from):
+    counts = Counter()
+    for order in orders:
+        if order['createdAt'] >= window_from:
+            counts.update({item['properties'][0]['value'].split('[')[1].rstrip(']') for item in order['items']})
+    return dict(counts)
+
+
+def sync(crm, store):
+    async def run():
+        async with serve(crm.make_app()) as base_url:
+            async with RetailCrmClient(base_url, 'test', rate=0, max_retries=0) as client:
+                return await fetch_crm_popularity(store, client=client)
+    return asyncio.run(run())
+
+
+@pytest.fixture(autouse=True)
+def small_pages(monkeypatch):
+    monkeypatch.setattr(crm_connector, 'CRM_PAGE_LIMIT', 7)
+
+
+@pytest.fixture
+def store(tmp_path):
+    return PopularityStore(str(tmp_path / 'crm.sqlite'))
+
+
+def window_from():
+    return (datetime.now() - timedelta(days=CRM_POPULARITY_DAYS)).strftime('%Y-%m-%d')
+
+
+def test_first_sync_loads_whole_window(store):
+    crm = FakeCrm(make_orders(60, compositions=10, days=CRM_POPULARITY_DAYS + 20))
+    popularity_map = sync(crm, store)
+
+    assert popularity_map == expected_popularity(crm.orders, window_from())
+    assert {request['filter[createdAtFrom]'] for request in crm.requests} == {window_from()}
+    # Все страницы окна, включая первую: по 7 заказов на страницу
+    in_window = sum(order['createdAt'] >= window_from() for order in crm.orders)
+    assert len(crm.requests) == -(-in_window // 7)
+    assert store.get_watermark() is not None
+
+
+def test_incremental_sync_starts_from_watermark_with_overlap(store):
+    crm = FakeCrm(make_orders(40, compositions=10, days=30))
+    sync(crm, store)
+    watermark = datetime.strptime(store.get_watermark(), '%Y-%m-%d %H:%M:%S')
+
+    # Новый заказ и правка недавнего заказа внутри окна перекрытия
+    now = datetime.now()
+    recent = max(crm.orders, key=lambda order: order['createdAt'])
+    recent['items'] = [{'properties': [{'code': 'SET_NAME', 'value': 'Набор [Новая композиция]'}]}]
+    recent['createdAt'] = (now - timedelta(hours=1)).strftime('%Y-%m-%d %H:%M:%S')
+    crm.orders.append({'id': 1000, 'createdAt': now.strftime('%Y-%m-%d %H:%M:%S'),
+                       'items': [{'properties': [{'code': 'SET_NAME', 'value': 'Набор [Композиция 1]'}]}]})
+    crm.requests.clear()
+    popularity_map = sync(crm, store)
+
+    overlap_from = (watermark - timedelta(days=CRM_SYNC_OVERLAP_DAYS)).strftime('%Y-%m-%d')
+    assert {request['filter[createdAtFrom]'] for request in crm.requests} == {overlap_from}
+    # Из CRM загружены только заказы периода перекрытия, а не всё окно
+    assert len(crm.requests) < -(-len(crm.orders) // 7)
+    assert popularity_map == expected_popularity(crm.orders, window_from())
+    assert popularity_map['Новая композиция'] == 1
+
+
+def test_orders_outside_window_are_pruned(store):
+    old = (datetime.now() - timedelta(days=CRM_POPULARITY_DAYS + 5)).strftime('%Y-%m-%d %H:%M:%S')
+    store.upsert_orders([('old-1', old, {'Композиция 1'}), ('old-2', old, {'Старая композиция'})])
+    crm = FakeCrm(make_orders(20, compositions=5, days=10))
+    popularity_map = sync(crm, store)
+
+    assert 'Старая композиция' not in popularity_map
+    assert popularity_map == expected_popularity(crm.orders, window_from())
+    with store._connect() as conn:
+        assert conn.execute("SELECT COUNT(*) FROM orders WHERE id LIKE 'old-%'").fetchone()[0] == 0
+        # Составы удалённых заказов удаляются каскадно
+        assert conn.execute("SELECT COUNT(*) FROM order_compositions WHERE order_id LIKE 'old-%'").fetchone()[0] == 0
+
+
+def test_failure_mid_sync_keeps_watermark(store):
+    crm = FakeCrm(make_orders(40, compositions=10, days=30))
+    sync(crm, store)
+    # Метка заведомо старше текущей секунды, чтобы её сдвиг был заметен
+    watermark = (datetime.now() - timedelta(days=2)).strftime('%Y-%m-%d %H:%M:%S')
+    store.set_watermark(watermark)
+    before = store.popularity(window_from())
+
+    crm.orders.extend(make_orders(30, compositions=10, days=1, seed=1))
+    for order in crm.orders[-30:]:
+        order['id'] += 1000
+    crm.fail_page = 2
+    crm.requests.clear()
+    assert sync(crm, store) is None
+
+    # Страница 1 успела сохраниться, но окно синхронизации не сдвинулось: следующая попытка загрузит всё заново
+    assert store.get_watermark() == watermark
+    assert any(request.get('page') == '2' for request in crm.requests)
+
+    crm.fail_page = None
+    popularity_map = sync(crm, store)
+    assert popularity_map == expected_popularity(crm.orders, window_from())
+    assert sum(popularity_map.values()) > sum(before.values())
+
+
+def test_failure_on_first_sync_leaves_no_watermark(store):
+    crm = FakeCrm(make_orders(30, compositions=5, days=10))
+    crm.fail_page = 3
+    assert sync(crm, store) is None
+    assert store.get_watermark() is None
@@ -0,0 +1,45 @@
+import sqlite3
+import asyncio
+
+from email_sender import (MailSender, Outbox, TransientEmailError, STATUS_PENDING, STATUS_FAILED, SEND_SENT,
+                          SEND_QUEUED, SEND_FAILED)
+
+
+def rows(path):
+    with sqlite3.connect(path) as conn:
+        return conn.execute("SELECT file_name, status FROM outbox ORDER BY id").fetchall()
+
+
+def test_sent_messages_are_removed_from_outbox(tmp_path, monkeypatch):
+    path = str(tmp_path / 'outbox.sqlite')
+    sender = MailSender(Outbox(path))
+    # Первое письмо уходит, второе сервер отклоняет окончательно (5xx)
+    monkeypatch.setattr(sender, '_deliver_batch', lambda batch: {
+        message_id: None if file_name == 'ok.xlsx' else RuntimeError('550 rejected')
+        for message_id, file_name, *_ in batch})
+
+    async def run():
+        try:
+            return await asyncio.gather(sender.send('ok.xlsx', b'data', ['a@example.com']),
+                                        sender.send('bad.xlsx', b'data', ['b@example.com']))
+        finally:
+            await sender.stop()
+
+    assert asyncio.run(run()) == [SEND_SENT, SEND_FAILED]
+    assert rows(path) == [('bad.xlsx', STATUS_FAILED)]
+
+
+def test_send_reports_queued_while_retries_continue(tmp_path, monkeypatch):
+    path = str(tmp_path / 'outbox.sqlite')
+    sender = MailSender(Outbox(path))
+    monkeypatch.setattr(sender, '_deliver_batch', lambda batch: {
+        message_id: TransientEmailError('421 try later') for message_id, *_ in batch})
+
+    async def run():
+        try:
+            return await sender.send('later.xlsx', b'data', ['a@example.com'], timeout=0.3)
+        finally:
+            await sender.stop()
+
+    assert asyncio.run(run()) == SEND_QUEUED
+    assert rows(path) == [('later.xlsx', STATUS_PENDING)]
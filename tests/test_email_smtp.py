@@ -0,0 +1,84 @@
+import time
+import sqlite3
+import asyncio
+import pytest
+
+import email_sender
+from email_sender import MailSender, Outbox, build_message, SEND_SENT, SEND_FAILED, STATUS_FAILED
+from helpers import SmtpStandIn
+
+
+@pytest.fixture
+def smtp(monkeypatch):
+    """Отправитель настраивается на локальный SMTP-сервер; первый повтор - через 0.2 с."""
+    def start(replies=None):
+        stand_in = SmtpStandIn(replies)
+        monkeypatch.setattr(email_sender, 'SMTP_SERVER', '127.0.0.1')
+        monkeypatch.setattr(email_sender, 'SMTP_PORT', stand_in.port)
+        monkeypatch.setattr(email_sender, 'SMTP_USE_SSL', False)
+        monkeypatch.setattr(email_sender, 'EMAIL_FROM', 'bot@example.com')
+        monkeypatch.setattr(email_sender, 'EMAIL_PASSWORD', 'secret')
+        monkeypatch.setattr(email_sender, 'EMAIL_RETRY_DELAY', 0.2)
+        return stand_in
+    return start
+
+
+def outbox_rows(path):
+    with sqlite3.connect(path) as conn:
+        return conn.execute("SELECT file_name, status, attempts FROM outbox ORDER BY id").fetchall()
+
+
+def run_sends(sender, *sends):
+    async def run():
+        try:
+            return await asyncio.gather(*(sender.send(name, b'data', [address], timeout=5) for name, address in sends))
+        finally:
+            await sender.stop()
+    return asyncio.run(run())
+
+
+def test_queued_messages_share_one_connection(smtp, tmp_path):
+    path = str(tmp_path / 'outbox.sqlite')
+    outbox = Outbox(path)
+    # Письма, накопившиеся в очереди до запуска отправителя (например, пока бот был остановлен)
+    for name in ('a.xlsx', 'b.xlsx', 'c.xlsx'):
+        outbox.add(name, [f'{name[0]}@example.com'], build_message(name, b'data', [f'{name[0]}@example.com']))
+
+    async def run(sender):
+        sender.start()
+        try:
+            while outbox_rows(path) and time.monotonic() - started < 5:
+                await asyncio.sleep(0.05)
+        finally:
+            await sender.stop()
+
+    with smtp() as stand_in:
+        started = time.monotonic()
+        asyncio.run(run(MailSender(outbox)))
+    assert stand_in.connections == 1
+    assert [recipients for _, recipients, _ in stand_in.delivered] == [['a@example.com'], ['b@example.com'],
+                                                                       ['c@example.com']]
+    assert outbox_rows(path) == []
+
+
+def test_temporary_errors_are_retried_with_backoff_and_permanent_are_not(smtp, tmp_path):
+    def replies(command, recipient, attempt):
+        rejections = {('DATA', 'later@example.com'): 451, ('RCPT', 'greylisted@example.com'): 450,
+                      ('DATA', 'bad@example.com'): 550, ('RCPT', 'unknown@example.com'): 550}
+        code = rejections.get((command, recipient))
+        # Временные отказы проходят со второй попытки, постоянные повторяются всегда
+        return code if code and (code >= 500 or attempt == 1) else None
+
+    path = str(tmp_path / 'outbox.sqlite')
+    started = time.monotonic()
+    with smtp(replies) as stand_in:
+        results = run_sends(MailSender(Outbox(path)), ('later.xlsx', 'later@example.com'),
+                            ('greylisted.xlsx', 'greylisted@example.com'), ('bad.xlsx', 'bad@example.com'),
+                            ('unknown.xlsx', 'unknown@example.com'))
+
+    assert results == [SEND_SENT, SEND_SENT, SEND_FAILED, SEND_FAILED]
+    assert stand_in.attempts == {'later@example.com': 2, 'greylisted@example.com': 2, 'bad@example.com': 1,
+                                 'unknown@example.com': 1}
+    # Повтор - не раньше EMAIL_RETRY_DELAY после первой попытки
+    assert all(moment - started >= 0.2 for moment, _, _ in stand_in.delivered)
+    assert outbox_rows(path) == [('bad.xlsx', STATUS_FAILED, 1), ('unknown.xlsx', STATUS_FAILED, 1)]
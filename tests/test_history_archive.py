@@ -0,0 +1,90 @@
+import os
+from datetime import datetime, timedelta
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip('pyarrow')
+
+import history_archive
+from history_archive import HistoryArchive
+from benchmarks.bench_rounding import make_compositions
+
+PROFILE = 'test'
+
+
+@pytest.fixture
+def archive(tmp_path):
+    """Архив с тремя запусками в каждый из трёх прошедших дней."""
+    archive = HistoryArchive(str(tmp_path / 'history'), cached_runs=0)
+    df_data, calculated_data, popularity_map = make_compositions(200, seed=5)
+    final_values = np.floor(np.clip(calculated_data, 0, None))
+    now = datetime.now().replace(microsecond=0)
+    for day in range(1, 4):
+        for run in range(3):
+            archive.append(PROFILE, df_data, calculated_data, final_values + day * 5 + run, popularity_map,
+                           run_at=now - timedelta(days=day, hours=run))
+    archive.plant = df_data.iloc[0, 2]
+    return archive
+
+
+def query(archive):
+    return archive.series(PROFILE, archive.plant), archive.depletion(PROFILE)
+
+
+def test_files_merged_into_day_file_are_not_counted_twice(archive, monkeypatch):
+    expected = query(archive)
+    # Склейка записала файлы дней, но ещё не удалила файлы запусков
+    monkeypatch.setattr(history_archive.os, 'remove', lambda path: None)
+    assert archive.compact() == 3
+    assert query(archive) == expected
+
+
+def test_scan_survives_compaction_during_read(archive, monkeypatch):
+    expected = query(archive)
+    day_files = HistoryArchive._day_files
+    compacted = []
+
+    def list_then_compact(day_path):
+        # compact удаляет файлы запусков сразу после того, как запрос их перечислил
+        paths = day_files(day_path)
+        if not compacted:
+            compacted.append(archive.compact())
+        return paths
+
+    monkeypatch.setattr(HistoryArchive, '_day_files', staticmethod(list_then_compact))
+    assert archive.series(PROFILE, archive.plant) == expected[0]
+    assert compacted == [3]
+    assert all(len(os.listdir(os.path.join(archive.directory, f'profile={PROFILE}', name))) == 1
+               for name in os.listdir(os.path.join(archive.directory, f'profile={PROFILE}')))
+    assert query(archive) == expected
+
+
+def test_compact_after_interrupted_compact_does_not_duplicate_rows(archive, monkeypatch):
+    with monkeypatch.context() as patch:
+        # Склейка прервалась после записи файлов дней, до удаления файлов запусков
+        patch.setattr(history_archive.os, 'remove', lambda path: None)
+        archive.compact()
+    df_data, calculated_data, popularity_map = make_compositions(200, seed=5)
+    archive.append(PROFILE, df_data, calculated_data, calculated_data, popularity_map,
+                   run_at=datetime.now().replace(microsecond=0) - timedelta(days=1, minutes=30))
+    expected = query(archive)
+
+    assert archive.compact() == 1
+    assert query(archive) == expected
+    profile_path = os.path.join(archive.directory, f'profile={PROFILE}')
+    assert all(len(os.listdir(os.path.join(profile_path, name))) == 1 for name in os.listdir(profile_path))
+
+
+def test_integral_float_codes_are_archived_without_fraction(tmp_path):
+    archive = HistoryArchive(str(tmp_path / 'history'), cached_runs=0)
+    # Коды растений и композиций, прочитанные из Excel как числа
+    df_data = pd.DataFrame({'composition': [501.0, 502.0, 'К-3'], 'crm_name': ['Набор 1', 'Набор 2', np.nan],
+                            'plant': [12345.0, 12345.0, 1.5]})
+    archive.append(PROFILE, df_data, np.array([3.0, 4.0, 1.0]), np.array([3.0, 4.0, 1.0]), {},
+                   run_at=datetime.now() - timedelta(days=1))
+    day = (datetime.now() - timedelta(days=1)).date().isoformat()
+
+    assert archive.series(PROFILE, '12345') == [(day, 7.0)]
+    assert archive.series(PROFILE, '502') == [(day, 4.0)]
+    assert archive.series(PROFILE, '1.5') == [(day, 1.0)]
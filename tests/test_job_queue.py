@@ -0,0 +1,35 @@
+import asyncio
+import threading
+
+from job_queue import JobQueue, STATUS_CANCELLED
+
+
+async def wait_running(queue):
+    while queue.active == 0:
+        await asyncio.sleep(0.01)
+
+
+def test_second_cancel_skips_jobs_already_cancelled():
+    release = threading.Event()
+
+    async def run():
+        queue = JobQueue(workers=1, executor_kind='thread')
+        queue.start()
+        try:
+            # Пул потоков передаёт функции колбэк прогресса последним аргументом
+            running = await queue.submit(1, lambda progress: release.wait(5))
+            queued = await queue.submit(1, lambda progress: release.wait(5))
+            await asyncio.wait_for(wait_running(queue), 5)
+            first = queue.cancel(1)
+            # Поток отменённой задачи ещё работает: задача остаётся в списке пользователя
+            remaining = queue.user_jobs(1)
+            second = queue.cancel(1)
+            return first, second, remaining, running, queued
+        finally:
+            release.set()
+            await queue.stop()
+
+    first, second, remaining, running, queued = asyncio.run(run())
+    assert (first, second) == (2, 0)
+    assert remaining == [running] and running.status == STATUS_CANCELLED
+    assert queued.status == STATUS_CANCELLED
@@ -0,0 +1,47 @@
+import time
+import asyncio
+from datetime import datetime
+
+import popularity_snapshot
+from crm_connector import PopularityStore
+from popularity_snapshot import PopularityScheduler
+
+
+async def hanging_crm(store, order_method):
+    # CRM не отвечает: запрос висит до таймаута
+    await asyncio.sleep(30)
+
+
+def previous_sync(path):
+    store = PopularityStore(path)
+    now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    store.upsert_orders([('1', now, {'Композиция 1'}), ('2', now, {'Композиция 1', 'Композиция 2'})])
+    store.set_watermark(now)
+
+
+def test_get_never_waits_for_crm(tmp_path, monkeypatch):
+    monkeypatch.setattr(popularity_snapshot, 'fetch_crm_popularity', hanging_crm)
+    previous_sync(str(tmp_path / 'crm.sqlite'))
+
+    async def run():
+        empty = PopularityScheduler(store_path=str(tmp_path / 'empty.sqlite'))
+        scheduler = PopularityScheduler(store_path=str(tmp_path / 'crm.sqlite'))
+        empty.start()
+        scheduler.start()
+        try:
+            started = time.perf_counter()
+            assert await empty.get() is None
+            assert await scheduler.get() is None  # Хранилище ещё не прочитано
+            await asyncio.sleep(0.5)
+            snapshot = await scheduler.get()
+            assert await empty.get() is None
+            return snapshot, time.perf_counter() - started
+        finally:
+            await empty.stop()
+            await scheduler.stop()
+
+    snapshot, seconds = asyncio.run(run())
+    assert seconds < 2
+    # Пока CRM молчит, используется популярность прошлой синхронизации
+    assert snapshot.data == {'Композиция 1': 2, 'Композиция 2': 1}
+    assert not snapshot.stale
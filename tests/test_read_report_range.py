@@ -0,0 +1,77 @@
+import random
+from io import BytesIO
+import pandas as pd
+import pytest
+from openpyxl import Workbook
+from openpyxl.utils.cell import range_boundaries
+
+from file_processing import read_report_range
+from profiles import REPORT_RANGE
+
+
+def read_excel_range(source, report_range):
+    """Чтение блока так, как это делала исходная версия через pd.read_excel."""
+    min_col, min_row, max_col, max_row = range_boundaries(report_range)
+    return pd.read_excel(source, header=None, usecols=list(range(min_col - 1, max_col)), skiprows=min_row - 1,
+                         nrows=max_row - min_row)
+
+
+def assert_same(source, report_range):
+    expected = read_excel_range(BytesIO(source) if isinstance(source, bytes) else source, report_range)
+    result = read_report_range(source, report_range)
+    # assert_frame_equal сравнивает и dtypes колонок, и позиции NaN
+    pd.testing.assert_frame_equal(result, expected)
+
+
+@pytest.mark.parametrize('report_range', ['A1:D294', 'A2:D60', 'B10:D83', 'C250:D300', 'D13:F83'])
+def test_matches_read_excel_on_leskovsky(workbooks, report_range):
+    path = workbooks / 'Остатки ИП Лесковский.xlsx'
+    if report_range == 'D13:F83':
+        # Колонок E:F в книге нет - обе реализации должны отказать одинаково
+        with pytest.raises(Exception):
+            read_excel_range(path, report_range)
+        with pytest.raises(Exception):
+            read_report_range(str(path), report_range)
+        return
+    assert_same(str(path), report_range)
+    assert_same(path.read_bytes(), report_range)
+
+
+@pytest.mark.parametrize('report_range', ['A1:F100', 'C2:F60', 'A200:C300'])
+def test_matches_read_excel_on_komus(workbooks, report_range):
+    # Первый лист справочника: текст, числа и пустые ячейки
+    assert_same((workbooks / 'Остатки_Комус.xlsx').read_bytes(), report_range)
+
+
+def make_report(seed):
+    """Отчёт с числами, дробями, текстом, числами в виде текста, пропусками и строками разной длины."""
+    rng = random.Random(seed)
+    workbook = Workbook()
+    worksheet = workbook.active
+    for row in range(1, rng.choice([40, 60, 70, 83, 90]) + 1):
+        for column in range(1, rng.randint(1, 9)):
+            kind = rng.random()
+            if kind < 0.1:
+                continue
+            if kind < 0.5:
+                value = rng.randint(-5, 100)
+            elif kind < 0.6:
+                value = rng.random() * 10
+            elif kind < 0.7:
+                value = str(rng.randint(0, 999))
+            elif kind < 0.85:
+                value = f'Товар {rng.randint(0, 9)}'
+            else:
+                value = float(rng.randint(0, 9))
+            worksheet.cell(row=row, column=column, value=value)
+    output = BytesIO()
+    workbook.save(output)
+    return output.getvalue()
+
+
+@pytest.mark.parametrize('seed', range(40))
+def test_matches_read_excel_on_generated_reports(seed):
+    data = make_report(seed)
+    expected = read_excel_range(BytesIO(data), REPORT_RANGE)
+    assert expected.isna().any().any()
+    pd.testing.assert_frame_equal(read_report_range(data), expected)
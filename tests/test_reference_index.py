@@ -0,0 +1,34 @@
+import sys
+import threading
+import numpy as np
+
+from benchmarks.bench_rounding import make_compositions
+from reference_index import build_index
+from reference_cache import COL_INDEX_COMPOSITION_KEY, COL_INDEX_CRM_NAME, COL_INDEX_PLANT_NAME
+
+
+def test_popularity_is_consistent_across_threads():
+    df_data, _, popularity_map = make_compositions(2000, seed=3)
+    index = build_index(df_data.iloc[:0], df_data, 'test', COL_INDEX_COMPOSITION_KEY, COL_INDEX_CRM_NAME,
+                         COL_INDEX_PLANT_NAME)
+    maps = [popularity_map, {name: count + 1000 for name, count in popularity_map.items()}]
+    expected = [df_data.iloc[:, COL_INDEX_CRM_NAME].map(m).fillna(0).to_numpy(dtype=float) for m in maps]
+    # Частое переключение потоков, чтобы смена снимка попадала между проверкой и чтением массива
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    mismatches = []
+
+    def worker(number):
+        for _ in range(2000):
+            if not np.array_equal(index.popularity(maps[number % 2]), expected[number % 2]):
+                mismatches.append(number)
+
+    threads = [threading.Thread(target=worker, args=(number,)) for number in range(4)]
+    try:
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        sys.setswitchinterval(interval)
+    assert not mismatches
@@ -0,0 +1,51 @@
+import shutil
+import numpy as np
+import pandas as pd
+import pytest
+
+from conftest import FILE_OST_KOMUS
+from reference_cache import ReferenceCache, export_snapshot, read_reference_workbook, KOMUS_LIST_2
+
+OTHER_SHEETS = ('счет остатков', KOMUS_LIST_2)
+
+
+@pytest.fixture
+def workbook(tmp_path):
+    # Своя копия книги: снимок и индекс пишутся рядом с ней
+    path = tmp_path / 'Остатки_Комус.xlsx'
+    shutil.copy(FILE_OST_KOMUS, path)
+    return str(path)
+
+
+def is_mapped(values):
+    while values is not None:
+        if isinstance(values, np.memmap):
+            return True
+        values = values.base
+    return False
+
+
+def test_snapshot_columns_are_not_copied(workbook):
+    export_snapshot(workbook)
+    data = ReferenceCache(workbook).get()
+
+    expected = read_reference_workbook(workbook)
+    for frame, expected_frame in zip((data.komus_df_1, data.komus_df_2_all), expected):
+        pd.testing.assert_frame_equal(frame, expected_frame)
+    numeric = [frame.iloc[:, position].to_numpy() for frame in (data.komus_df_1, data.komus_df_2_all)
+               for position, dtype in enumerate(frame.dtypes) if dtype.kind in 'biuf']
+    assert numeric and all(is_mapped(values) for values in numeric)
+
+
+def test_other_sheets_do_not_reuse_snapshot_and_index(workbook):
+    export_snapshot(workbook)
+    default = ReferenceCache(workbook).get()
+    other = ReferenceCache(workbook, OTHER_SHEETS).get()
+
+    komus_df_1, komus_df_2_all = read_reference_workbook(workbook, OTHER_SHEETS)
+    pd.testing.assert_frame_equal(other.komus_df_1, komus_df_1)
+    assert not is_mapped(other.komus_df_1.iloc[:, 0].to_numpy())
+    # Индекс той же книги с другим листом остатков строится заново и не путается с индексом по умолчанию
+    assert other.index.digest != default.index.digest
+    assert not np.array_equal(other.index.item_rows, default.index.item_rows)
+    assert np.array_equal(ReferenceCache(workbook).get().index.item_rows, default.index.item_rows)
@@ -0,0 +1,136 @@
+import time
+import asyncio
+import aiohttp
+import pytest
+from aiohttp import web
+
+import retailcrm_client
+from retailcrm_client import RetailCrmClient, TokenBucket, CrmError, ORDER_FIELDS
+from helpers import serve
+
+ORDER = {
+    'id': 7, 'number': '7A', 'createdAt': '2025-09-01 10:00:00', 'customer': {'firstName': 'Анна'},
+    'items': [{'id': 1, 'offer': {'name': 'Набор'}, 'properties': [{'code': 'SET_NAME', 'value': 'Набор [Мох]'}]}],
+}
+
+
+class ScriptedCrm:
+    """Сервер, отвечающий по сценарию: каждый элемент - ответ на очередной запрос, последний повторяется."""
+
+    def __init__(self, *script):
+        self.script = list(script)
+        self.requests = []
+
+    def make_app(self):
+        app = web.Application()
+        app.router.add_get('/api/v5/{path:.*}', self.handle)
+        return app
+
+    async def handle(self, request):
+        self.requests.append((time.perf_counter(), request))
+        step = self.script[min(len(self.requests), len(self.script)) - 1]
+        if step == 'drop':
+            # Обрыв соединения до ответа
+            request.transport.close()
+            return web.Response()
+        status, body, headers = step if len(step) == 3 else (*step, {})
+        return web.json_response(body, status=status, headers=headers)
+
+
+OK = (200, {'success': True, 'orders': [ORDER]})
+
+
+def call(crm, method='get', *args, **client_kwargs):
+    async def run():
+        async with serve(crm.make_app()) as base_url:
+            client_kwargs.setdefault('rate', 0)
+            async with RetailCrmClient(base_url, 'secret', **client_kwargs) as client:
+                return await getattr(client, method)(*args)
+    return asyncio.run(run())
+
+
+@pytest.fixture(autouse=True)
+def short_backoff(monkeypatch):
+    monkeypatch.setattr(retailcrm_client, 'CRM_RETRY_BASE_DELAY', 0.01)
+
+
+def test_429_waits_for_retry_after():
+    crm = ScriptedCrm((429, {'success': False}, {'Retry-After': '0.4'}), OK)
+    data = call(crm, 'get', 'orders', max_retries=2)
+
+    assert data['orders'] == [ORDER]
+    assert len(crm.requests) == 2
+    assert crm.requests[1][0] - crm.requests[0][0] >= 0.4
+
+
+def test_5xx_is_retried_until_success():
+    crm = ScriptedCrm((503, {}), (502, {}), OK)
+    assert call(crm, 'get', 'orders', max_retries=3)['success']
+    assert len(crm.requests) == 3
+
+
+def test_5xx_after_all_retries_raises_crm_error():
+    crm = ScriptedCrm((500, {'success': False}))
+    with pytest.raises(CrmError):
+        call(crm, 'get', 'orders', max_retries=2)
+    assert len(crm.requests) == 3
+
+
+def test_dropped_connection_is_retried():
+    crm = ScriptedCrm('drop', OK)
+    assert call(crm, 'get', 'orders', max_retries=2)['orders'] == [ORDER]
+    assert len(crm.requests) == 2
+
+
+def test_dropped_connection_after_all_retries_raises_client_error():
+    crm = ScriptedCrm('drop')
+    with pytest.raises(aiohttp.ClientConnectionError):
+        call(crm, 'get', 'orders', max_retries=1)
+    # aiohttp сам повторяет запрос, если оборвалось повторно используемое соединение, поэтому запросов не меньше двух
+    assert len(crm.requests) >= 2
+
+
+def test_success_false_raises_without_retries():
+    crm = ScriptedCrm((200, {'success': False, 'errorMsg': 'Not found'}))
+    with pytest.raises(CrmError, match='Not found'):
+        call(crm, 'get', 'orders', max_retries=3)
+    assert len(crm.requests) == 1
+
+
+def test_token_bucket_limits_rate():
+    async def run(bucket, count):
+        started = time.monotonic()
+        for _ in range(count):
+            await bucket.acquire()
+        return time.monotonic() - started
+
+    # Запас из 2 жетонов уходит сразу, остальные 4 - по одному в 1/20 с
+    assert 0.2 <= asyncio.run(run(TokenBucket(20, 2), 6)) < 1
+    assert asyncio.run(run(TokenBucket(0), 100)) < 0.05
+
+
+def test_client_requests_are_rate_limited():
+    crm = ScriptedCrm(OK)
+
+    async def run():
+        async with serve(crm.make_app()) as base_url:
+            async with RetailCrmClient(base_url, 'secret', rate=20, burst=1) as client:
+                await asyncio.gather(*(client.get('orders') for _ in range(5)))
+
+    asyncio.run(run())
+    times = [moment for moment, _ in crm.requests]
+    assert times[-1] - times[0] >= 4 / 20 * 0.9
+
+
+def test_list_orders_projects_fields_and_builds_filters():
+    crm = ScriptedCrm(OK)
+    data = call(crm, 'list_orders', {'createdAtFrom': '2025-09-01', 'extendedStatus': ['new', 'complete']}, 3, 50,
+                ORDER_FIELDS)
+
+    assert data['orders'] == [{'id': 7, 'createdAt': '2025-09-01 10:00:00',
+                               'items': [{'properties': [{'code': 'SET_NAME', 'value': 'Набор [Мох]'}]}]}]
+    request = crm.requests[0][1]
+    assert request.headers['X-API-KEY'] == 'secret'
+    assert request.query['limit'] == '50' and request.query['page'] == '3'
+    assert request.query['filter[createdAtFrom]'] == '2025-09-01'
+    assert request.query.getall('filter[extendedStatus][]') == ['new', 'complete']
@@ -0,0 +1,90 @@
+import numpy as np
+import pytest
+
+import baseline
+from benchmarks.bench_rounding import make_compositions
+from file_processing import apply_rounding_logic, IncrementalRounding
+from reference_index import build_index
+from reference_cache import COL_INDEX_COMPOSITION_KEY, COL_INDEX_CRM_NAME, COL_INDEX_PLANT_NAME
+
+
+def make_index(df_data):
+    return build_index(df_data.iloc[:0], df_data, 'test', COL_INDEX_COMPOSITION_KEY, COL_INDEX_CRM_NAME,
+                       COL_INDEX_PLANT_NAME)
+
+
+def successive_runs(size, seed, runs=8):
+    """Данные нескольких запусков подряд: между запусками меняются часть остатков и популярности."""
+    df_data, calculated_data, popularity_map = make_compositions(size, seed=seed)
+    rng = np.random.default_rng(seed)
+    values = np.asarray(calculated_data, dtype=float)
+    for run in range(runs):
+        if run:
+            values = values.copy()
+            changed = rng.integers(0, size, max(1, size // 50))
+            values[changed] = rng.integers(-2, 40, changed.size) / rng.integers(1, 7, changed.size)
+            if run % 3 == 2:
+                values[rng.integers(0, size, 3)] = np.nan
+            popularity_map = dict(popularity_map)
+            for name in rng.integers(0, size, 3):
+                popularity_map[f'Композиция {name}'] = int(rng.integers(0, 20))
+        yield df_data, values, popularity_map
+
+
+@pytest.mark.parametrize('size, seed', [(50, 0), (1000, 1), (2000, 2)])
+def test_rounding_matches_baseline(size, seed):
+    for df_data, values, popularity_map in successive_runs(size, seed, runs=3):
+        expected = baseline.apply_rounding_logic(df_data, values, popularity_map).to_numpy()
+        assert apply_rounding_logic(df_data, values, popularity_map).to_numpy().tobytes() == expected.tobytes()
+        index = make_index(df_data)
+        assert apply_rounding_logic(df_data, values, popularity_map, index).to_numpy().tobytes() == \
+            expected.tobytes()
+
+
+@pytest.mark.parametrize('size, seed', [(200, 3), (1500, 4)])
+def test_incremental_rounding_matches_baseline_across_runs(size, seed):
+    rounding = IncrementalRounding()
+    previous = None
+    for run, (df_data, values, popularity_map) in enumerate(successive_runs(size, seed)):
+        expected = baseline.apply_rounding_logic(df_data, values, popularity_map).to_numpy()
+        result, delta = rounding.apply(df_data, values, popularity_map, make_index(df_data))
+        assert result.to_numpy().tobytes() == expected.tobytes(), run
+        if previous is None:
+            assert delta is None
+        else:
+            # В отчёт об изменениях попадают ровно те строки, у которых изменился результат
+            assert len(delta) == int((expected != previous).sum())
+        previous = expected
+
+
+def test_incremental_rounding_recomputes_all_when_reference_changes():
+    df_data, values, popularity_map = make_compositions(500, seed=5)
+    rounding = IncrementalRounding()
+    rounding.apply(df_data, values, popularity_map, make_index(df_data))
+
+    other, other_values, other_popularity = make_compositions(500, seed=6)
+    index = build_index(other.iloc[:0], other, 'other', COL_INDEX_COMPOSITION_KEY, COL_INDEX_CRM_NAME,
+                        COL_INDEX_PLANT_NAME)
+    result, delta = rounding.apply(other, other_values, other_popularity, index)
+    expected = baseline.apply_rounding_logic(other, other_values, other_popularity).to_numpy()
+    assert delta is None
+    assert result.to_numpy().tobytes() == expected.tobytes()
+
+
+def test_rounding_matches_baseline_on_bundled_reference(reference):
+    # Часть композиций без названия растения и без названия в CRM - как в незаполненных строках справочника
+    komus_df_2_all = reference[1].copy()
+    komus_df_2_all.iloc[:5, COL_INDEX_PLANT_NAME] = np.nan
+    komus_df_2_all.iloc[5:10, COL_INDEX_CRM_NAME] = np.nan
+    index = make_index(komus_df_2_all)
+    rounding = IncrementalRounding()
+    rng = np.random.default_rng(7)
+    names = komus_df_2_all.iloc[:, COL_INDEX_CRM_NAME].dropna().unique()
+    for run in range(4):
+        values = rng.integers(-2, 30, len(komus_df_2_all)) / rng.integers(1, 5, len(komus_df_2_all))
+        popularity_map = {name: int(rng.integers(0, 5)) for name in names if rng.random() < 0.7}
+        expected = baseline.apply_rounding_logic(komus_df_2_all, values, popularity_map).to_numpy()
+        assert apply_rounding_logic(komus_df_2_all, values, popularity_map, index).to_numpy().tobytes() == \
+            expected.tobytes()
+        result, _ = rounding.apply(komus_df_2_all, values, popularity_map, index)
+        assert result.to_numpy().tobytes() == expected.tobytes(), run
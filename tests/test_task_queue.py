@@ -0,0 +1,96 @@
+import time
+import asyncio
+import pytest
+from aiogram.fsm.storage.base import StorageKey
+
+from fsm_storage import SQLiteStorage
+from job_queue import STATUS_QUEUED, STATUS_RUNNING, STATUS_CANCELLED
+from task_queue import SQLiteTaskQueue, TASK_MAX_ATTEMPTS
+from worker import Worker
+
+
+@pytest.fixture
+def queue(tmp_path):
+    # stale_after=0: задача считается брошенной, как только обработчик пропустил хотя бы одну отметку
+    return SQLiteTaskQueue(str(tmp_path / 'tasks.sqlite'), stale_after=0)
+
+
+def claim_later(queue):
+    time.sleep(0.01)
+    return queue.claim('worker')
+
+
+def test_abandoned_task_is_dropped_after_max_attempts(queue):
+    job_id, _ = queue.put(1, 10, 'file-a', 'a.xlsx')
+    queue.put(1, 10, 'file-b', 'b.xlsx')
+    attempts = [claim_later(queue).attempts for _ in range(TASK_MAX_ATTEMPTS)]
+    assert attempts == list(range(1, TASK_MAX_ATTEMPTS + 1))
+
+    # Исчерпавшая попытки задача не возвращается в очередь, а снимается с уведомлением
+    assert claim_later(queue).files == [('file-b', 'b.xlsx')]
+    assert queue.drop_abandoned() == [(job_id, 10, ['a.xlsx'])]
+    assert queue.status(job_id) is None
+    assert queue.drop_abandoned() == []
+
+
+def test_cancelled_task_of_dead_worker_is_removed(queue):
+    job_id, _ = queue.put(1, 10, 'file-a', 'a.xlsx')
+    queue.claim('worker')
+    assert queue.cancel(1) == 1
+    assert queue.status(job_id) == STATUS_CANCELLED
+
+    assert claim_later(queue) is None
+    assert queue.status(job_id) is None
+
+
+def test_user_jobs_report_status_and_position(tmp_path):
+    queue = SQLiteTaskQueue(str(tmp_path / 'tasks.sqlite'))
+    running, _ = queue.put(1, 10, 'file-a', 'a.xlsx')
+    queue.claim('worker')
+    other, _ = queue.put(2, 20, 'file-b', 'b.xlsx')
+    queued, _ = queue.put(1, 10, 'file-c', 'c.xlsx', media_group_id='album')
+    queue.put(1, 10, 'file-d', 'd.xlsx', media_group_id='album')
+
+    assert queue.user_jobs(1) == [(running, STATUS_RUNNING, 0, ['a.xlsx']),
+                                  (queued, STATUS_QUEUED, 2, ['c.xlsx', 'd.xlsx'])]
+    assert queue.user_jobs(2) == [(other, STATUS_QUEUED, 1, ['b.xlsx'])]
+    assert queue.user_jobs(3) == []
+
+
+class FailingBot:
+    def __init__(self):
+        self.calls = 0
+
+    async def send_message(self, chat_id, text):
+        self.calls += 1
+        raise ConnectionError('Telegram недоступен')
+
+
+def test_worker_survives_failed_error_notice(queue):
+    queue.put(1, 10, 'file-a', 'a.xlsx')
+    task = queue.claim('worker')
+    worker = Worker('test', queue)
+
+    async def broken(bot, task):
+        raise ValueError('испорченный файл')
+
+    worker._process = broken
+    bot = FailingBot()
+    asyncio.run(worker.process(bot, task))
+    assert bot.calls == 1
+    assert queue.status(task.job_id) is None
+
+
+def test_sqlite_storage_keeps_state_and_data(tmp_path):
+    key = StorageKey(bot_id=1, chat_id=10, user_id=1)
+
+    async def run():
+        storage = SQLiteStorage(str(tmp_path / 'fsm.sqlite'))
+        await storage.set_state(key, 'waiting')
+        await storage.set_data(key, {'profile': 'Лесковский'})
+        # Другой процесс бота открывает тот же файл
+        other = SQLiteStorage(str(tmp_path / 'fsm.sqlite'))
+        stranger = StorageKey(bot_id=1, chat_id=20, user_id=2)
+        return await other.get_state(key), await other.get_data(key), await other.get_state(stranger)
+
+    assert asyncio.run(run()) == ('waiting', {'profile': 'Лесковский'}, None)
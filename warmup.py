@@ -0,0 +1,69 @@
+import os
+import time
+import asyncio
+import logging
+from dotenv import load_dotenv
+
+from metrics import metrics
+
+# --- ЗАГРУЗКА ПЕРЕМЕННЫХ ИЗ .ENV ---
+load_dotenv()
+# Режим запуска: 'lazy' - бот начинает опрос сразу, стек обработки прогревается в фоне;
+# 'eager' - опрос начинается только после прогрева
+STARTUP_MODE = os.getenv("STARTUP_MODE", "lazy")
+
+
+class Warmup:
+    """
+    Прогрев стека обработки в отдельном потоке: импорт pandas/numpy/openpyxl (через file_processing),
+    загрузка справочников и шаблонов отчёта всех профилей.
+    Обработчики ждут прогрева через wait() перед первой задачей.
+    """
+
+    def __init__(self):
+        self._task = None
+        self.duration = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(asyncio.to_thread(self._run))
+        return self._task
+
+    async def wait(self):
+        """Ждёт окончания прогрева. Если импорт не удался, ошибка пробрасывается, а следующий вызов повторит прогрев."""
+        task = self.start()
+        try:
+            await asyncio.shield(task)
+        except Exception:
+            if self._task is task:
+                self._task = None
+            raise
+
+    @property
+    def ready(self):
+        return self._task is not None and self._task.done() and not self._task.exception()
+
+    def _run(self):
+        started = time.perf_counter()
+        with metrics.span('warmup_import'):
+            import file_processing  # noqa: F401 - импорт и есть прогрев
+            import batch  # noqa: F401
+        from profiles import profile_registry
+
+        # Без справочника или шаблона бот всё равно работает: ошибку покажет обработка файла
+        for profile in profile_registry.profiles.values():
+            for stage, load in (('warmup_reference', profile.reference_cache.get),
+                                ('warmup_template', profile.template_cache.get)):
+                try:
+                    with metrics.span(stage):
+                        load()
+                except Exception as e:
+                    logging.error(f"Прогрев профиля {profile.name}: не удалось выполнить {stage}: {e}")
+
+        self.duration = time.perf_counter() - started
+        metrics.set_gauge('warmup_seconds', self.duration)
+        logging.info(f"Стек обработки прогрет за {self.duration:.3f} с")
+
+
+# Общий прогрев процесса
+processing_warmup = Warmup()
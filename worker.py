@@ -0,0 +1,181 @@
+"""
+Процессы-обработчики общей очереди задач (JOB_BACKEND=sqlite): забирают документы, поставленные
+процессами бота, обрабатывают их и сами отправляют результат пользователю.
+Процессов бота (реплик в режиме webhook) и обработчиков может быть сколько угодно, если у всех
+одни и те же TASK_QUEUE_PATH, JOB_REGISTRY_PATH, FSM_STORAGE_PATH и хранилища CRM.
+
+Запуск из корня проекта:
+    python worker.py --processes 4
+"""
+import os
+import sys
+import time
+import socket
+import asyncio
+import logging
+import argparse
+import multiprocessing
+from dotenv import load_dotenv
+
+from job_queue import STATUS_CANCELLED
+from metrics import metrics
+from task_queue import SQLiteTaskQueue, JOB_BACKEND, TASK_STALE_AFTER
+
+# --- ЗАГРУЗКА ПЕРЕМЕННЫХ ИЗ .ENV ---
+load_dotenv()
+# Сколько процессов-обработчиков запускается
+WORKER_PROCESSES = int(os.getenv("WORKER_PROCESSES", str(os.cpu_count() or 1)))
+# Как часто свободный обработчик проверяет очередь, в секундах
+WORKER_POLL_INTERVAL = float(os.getenv("WORKER_POLL_INTERVAL", "1.0"))
+# Отметка о живости чаще, чем задача считается брошенной
+WORKER_HEARTBEAT_INTERVAL = max(1.0, TASK_STALE_AFTER / 3)
+
+
+class StatusMessage:
+    """Сообщение о ходе обработки: правится, если бот уже отправил его при постановке в очередь."""
+
+    def __init__(self, bot, chat_id, message_id):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.message_id = message_id
+
+    async def update(self, text):
+        try:
+            if self.message_id is None:
+                self.message_id = (await self.bot.send_message(self.chat_id, text)).message_id
+            else:
+                await self.bot.edit_message_text(text, chat_id=self.chat_id, message_id=self.message_id)
+        except Exception as e:
+            logging.warning(f"Не удалось сообщить статус задачи: {e}")
+
+
+class Worker:
+    """Обработчик: по одной задаче за раз, тяжёлая обработка - в отдельном потоке."""
+
+    def __init__(self, name, queue=None):
+        self.name = name
+        self.queue = queue or SQLiteTaskQueue()
+
+    async def run(self):
+        # Бот и отправка результата общие с main.py; модуль бота с его обработчиками сообщений не нужен
+        from delivery import bot
+        from warmup import processing_warmup
+
+        await processing_warmup.wait()
+        logging.info(f"Обработчик {self.name} готов к работе.")
+        try:
+            while True:
+                try:
+                    for job_id, chat_id, files in await asyncio.to_thread(self.queue.drop_abandoned):
+                        text = (f"Не удалось обработать {', '.join(files)}: обработка несколько раз прерывалась. "
+                                f"Отправьте файл ещё раз.")
+                        await self._notify(bot, chat_id, text)
+                    task = await asyncio.to_thread(self.queue.claim, self.name)
+                    if task is None:
+                        await asyncio.sleep(WORKER_POLL_INTERVAL)
+                        continue
+                    await self.process(bot, task)
+                except Exception as e:
+                    # Ошибка одной задачи или недоступность файла очереди не должны останавливать обработчик
+                    logging.error(f"Обработчик {self.name}: ошибка при работе с очередью: {e}", exc_info=True)
+                    await asyncio.sleep(WORKER_POLL_INTERVAL)
+        finally:
+            await bot.session.close()
+
+    async def process(self, bot, task):
+        started = time.perf_counter()
+        logging.info(f"Обработчик {self.name} взял задачу {task.job_id}: файлов {len(task.files)}, "
+                     f"попытка {task.attempts}")
+        heartbeat = asyncio.create_task(self._heartbeat(task.job_id))
+        try:
+            await self._process(bot, task)
+        except Exception as e:
+            logging.error(f"Ошибка при обработке задачи {task.job_id}: {e}", exc_info=True)
+            await self._notify(bot, task.chat_id, f"Произошла ошибка: {e}")
+        finally:
+            heartbeat.cancel()
+            await asyncio.gather(heartbeat, return_exceptions=True)
+            await asyncio.to_thread(self.queue.finish, task.job_id)
+            metrics.observe('stage_duration_seconds', time.perf_counter() - started, stage='worker_task')
+
+    async def _process(self, bot, task):
+        from delivery import processing_call, announce_job, deliver_results
+        from profiles import profile_registry
+        from popularity_snapshot import load_store_snapshot
+
+        status = StatusMessage(bot, task.chat_id, task.status_message_id)
+        await status.update("Начинаю обработку файла...")
+
+        # Файлы скачиваются сразу в память, на диск ничего не пишется
+        inputs = []
+        for file_id, file_name in task.files:
+            buffer = await bot.download(file_id)
+            inputs.append((file_name, buffer.getvalue()))
+
+        profile = profile_registry.resolve(task.user_id, inputs[0][0], task.profile)
+        # Хранилище заказов синхронизирует процесс бота, обработчик только читает его
+        snapshot = await asyncio.to_thread(load_store_snapshot, profile.crm_store)
+        popularity_map = await announce_job(task.chat_id, profile, snapshot)
+
+        loop = asyncio.get_running_loop()
+
+        def progress(text):
+            asyncio.run_coroutine_threadsafe(status.update(text), loop)
+
+        func, data = processing_call(inputs, profile)
+        result = await asyncio.to_thread(func, data, popularity_map, progress)
+
+        if await asyncio.to_thread(self.queue.status, task.job_id) == STATUS_CANCELLED:
+            await bot.send_message(task.chat_id, "Обработка файла отменена.")
+            return
+        await deliver_results(task.chat_id, task.user_id, task.job_id, inputs, result, profile)
+
+    @staticmethod
+    async def _notify(bot, chat_id, text):
+        try:
+            await bot.send_message(chat_id, text)
+        except Exception as e:
+            logging.warning(f"Не удалось отправить сообщение в чат {chat_id}: {e}")
+
+    async def _heartbeat(self, job_id):
+        while True:
+            await asyncio.sleep(WORKER_HEARTBEAT_INTERVAL)
+            await asyncio.to_thread(self.queue.heartbeat, job_id)
+
+
+def run_worker(index):
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    try:
+        asyncio.run(Worker(f"{socket.gethostname()}-{os.getpid()}-{index}").run())
+    except KeyboardInterrupt:
+        pass
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Обработчики общей очереди задач бота")
+    parser.add_argument('--processes', type=int, default=WORKER_PROCESSES)
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    if JOB_BACKEND != 'sqlite':
+        # Без общей очереди бот обрабатывает файлы сам и задач для обработчиков не ставит
+        logging.error("Обработчики работают только с общей очередью: задайте JOB_BACKEND=sqlite боту и worker.py.")
+        return 1
+    processes = [multiprocessing.Process(target=run_worker, args=(index,), name=f"worker-{index}")
+                 for index in range(max(1, args.processes))]
+    for process in processes:
+        process.start()
+    logging.info(f"Запущено обработчиков: {len(processes)}")
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.join()
+    return max((process.exitcode or 0) for process in processes)
+
+
+if __name__ == '__main__':
+    sys.exit(main())